@@ -0,0 +1,162 @@
+# pylint: disable=E0401
+import argparse
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from perform_test import DATASETS
+from queries.field_spec import FieldSpec
+from queries.query import Query, GENERATION_MODES, DIRECT_GENERATION
+from utils.prepare_database import prepare_database
+from utils.query_timing import time_query, timing_summary, print_repetition_report
+from utils.snapshot import create_dataset_db, create_dataset_connection, paused, remove_database
+
+
+TEST_TIME_STRING = f"{datetime.now().date()}-{datetime.now().hour}H"
+
+# Executions of each query. ADAPTIVE_ITERATIONS instead repeats each query until the
+# confidence interval of its median is narrow enough, see `utils.query_timing.done_iterating`
+ITERATIONS = 5
+
+
+def _results_match(dfs: list[pd.DataFrame]) -> bool:
+    """
+    Compare the results of the modes, ignoring the order of rows, as rows tied in
+    ORDER BY may be returned in any order, and the names of unaliased columns, which
+    depend on how the field is extracted
+    """
+    def _sorted(df: pd.DataFrame) -> pd.DataFrame:
+        df = df.set_axis(range(len(df.columns)), axis=1)
+        return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+    return all(_sorted(df).equals(_sorted(dfs[0])) for df in dfs)
+
+
+def _perform_test(
+        con,
+        queries: dict[str, Query],
+        field_spec: FieldSpec,
+        modes: list[str],
+) -> list[dict]:
+    '''Execute each query generated in each mode, and check that the results match'''
+    rows = []
+
+    for query_no, (query_name, query_obj) in enumerate(queries.items()):
+        mode_results = []
+        # Rotate the order of the modes, so no mode always runs on a warm cache
+        rotation = query_no % len(modes)
+        for mode in modes[rotation:] + modes[:rotation]:
+            query = query_obj.get_query(fields=field_spec, mode=mode)
+
+            execution_times, _, result = time_query(
+                con=con, query=query, iterations=ITERATIONS, fetch=True)
+            mode_results.append(result)
+
+            row = {
+                "Query": query_name,
+                "Mode": mode,
+            }
+            row.update(timing_summary(execution_times=execution_times))
+            row["Avg (last 4 runs)"] = sum(
+                execution_times[1:]) / (len(execution_times) - 1)
+            rows.append(row)
+
+        results_match = _results_match(dfs=mode_results)
+        for row in rows[-len(modes):]:
+            row["Results match"] = results_match
+
+        timings = ", ".join(
+            f"{row['Mode']} {row['Avg (last 4 runs)']:.4f}s" for row in rows[-len(modes):])
+        print(
+            f"Query {query_name}: {timings}{'' if results_match else ' (results do not match)'}")
+
+    return rows
+
+
+def _fastest_modes(results_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Get the fastest mode of each query in each test, and its speedup over direct generation
+    """
+    fastest = results_df.loc[results_df.groupby(
+        ["Test", "Query"], sort=False)["Avg (last 4 runs)"].idxmin()]
+    direct = results_df[results_df["Mode"] == DIRECT_GENERATION].set_index(
+        ["Test", "Query"])["Avg (last 4 runs)"]
+
+    fastest = fastest[["Test", "Query", "Mode",
+                       "Avg (last 4 runs)"]].rename(columns={"Mode": "Fastest mode"})
+    fastest["Speedup over direct"] = [
+        direct.get((test, query), float("nan")) / avg
+        for test, query, avg in zip(fastest["Test"], fastest["Query"], fastest["Avg (last 4 runs)"])
+    ]
+    return fastest.reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the query generation modes on each materialization setup.")
+    parser.add_argument("dataset", nargs="?", default="tpch", choices=list(DATASETS.keys()),
+                        help="The dataset to run tests on")
+    parser.add_argument("--modes", nargs="+", default=GENERATION_MODES, choices=GENERATION_MODES,
+                        help="The generation modes to compare")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="Import the backup into an in-memory database, and copy it in memory for the tests, rather than copying database files")
+    args = parser.parse_args()
+
+    modes = args.modes
+    if DIRECT_GENERATION not in modes:
+        modes = [DIRECT_GENERATION] + modes
+
+    dataset = args.dataset
+    config = DATASETS[dataset]
+    queries: dict = config["queries"]
+    tests_map: dict = config["tests_map"]
+    column_map: dict = config["column_map"]
+
+    result_dir = f"./results/generation-modes/{dataset}/{TEST_TIME_STRING}"
+    os.makedirs(result_dir, exist_ok=True)
+
+    create_dataset_db(dataset=dataset, in_memory=args.in_memory)
+    db_connection, db_path = create_dataset_connection(dataset=dataset)
+
+    rows = []
+    for test, test_config in tests_map.items():
+        materialize_columns = test_config["materialization"]
+        if materialize_columns is None:
+            materialize_columns = column_map.keys()
+
+        fields = []
+        for field, access_query in column_map.items():
+            fields.append(
+                (field, access_query, field in materialize_columns))
+
+        # Without background copies competing for I/O
+        with paused():
+            prepare_database(con=db_connection, fields=fields)
+
+        print(f"\nTest {test}")
+        test_rows = _perform_test(
+            con=db_connection,
+            queries=queries,
+            field_spec=FieldSpec(fields),
+            modes=modes,
+        )
+        rows.extend({"Test": test, **row} for row in test_rows)
+
+    db_connection.close()
+    remove_database(db_path)
+
+    results_df = pd.DataFrame(rows)
+    results_df.to_csv(result_dir + "/results.csv", index=False)
+
+    fastest_df = _fastest_modes(results_df=results_df)
+    fastest_df.to_csv(result_dir + "/fastest_modes.csv", index=False)
+    print(f"\nFastest mode per query:\n{fastest_df.to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    t = time.perf_counter()
+    main()
+    print_repetition_report()
+    print(f"Finished test in time ~{int(time.perf_counter() - t)/60} minutes")
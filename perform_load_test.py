@@ -1,20 +1,27 @@
 # pylint: disable=E0401
 import copy
 from datetime import datetime
-import shutil
 import time
 import os
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 from collections.abc import Callable
 
 import duckdb  # type: ignore
+import numpy as np
 import pandas as pd
 
 import testing.twitter.setup as twitter_setup
 import testing.tpch.setup as tpch_setup
+from queries.field_spec import FieldSpec
 from queries.query import Query
+import utils.advisor as advisor
 import utils.generate_load as generate_load
+import utils.selector as selector
+from utils.measurement_cache import MeasurementCache, measurement_setup
+from utils.usage_matrix import get_usage_matrix
 from utils.prepare_database import prepare_database
+from utils.query_timing import time_query, timing_summary, print_repetition_report, DIRECT_EXECUTION
+from utils.snapshot import create_connection, import_in_memory, paused, print_setup_report
 
 if not os.path.isdir("./results"):
     os.mkdir("./results")
@@ -40,7 +47,31 @@ DISTRIBUTIONS: dict[str, Callable] = {
 
 USE_WEIGHTS_IN_DECISION = True
 USE_PREV_TIME_IN_DECISION = True
+# Also test the materializations recommended by the cost-based advisor, see `utils.advisor`
+USE_COST_BASED_ADVISOR = True
+# Also test the materializations selected by `utils.selector` within storage budgets, in
+# percent of the storage of materializing every field
+USE_KNAPSACK_SELECTOR = True
+KNAPSACK_BUDGETS = [1, 2, 5, 10, 20, 50]
+# The number of write tests worth of writes performed alongside each load
+WRITE_WEIGHT = 1
 DATASET = 'tpch'
+# Size of the backup the database is imported from
+BACKUP_SIZE = 'tiny'
+# Import the backup into memory, and snapshot it in memory, rather than copying
+# database files. For backups small enough to fit in memory twice
+IN_MEMORY = False
+# How queries are executed, see `utils.query_timing`
+EXECUTION_MODE = DIRECT_EXECUTION
+# Executions of each query. ADAPTIVE_ITERATIONS instead repeats each query until the
+# confidence interval of its median is narrow enough, see `utils.query_timing.done_iterating`
+ITERATIONS = 5
+# Reuse the execution times measured by earlier runs, see `utils.measurement_cache`
+USE_MEASUREMENT_CACHE = True
+# Measure again if the stored measurement is older than this. None never expires
+MEASUREMENT_MAX_AGE = None
+# Measure every query again, replacing the stored measurements
+FORCE_MEASUREMENT = False
 
 
 # Paths and queries for different datasets
@@ -95,32 +126,13 @@ def _generate_loads(distribution: str, queries: dict[str, Query]) -> dict[str, l
     return load_confs
 
 
-def _calculate_field_priority(load: list[str], field_distribution: pd.DataFrame):
-    # Copy to not alter original df
-    field_distribution = field_distribution.copy()
-    field_names = field_distribution.columns.drop("query")
-
-    # Calculate column frequency given the load
-    query_frequency = defaultdict(int)
-    # Calculate query frequency
-    for query in load:
-        query_frequency[query] += 1
-    # Get column frequency
-    for query, frequency in query_frequency.items():
-        mask = field_distribution["query"] == query
-        field_distribution.loc[mask, field_names] *= frequency
-
-    # Get column frequency across all queries in load
-    field_frequency = field_distribution.sum(axis=0, numeric_only=True)
-    # Sort column frequencies
-    field_frequency.sort_values(ascending=False, inplace=True)
-
-    return field_frequency
-
-
 def _create_fresh_db():
     db_path = f"./data/db/{DATASET}.duckdb"
-    backup_path = f"./data/backup/{DATASET}_tiny"
+    backup_path = f"./data/backup/{DATASET}_{BACKUP_SIZE}"
+
+    if IN_MEMORY:
+        import_in_memory(db_path=db_path, backup_path=backup_path)
+        return
 
     if os.path.exists(db_path):
         os.remove(db_path)
@@ -133,51 +145,39 @@ def _create_connection(test: str = "temp") -> tuple[duckdb.DuckDBPyConnection, s
     original_db_path = BASE_PATH + f"/data/db/{DATASET}.duckdb"
     copy_db_path = BASE_PATH + f"/data/db/{DATASET}_{test}.db"
 
-    # Remove any old db
-    if os.path.exists(copy_db_path):
-        os.remove(copy_db_path)
-
-    # Copy original db
-    shutil.copy(original_db_path, copy_db_path)
-
     PATHS_TO_REMOVE.append(copy_db_path)
 
-    # Reconnect to db
-    con = duckdb.connect(copy_db_path)
+    return create_connection(original_db_path=original_db_path, copy_db_path=copy_db_path)
 
-    con.execute("CHECKPOINT;")
 
-    return con, copy_db_path
+def _append_row(columns: dict[str, list], row: dict):
+    """
+    Append a row to columnar buffers, leaving the columns missing from the row empty
+    """
+    for column, values in columns.items():
+        values.append(row.get(column))
 
 
-def _test_execute_query(
-    con: duckdb.DuckDBPyConnection,
-    query: str,
+def _test_result(
     query_name: str,
-    materialization: list[str]
+    materialization: list[str],
+    execution_times: list[float],
+    planning_time: float | None
 ):
-    '''Execute the query 5 times and calculate average time of last 4 runs'''
+    '''Record the execution times and calculate average time of all runs but the first'''
 
     row = {
         "Query": query_name,
         "Materialization": materialization
     }
 
-    execution_times = []
-
-    iterations = 5
+    row.update(timing_summary(execution_times=execution_times))
+    row["Planning time"] = planning_time
 
-    for i in range(iterations):
-        start_time = time.perf_counter()
-        con.execute(query)
-        end_time = time.perf_counter()
-        execution_time = end_time - start_time
-        execution_times.append(execution_time)
-        row[f"Iteration {i}"] = execution_time
-
-    # Calculate the average time of the last 4 runs and store it
+    # Calculate the average time of the runs after the first and store it, under the
+    # name it had when there were 5 runs
     # avg_time = -1
-    avg_time = sum(execution_times[1:]) / (iterations - 1)
+    avg_time = sum(execution_times[1:]) / (len(execution_times) - 1)
     row['Average (last 4 runs)'] = avg_time
 
     return row
@@ -209,27 +209,65 @@ def main():
 
     sorted_column_map = OrderedDict(sorted_items)
 
+    # Field usage of each query, computed once for every load and test
+    usage = get_usage_matrix(dataset=DATASET)
+    # Fields any query uses, in column map order
+    used_fields = usage.used.any(axis=0)
+
     # Create fresh db
     _create_fresh_db()
 
     # Create empty result columns
     result_df_columns = [
-        "Query", "Last Materialization", "Load", "Test", "Materialization", "Iteration 0", "Iteration 1", "Iteration 2", "Iteration 3", "Iteration 4", "Average (last 4 runs)"
+        "Query", "Last Materialization", "Load", "Test", "Materialization", "Iteration 0", "Iteration 1", "Iteration 2", "Iteration 3", "Iteration 4", "Average (last 4 runs)", "Planning time",
+        "Iterations", "Execution times", "Median", "Median CI low", "Median CI high"
     ]
     loads_df_columns = [
         "Load", "Test", "Total Query Time", "Majority Queries", "Materialization", "Strategy"
     ]
 
-    results_df = pd.DataFrame(columns=result_df_columns)
-    loads_df = pd.DataFrame(columns=loads_df_columns)
+    # Rows of the results, by column, turned into DataFrames once written
+    result_columns: dict[str, list] = {
+        column: [] for column in result_df_columns}
+    load_columns: dict[str, list] = {
+        column: [] for column in loads_df_columns}
+    overhead_rows = []
+
+    # First result of each query under each materialization, and the materialization
+    # of each test of each load
+    stored_results: dict[tuple[str, frozenset[str]], dict] = {}
+    test_materializations: dict[tuple[int, str], set[str]] = {}
 
     db_connection, db_path = _create_connection()
 
+    # Calibrate the extraction costs on the unmaterialized db
+    column_costs = None
+    if USE_COST_BASED_ADVISOR or USE_KNAPSACK_SELECTOR:
+        column_costs = advisor.calibrate(
+            con=db_connection, column_map=column_map)
+        column_costs.to_csv(result_dir + "/column_costs.csv")
+
+    # Write costs of the knapsack selector, as written by `perform_write_test.py`
+    write_times = None
+    write_times_path = BASE_PATH + \
+        f"/results/load-based/{DATASET}/write_times.csv"
+    if USE_KNAPSACK_SELECTOR and os.path.exists(write_times_path):
+        write_times = pd.read_csv(write_times_path)
+
     # for distribution in distributions:
 
     load_setups = _generate_loads(
         distribution=WORKLOAD_DISTRIBUTION, queries=queries)
 
+    measurement_cache = None
+    if USE_MEASUREMENT_CACHE:
+        measurement_cache = MeasurementCache(
+            max_age=MEASUREMENT_MAX_AGE, force=FORCE_MEASUREMENT)
+
+    # Results of executed queries, by query and the materialized fields it uses.
+    # Setups with the same relevant materialization run a byte-identical query text
+    executed_results: dict[tuple[str, frozenset[str]], dict] = {}
+
     for load_setup in load_setups:
 
         loads = load_setup["loads"]
@@ -239,6 +277,9 @@ def main():
 
         for load_no, load in enumerate(loads):
             load_test_time = time.time()
+            load_counts = usage.load_counts(load=load)
+            # Time spent preparing the db and executing queries, rather than in the harness
+            measured_time = 0.0
 
             # Copy the standard tests (zero materializations etc.)
             tests: dict = copy.deepcopy(standard_tests)
@@ -253,12 +294,31 @@ def main():
             for len_materialization in m_sizes:
                 tests[f"load_based_m{len_materialization}"] = {
                     'len_materialization': len_materialization}
+                if USE_COST_BASED_ADVISOR:
+                    tests[f"cost_based_c{len_materialization}"] = {
+                        'len_materialization': len_materialization}
                 if PHASE_3_ITERATION > 1:
                     tests[f"schema_based_s{len_materialization}"] = {
                         'len_materialization': len_materialization}
                     tests[f"frequency_based_f{len_materialization}"] = {
                         'len_materialization': len_materialization}
 
+            # Select the knapsack materializations up front, as they do not build on
+            # the previous materialization
+            if USE_KNAPSACK_SELECTOR:
+                full_storage = column_costs["Storage"].sum()
+                for budget in KNAPSACK_BUDGETS:
+                    tests[f"knapsack_b{budget}"] = {
+                        "materialization": selector.select_fields(
+                            costs=column_costs,
+                            queries=queries,
+                            load=load,
+                            budget=full_storage * budget / 100,
+                            write_times=write_times,
+                            write_weight=WRITE_WEIGHT,
+                        )
+                    }
+
             # Loop through the tests
             prev_materialization = set()
             for test_name, test_setup in tests.items():
@@ -271,6 +331,8 @@ def main():
                     test_type = 'frequency_based_f'
                 if 'schema_based_s' in test_name:
                     test_type = 'schema_based_s'
+                if 'cost_based_c' in test_name:
+                    test_type = 'cost_based_c'
 
                 if test_type is not None:
                     len_materialization = test_setup.get(
@@ -281,53 +343,46 @@ def main():
                     no_fields_to_materialize = 1
 
                     if len_materialization == 1:
-                        prev_df = results_df[(
-                            results_df["Load"] == load_no) & (results_df["Test"] == 'no_materialization')]
+                        prev_test = 'no_materialization'
                     # Will only happen for TPC-H
                     elif len_materialization >= 20:
                         no_fields_to_materialize = 5
-                        prev_df = results_df[(
-                            results_df["Load"] == load_no) & (results_df["Test"] == f'{test_type}{len_materialization-5}')]
+                        prev_test = f'{test_type}{len_materialization-5}'
 
                     else:
-                        prev_df = results_df[(
-                            results_df["Load"] == load_no) & (results_df["Test"] == f'{test_type}{len_materialization-1}')]
+                        prev_test = f'{test_type}{len_materialization-1}'
 
-                    prev_materialization = prev_df['Materialization'].iloc[0]
-                    prev_time = prev_df['Materialization'].iloc[0]
-
-                    field_weights = defaultdict(int)
+                    prev_materialization = test_materializations[(
+                        load_no, prev_test)]
 
                     if test_type == 'schema_based_s':
                         weighted_load_test_fields = list(
                             sorted_column_map.keys())
 
+                    elif test_type == 'cost_based_c':
+                        weighted_load_test_fields = advisor.rank_fields(
+                            costs=column_costs,
+                            queries=queries,
+                            load=load,
+                            exclude=prev_materialization
+                        )
+
                     else:
                         only_freq = not USE_WEIGHTS_IN_DECISION
                         if test_type == 'frequency_based_f':
                             only_freq = True
 
-                        for query_name, query_obj in queries.items():
-                            query_frequency = load.count(query_name)
-                            _field_weights = query_obj.get_column_weights(
-                                only_freq=only_freq,
-                                prev_materialization=prev_materialization,
-                                iteration=PHASE_3_ITERATION
-                            )
-                            for field, weight in _field_weights.items():
-                                field_weights[field] += weight * \
-                                    query_frequency
-
-                        # Remove prev materializations from field weights
-                        load_test_field_weights = {key: val for key, val in field_weights.items(
-                        ) if key not in prev_materialization}
-
-                        # Sort fields by total weight
-                        load_test_field_weights = dict(
-                            sorted(load_test_field_weights.items(), key=lambda item: item[1], reverse=True))
+                        field_weights = usage.field_weights(
+                            load_counts=load_counts,
+                            prev_materialization=prev_materialization,
+                            iteration=PHASE_3_ITERATION,
+                            only_freq=only_freq
+                        )
 
-                        weighted_load_test_fields = list(
-                            load_test_field_weights.keys())
+                        # Sort the used fields by total weight, without the prev materializations
+                        weighted_load_test_fields = [
+                            usage.field_names[i] for i in np.argsort(-field_weights, kind="stable")
+                            if used_fields[i] and usage.field_names[i] not in prev_materialization]
 
                     fields_to_materialize = list(prev_materialization) + \
                         weighted_load_test_fields[:no_fields_to_materialize]
@@ -349,49 +404,80 @@ def main():
                 for field, access_query in sorted_column_map.items():
                     fields.append(
                         (field, access_query, field in fields_to_materialize))
+                # Index the fields once, for all queries of this test
+                field_spec = FieldSpec(fields)
 
                 prepared_db = False
 
                 # Loop through each query
                 for query_name, query_obj in queries.items():
                     result = None
-                    query_affected = last_materialization in query_obj.columns_used(
-                    ) or test_name in standard_tests or len(fields_to_materialize) >= 15
+                    # Tests without a last materialization do not build on the previous one
+                    query_affected = usage.uses(query_name=query_name, field=last_materialization
+                                                ) or test_name in standard_tests or last_materialization is None or len(fields_to_materialize) >= 15
 
                     # Check if test results exists already
-                    filtered_result = results_df[(
-                        results_df["Query"] == query_name) & (results_df["Materialization"].apply(lambda s: s == fields_to_materialize))]
+                    result_key = (query_name, frozenset(fields_to_materialize))
 
                     # If we have a result, use it
-                    if len(filtered_result) > 0:
-                        result = filtered_result.iloc[0].copy()
+                    if result_key in stored_results:
+                        result = dict(stored_results[result_key])
                     else:
                         # If query was not affected by materialization, use result from prev materialization
                         if not query_affected:
-                            result = results_df[(
-                                results_df["Query"] == query_name) & (results_df["Materialization"] == prev_materialization)].iloc[0]
+                            result = dict(stored_results[(
+                                query_name, frozenset(prev_materialization))])
                         else:
-
-                            # Prepare database, if not already done
-                            if not prepared_db:
-                                prepare_database(
-                                    con=db_connection, fields=fields)
-                                prepared_db = True
-                            # Perform test
-                            query = query_obj.get_query(fields=fields)
-                            result = _test_execute_query(
-                                con=db_connection,
-                                query=query,
-                                query_name=query_name,
-                                materialization=fields_to_materialize
-                            )
-                            print(
-                                f"Executed {query_name}, load {load_no}, test {test_name} in time {result['Average (last 4 runs)']}")
-
-                    # Update results_df
-                    if isinstance(result, dict):
-                        result = pd.Series(
-                            data=result, index=results_df.columns)
+                            executed_key = (
+                                query_name, query_obj.relevant_materialization(fields=field_spec))
+
+                            # If the same query text has run, use its result
+                            if executed_key in executed_results:
+                                result = dict(executed_results[executed_key])
+                            else:
+                                query = query_obj.get_query(fields=field_spec)
+                                measurement_key = {
+                                    "dataset": DATASET,
+                                    "scale_factor": BACKUP_SIZE,
+                                    "query": query,
+                                    "materialization": fields_to_materialize,
+                                    "mode": EXECUTION_MODE,
+                                    "setup": measurement_setup(in_memory=IN_MEMORY),
+                                }
+
+                                # If an earlier run measured the query, use its measurement
+                                measurement = None
+                                if measurement_cache is not None:
+                                    measurement = measurement_cache.get(
+                                        iterations=ITERATIONS, **measurement_key)
+
+                                if measurement is None:
+                                    measure_start = time.perf_counter()
+                                    # Prepare database, if not already done
+                                    if not prepared_db:
+                                        # Without background copies competing for I/O
+                                        with paused():
+                                            prepare_database(
+                                                con=db_connection, fields=fields)
+                                        prepared_db = True
+                                    # Perform test
+                                    execution_times, planning_time, _ = time_query(
+                                        con=db_connection, query=query, iterations=ITERATIONS, mode=EXECUTION_MODE)
+                                    measured_time += time.perf_counter() - measure_start
+                                    measurement = (execution_times, planning_time)
+                                    if measurement_cache is not None:
+                                        measurement_cache.put(
+                                            execution_times=execution_times, planning_time=planning_time, iterations=ITERATIONS, **measurement_key)
+
+                                result = _test_result(
+                                    query_name=query_name,
+                                    materialization=fields_to_materialize,
+                                    execution_times=measurement[0],
+                                    planning_time=measurement[1]
+                                )
+                                executed_results[executed_key] = dict(result)
+                                print(
+                                    f"Executed {query_name}, load {load_no}, test {test_name} in time {result['Average (last 4 runs)']}")
 
                     # Add load and test_name
                     result["Load"] = load_no
@@ -401,48 +487,62 @@ def main():
                     # Update with the fields materialized
                     result["Materialization"] = fields_to_materialize
 
-                    # Convert result to a one-row df
-                    result = pd.DataFrame(
-                        data=[result], columns=result_df_columns)
-
-                    results_df = pd.concat(
-                        [results_df, result], ignore_index=True)
+                    _append_row(columns=result_columns, row=result)
+                    stored_results.setdefault(result_key, result)
 
-                    query_execution_time = result["Average (last 4 runs)"].iloc[0]
+                    query_execution_time = result["Average (last 4 runs)"]
                     load_test_execution_time += query_execution_time * \
-                        load.count(query_name)
+                        load_counts[usage.query_index[query_name]]
 
                 # Update how long time the load "took"
-                _load_df = pd.DataFrame(data={
-                    "Load": [load_no],
-                    "Test": [test_name],
-                    "Total Query Time": [load_test_execution_time],
-                    "Majority Queries": [majority_queries[load_no]],
-                    "Materialization": [fields_to_materialize],
-                    "Strategy": ["Frequency"]
-                }, columns=loads_df_columns)
-
-                loads_df = pd.concat(
-                    [loads_df, _load_df], ignore_index=True)
+                load_row = {
+                    "Load": load_no,
+                    "Test": test_name,
+                    "Total Query Time": load_test_execution_time,
+                    "Majority Queries": majority_queries[load_no],
+                    "Materialization": fields_to_materialize,
+                    "Strategy": "Frequency"
+                }
+                _append_row(columns=load_columns, row=load_row)
+                test_materializations.setdefault(
+                    (load_no, test_name), fields_to_materialize)
 
                 # Set last materialization
                 if test_name not in standard_tests:
                     prev_materialization = fields_to_materialize
 
-                _load_df.to_csv(result_dir + f"/load_{load_no}_results.csv")
+            pd.DataFrame(data=[load_row], columns=loads_df_columns).to_csv(
+                result_dir + f"/load_{load_no}_results.csv")
 
+            load_time = time.time() - load_test_time
+            overhead_rows.append({
+                "Load": load_no,
+                "Total time": load_time,
+                "Measured time": measured_time,
+                "Harness overhead": load_time - measured_time,
+            })
             print(
-                f"Time taken for load {load_no}: {time.time() - load_test_time}")
+                f"Time taken for load {load_no}: {load_time}, of which harness overhead {load_time - measured_time:.2f}s")
 
     # Write results to csv
-    results_df.to_csv(result_dir + "/results.csv")
-    loads_df.to_csv(result_dir + "/all_loads_results.csv")
+    pd.DataFrame(data=result_columns).to_csv(result_dir + "/results.csv")
+    pd.DataFrame(data=load_columns).to_csv(
+        result_dir + "/all_loads_results.csv")
+    pd.DataFrame(overhead_rows).to_csv(
+        result_dir + "/harness_overhead.csv", index=False)
+
+    if measurement_cache is not None:
+        measurement_cache.flush()
+        print(
+            f"Measurement cache: {measurement_cache.hits} measurements reused, {measurement_cache.misses} measured")
 
 
 if __name__ == "__main__":
     t = time.perf_counter()
 
     main()
+    print_setup_report()
+    print_repetition_report()
 
     print(
         f"Total time for load tests: {time.perf_counter() - t}")
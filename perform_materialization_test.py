@@ -0,0 +1,214 @@
+# pylint: disable=E0401
+import os
+import threading
+import time
+from datetime import datetime
+
+import duckdb  # type: ignore
+import pandas as pd
+
+import testing.tpch.setup as tpch_setup
+from utils.prepare_database import prepare_database, get_db_size, DEFAULT_CHUNK_SIZE, ALTER_UPDATE, CTAS_SWAP
+from utils.snapshot import create_connection, paused, print_setup_report
+
+
+TEST_TIME_STRING = f"{datetime.now().date()}-{datetime.now().hour}H"
+
+DATASETS = {
+    "tpch": {
+        "tests_map": tpch_setup.STANDARD_SETUPS,
+        "column_map": tpch_setup.COLUMN_MAP,
+        "db_backups": [
+            {
+                "scale_factor": 2,
+                "dir": "tpch_bigger"
+            },
+            {
+                "scale_factor": 4,
+                "dir": "tpch_bigbigger"
+            }
+        ]
+    }
+}
+
+# Materialization strategies to compare. A chunk size of None is the one-shot UPDATE
+MATERIALIZATION_MODES = [
+    {"strategy": ALTER_UPDATE, "chunk_size": None},
+    {"strategy": ALTER_UPDATE, "chunk_size": DEFAULT_CHUNK_SIZE},
+    {"strategy": ALTER_UPDATE, "chunk_size": 4 * DEFAULT_CHUNK_SIZE},
+    {"strategy": ALTER_UPDATE, "chunk_size": 16 * DEFAULT_CHUNK_SIZE},
+    {"strategy": CTAS_SWAP, "chunk_size": None},
+]
+
+# Interval between samples of memory usage, in seconds
+MEMORY_SAMPLE_INTERVAL = 0.05
+
+CLEAN_UP_FILES = set()
+
+
+def _prepare_dirs(dataset: str) -> str:
+    result_dir = f"./results/materialization/{dataset}/{TEST_TIME_STRING}"
+    os.makedirs(result_dir, exist_ok=True)
+    return result_dir
+
+
+class _MemorySampler:
+    """
+    Sample the resident memory of this process in a background thread, and keep the peak
+
+    Reads `/proc/self/statm`, so the peak is only available on Linux.
+    Sampling through `duckdb_memory()` is avoided, as its transactions block CHECKPOINT.
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self.peak = None
+
+    def _sample(self):
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        while not self._stop.is_set():
+            try:
+                with open("/proc/self/statm", "r") as statm:
+                    rss = int(statm.read().split()[1]) * page_size
+            except (FileNotFoundError, OSError):
+                return
+            self.peak = max(self.peak or 0, rss)
+            self._stop.wait(MEMORY_SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def _create_fresh_db(db_dir: str):
+    db_path = f"./data/db/{db_dir}.duckdb"
+    backup_path = f"./data/backup/{db_dir}"
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+        print(f"Removed db at path {db_path}")
+
+    with duckdb.connect(db_path) as con:
+        con.execute("SET default_block_size = '16384'")
+        con.execute(f"IMPORT DATABASE '{backup_path}';")
+
+    CLEAN_UP_FILES.add(db_path)
+
+
+def _create_connection(db_dir: str) -> tuple[duckdb.DuckDBPyConnection, str]:
+    original_db_path = f"./data/db/{db_dir}.duckdb"
+    copy_db_path = f"./data/db/{db_dir}_materialization.db"
+
+    CLEAN_UP_FILES.add(copy_db_path)
+
+    return create_connection(
+        original_db_path=original_db_path, copy_db_path=copy_db_path, block_size=16384)
+
+
+def _clean_up():
+    for file in list(CLEAN_UP_FILES):
+        try:
+            os.remove(file)
+            print(f"Deleted file {file}")
+        except FileNotFoundError:
+            print(f"No file at path {file}")
+
+
+def _perform_test(
+        db_dir: str,
+        fields: list[tuple[str, dict, bool]],
+        strategy: str,
+        chunk_size: int | None
+) -> dict:
+    '''Materialize the fields on a fresh copy of the db, and measure time, memory and size'''
+
+    con, _ = _create_connection(db_dir=db_dir)
+
+    start_time = time.perf_counter()
+    with paused(), _MemorySampler() as sampler:
+        time_taken = prepare_database(
+            con=con,
+            fields=fields,
+            include_print=False,
+            chunk_size=chunk_size,
+            strategy=strategy
+        )
+    wall_time = time.perf_counter() - start_time
+
+    _, _, db_size = get_db_size(con=con)
+    con.close()
+
+    return {
+        "Materialization time": time_taken,
+        "Wall time": wall_time,
+        "Peak memory": sampler.peak,
+        "Database size": db_size,
+    }
+
+
+def main():
+    dataset = "tpch"
+
+    result_dir = _prepare_dirs(dataset=dataset)
+
+    config = DATASETS[dataset]
+    tests_map: dict = config["tests_map"]
+    column_map: dict = config["column_map"]
+
+    rows = []
+
+    for db in config["db_backups"]:
+        scale_factor = db["scale_factor"]
+        db_dir = db["dir"]
+        _create_fresh_db(db_dir=db_dir)
+
+        for test, test_config in tests_map.items():
+            materialize_columns = test_config["materialization"]
+            if materialize_columns is None:
+                materialize_columns = column_map.keys()
+
+            # Nothing to backfill
+            if len(materialize_columns) == 0:
+                continue
+
+            fields = []
+            for field, access_query in column_map.items():
+                fields.append(
+                    (field, access_query, field in materialize_columns))
+
+            for mode in MATERIALIZATION_MODES:
+                strategy = mode["strategy"]
+                chunk_size = mode["chunk_size"]
+                result = _perform_test(
+                    db_dir=db_dir,
+                    fields=fields,
+                    strategy=strategy,
+                    chunk_size=chunk_size
+                )
+
+                rows.append({
+                    "Scale factor": scale_factor,
+                    "Test": test,
+                    "Strategy": strategy,
+                    "Chunk size": chunk_size if chunk_size is not None else "one-shot",
+                    **result
+                })
+                print(
+                    f"[sf {scale_factor}, {test}, {strategy}, chunk size {chunk_size}] {result['Materialization time']:.2f}s, {result['Database size']} bytes, peak memory {result['Peak memory']} bytes")
+
+        # Write intermediate results
+        pd.DataFrame(rows).to_csv(result_dir + "/results.csv", index=False)
+
+
+if __name__ == "__main__":
+    t = time.perf_counter()
+    main()
+    print_setup_report()
+    _clean_up()
+
+    print(f"Finished test in time ~{int(time.perf_counter() - t)/60} minutes")
@@ -0,0 +1,205 @@
+# pylint: disable=E0401
+import argparse
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+
+import utils.advisor as advisor
+import utils.generate_load as generate_load
+from perform_test import DATASETS
+from queries.field_spec import FieldSpec
+from utils.online_materializer import OnlineMaterializer, ACTION_COLUMNS
+from utils.prepare_database import prepare_database
+from utils.query_timing import time_query, timing_summary, print_repetition_report, check_iterations, ITERATIONS, ADAPTIVE_ITERATIONS
+from utils.snapshot import create_dataset_db, create_dataset_connection, paused, remove_database
+
+
+TEST_TIME_STRING = f"{datetime.now().date()}-{datetime.now().hour}H"
+
+# Strategies
+# Never materialize
+NO_MATERIALIZATION = "none"
+# Materialize the `OFFLINE_FIELDS` fields ranked highest by the advisor on the whole
+# load, before replaying it
+OFFLINE = "offline"
+# Adapt the materialization to the replayed queries with `OnlineMaterializer`
+ONLINE = "online"
+STRATEGIES = [NO_MATERIALIZATION, OFFLINE, ONLINE]
+
+OFFLINE_FIELDS = 10
+
+
+def _replay_load(
+        dataset: str,
+        load: list[str],
+        strategy: str,
+        costs: pd.DataFrame,
+        background: bool,
+        iterations: int = ITERATIONS,
+) -> tuple[list[dict], float, list[dict]]:
+    """
+    Execute the queries of the load in order, on a fresh copy of the database. Each
+    query is timed `iterations` times, the same way in every strategy, and its execution
+    time is the average of the executions after the warm-up
+
+    Returns
+    -------
+    tuple[list[dict], float, list[dict]]
+        A row per executed query, the time spent materializing, and the actions of the
+        online materializer
+    """
+    config = DATASETS[dataset]
+    queries = config["queries"]
+    column_map = config["column_map"]
+
+    con, db_path = create_dataset_connection(dataset=dataset)
+
+    materializer = None
+    materialization_time = 0.0
+    field_spec = FieldSpec([(field, access_query, False)
+                           for field, access_query in column_map.items()])
+
+    if strategy == OFFLINE:
+        materialized = set(advisor.rank_fields(
+            costs=costs, queries=queries, load=load)[:OFFLINE_FIELDS])
+        fields = [(field, access_query, field in materialized)
+                  for field, access_query in column_map.items()]
+        # Without background copies competing for I/O
+        with paused():
+            start_time = time.perf_counter()
+            prepare_database(con=con, fields=fields, include_print=False)
+            materialization_time = time.perf_counter() - start_time
+        field_spec = FieldSpec(fields)
+    elif strategy == ONLINE:
+        materializer = OnlineMaterializer(
+            con=con,
+            queries=queries,
+            column_map=column_map,
+            costs=costs,
+            background=background,
+        )
+
+    rows = []
+    for query_no, query_name in enumerate(load):
+        if materializer is not None:
+            with materializer.lock:
+                query = queries[query_name].get_query(
+                    fields=materializer.field_spec)
+                # The materialization does not change between the executions
+                execution_times, _, _ = time_query(
+                    con=con, query=query, iterations=iterations)
+                no_materialized = len(materializer.materialized)
+        else:
+            query = queries[query_name].get_query(fields=field_spec)
+            execution_times, _, _ = time_query(
+                con=con, query=query, iterations=iterations)
+            no_materialized = len(field_spec.materialized())
+
+        execution_time = sum(execution_times[1:]) / (len(execution_times) - 1)
+        if materializer is not None:
+            materializer.observe(query_name=query_name, runtime=execution_time)
+
+        rows.append({
+            "Query no": query_no,
+            "Query": query_name,
+            "Execution time": execution_time,
+            "Materialized fields": no_materialized,
+            **timing_summary(execution_times=execution_times),
+        })
+
+    actions = []
+    if materializer is not None:
+        materializer.wait()
+        actions = materializer.actions
+        materialization_time = materializer.time_taken
+
+    con.close()
+    remove_database(db_path)
+
+    return rows, materialization_time, actions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay loads whose majority queries shift halfway through, with and without online materialization.")
+    parser.add_argument("dataset", nargs="?", default="tpch", choices=list(DATASETS.keys()),
+                        help="The dataset to run tests on")
+    parser.add_argument("--strategies", nargs="+", default=STRATEGIES, choices=STRATEGIES,
+                        help="The strategies to compare")
+    parser.add_argument("--loads", type=int, default=None,
+                        help="Only replay the first LOADS loads")
+    parser.add_argument("--background", action="store_true",
+                        help="Materialize in a background thread in the online strategy")
+    parser.add_argument("--iterations", type=int, default=ITERATIONS,
+                        help=f"Execute each query ITERATIONS times. {ADAPTIVE_ITERATIONS} repeats each query until the confidence interval of its median is narrow enough")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="Import the backup into an in-memory database, and copy it in memory for each replay, rather than copying database files")
+    args = parser.parse_args()
+    try:
+        check_iterations(iterations=args.iterations)
+    except ValueError as e:
+        parser.error(str(e))
+
+    dataset = args.dataset
+    config = DATASETS[dataset]
+
+    result_dir = f"./results/online/{dataset}/{TEST_TIME_STRING}"
+    os.makedirs(result_dir, exist_ok=True)
+
+    create_dataset_db(dataset=dataset, in_memory=args.in_memory)
+
+    # Calibrate the extraction costs once, on an unmaterialized copy
+    con, db_path = create_dataset_connection(dataset=dataset)
+    costs = advisor.calibrate(con=con, column_map=config["column_map"])
+    con.close()
+    remove_database(db_path)
+    costs.to_csv(result_dir + "/column_costs.csv")
+
+    load_dicts = generate_load.shifting_distribution(
+        queries=config["queries"])
+
+    query_rows = []
+    load_rows = []
+    action_rows = []
+    for load_dict in load_dicts:
+        for load_no, load in enumerate(load_dict["loads"][:args.loads]):
+            for strategy in args.strategies:
+                rows, materialization_time, actions = _replay_load(
+                    dataset=dataset,
+                    load=load,
+                    strategy=strategy,
+                    costs=costs,
+                    background=args.background,
+                    iterations=args.iterations,
+                )
+                query_rows.extend(
+                    {"Load": load_no, "Strategy": strategy, **row} for row in rows)
+                action_rows.extend(
+                    {"Load": load_no, **action} for action in actions)
+
+                execution_time = sum(row["Execution time"] for row in rows)
+                load_rows.append({
+                    "Load": load_no,
+                    "Strategy": strategy,
+                    "Majority Queries": load_dict["majority_queries"][load_no],
+                    "Total Query Time": execution_time,
+                    "Materialization Time": materialization_time,
+                    "Total Time": execution_time + materialization_time,
+                })
+                print(
+                    f"Load {load_no}, {strategy}: queries {execution_time:.2f}s, materialization {materialization_time:.2f}s, {len(actions)} actions")
+
+    pd.DataFrame(query_rows).to_csv(result_dir + "/results.csv", index=False)
+    pd.DataFrame(load_rows).to_csv(
+        result_dir + "/all_loads_results.csv", index=False)
+    pd.DataFrame(action_rows, columns=["Load"] + ACTION_COLUMNS).to_csv(
+        result_dir + "/actions.csv", index=False)
+
+
+if __name__ == "__main__":
+    t = time.perf_counter()
+    main()
+    print_repetition_report()
+    print(f"Finished test in time ~{int(time.perf_counter() - t)/60} minutes")
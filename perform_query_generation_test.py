@@ -0,0 +1,161 @@
+# pylint: disable=E0401
+import argparse
+import os
+import time
+from datetime import datetime
+from itertools import islice
+
+import pandas as pd
+
+import queries.query as query_module
+import testing.tpch.setup as tpch_setup
+import testing.twitter.setup as twitter_setup
+from perform_test_v2 import _gen_combinations
+from queries.field_spec import Field, FieldSpec
+from queries.query import Query
+
+
+TEST_TIME_STRING = f"{datetime.now().date()}-{datetime.now().hour}H"
+
+DATASETS = {
+    "tpch": {
+        "queries": tpch_setup.QUERIES,
+        "column_map": tpch_setup.COLUMN_MAP,
+    },
+    "twitter": {
+        "queries": twitter_setup.QUERIES,
+        "column_map": twitter_setup.COLUMN_MAP,
+    }
+}
+
+# How the fields are passed to `get_query`
+# The lookups before `FieldSpec`: a linear scan of the field tuples for the type, the
+# access and the document type of each extracted field, see `_ScanFieldSpec`
+SCAN_MODE = "scan"
+# A list of field tuples, converted for every query
+LIST_MODE = "list"
+# A field spec, built once per materialization and shared by all queries
+SPEC_MODE = "spec"
+MODES = [SCAN_MODE, LIST_MODE, SPEC_MODE]
+
+
+class _ScanFieldSpec(FieldSpec):
+    """
+    A field spec looking up each field as `Query._json` did before `FieldSpec`, with a
+    linear scan of the field tuples for each of its type, access and document type.
+    The lookups of the query text cache key use the index, as the cache did not exist
+    """
+
+    __slots__ = ("_field_list",)
+
+    def __init__(self, fields: list[tuple[str, dict, bool]]):
+        super().__init__(fields)
+        self._field_list = fields
+
+    def __getitem__(self, field: str) -> Field:
+        data_type = self._scan(field=field, key="type")
+        access = self._scan(field=field, key="access")
+        doc_type = self._scan(field=field, key="doc_type")
+        materialized = next(materialized for col, _, materialized in self._field_list
+                            if col == field)
+        return Field(access=access, type=data_type, materialized=materialized, doc_type=doc_type)
+
+    def get(self, field: str, default=None) -> Field | None:
+        return self._fields.get(field, default)
+
+    def _scan(self, field: str, key: str):
+        for col, access_query, _ in self._field_list:
+            if col == field:
+                return access_query.get(key)
+        raise KeyError(field)
+
+
+def _clear_query_caches(queries: dict[str, Query]):
+    """
+    Clear the query texts cached by each query, so a mode does not reuse the texts
+    generated by another
+    """
+    for query_obj in queries.values():
+        query_obj._query_cache.clear()
+
+
+def _generate_sweep(queries: dict[str, Query], column_map: dict, mode: str, limit: int | None) -> tuple[float, int, int]:
+    """
+    Generate every query for every materialization of the phase-2 sweep, from empty query
+    text caches
+
+    Returns
+    -------
+    tuple[float, int, int]
+        The time taken, the number of materializations, and the number of queries generated
+    """
+    column_list = list(column_map.keys())
+    _clear_query_caches(queries=queries)
+
+    no_materializations = 0
+    no_queries = 0
+    start_time = time.perf_counter()
+    for materialize_columns in islice(_gen_combinations(column_list), limit):
+        fields = [(field, access_query, field in materialize_columns)
+                  for field, access_query in column_map.items()]
+        if mode == SPEC_MODE:
+            fields = FieldSpec(fields)
+        elif mode == SCAN_MODE:
+            fields = _ScanFieldSpec(fields)
+
+        for query_obj in queries.values():
+            query_obj.get_query(fields=fields)
+            no_queries += 1
+        no_materializations += 1
+
+    return time.perf_counter() - start_time, no_materializations, no_queries
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the time taken to generate the queries of a phase-2 sweep.")
+    parser.add_argument("dataset", nargs="?", default="tpch", choices=list(DATASETS.keys()),
+                        help="The dataset whose queries are generated")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="Only generate the queries of the first LIMIT materializations")
+    parser.add_argument("--text-cache", action="store_true",
+                        help="Keep the query text cache enabled. It is cleared before each mode either way")
+    args = parser.parse_args()
+
+    config = DATASETS[args.dataset]
+    if not args.text_cache:
+        # Measure the generation of every text, not the lookups of cached texts
+        query_module.QUERY_CACHE_SIZE = 0
+
+    result_dir = f"./results/query-generation/{args.dataset}/{TEST_TIME_STRING}"
+    os.makedirs(result_dir, exist_ok=True)
+
+    rows = []
+    for mode in MODES:
+        time_taken, no_materializations, no_queries = _generate_sweep(
+            queries=config["queries"],
+            column_map=config["column_map"],
+            mode=mode,
+            limit=args.limit,
+        )
+        rows.append({
+            "Mode": mode,
+            "Text cache": args.text_cache,
+            "Materializations": no_materializations,
+            "Queries": no_queries,
+            "Time taken": time_taken,
+            "Time per query": time_taken / no_queries,
+        })
+        print(
+            f"[{mode}] Generated {no_queries} queries for {no_materializations} materializations in {time_taken:.2f}s ({time_taken / no_queries * 1e6:.1f} us/query)")
+
+    scan_time = rows[0]["Time taken"]
+    for row in rows[1:]:
+        print(
+            f"[{row['Mode']}] Speedup over {SCAN_MODE}: {scan_time / row['Time taken']:.2f}x")
+
+    pd.DataFrame(rows).to_csv(result_dir + "/results.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,6 @@
 # pylint: disable=E0401
 import argparse
-import shutil
 import time
-import tracemalloc
 import os
 from datetime import datetime
 
@@ -12,9 +10,12 @@ import pandas as pd
 import testing.tpch.setup as tpch_setup
 import testing.twitter.setup as twitter_setup
 
+from queries.field_spec import FieldSpec
 from queries.query import Query
 # from queries.twitter_queries import
-from utils.prepare_database import prepare_database, get_db_size
+from utils.prepare_database import prepare_database, get_db_size, STRATEGIES, ALTER_UPDATE
+from utils.query_timing import time_query, timing_summary, print_repetition_report, check_iterations, ITERATIONS, ADAPTIVE_ITERATIONS, EXECUTION_MODES, DIRECT_EXECUTION
+from utils.snapshot import create_dataset_db, create_dataset_connection, paused, remove_database, print_setup_report
 
 if not os.path.isdir("./results"):
     os.mkdir("./results")
@@ -47,6 +48,12 @@ DF_COL_NAMES = [
     'Iteration 2',
     'Iteration 3',
     'Iteration 4',
+    'Planning time',
+    'Iterations',
+    'Execution times',
+    'Median',
+    'Median CI low',
+    'Median CI high',
     'Created At',
     'Test run no.',
 ]
@@ -76,15 +83,20 @@ def _perform_test(
         fields: list[tuple[str, dict, bool]],
         run_no: int,
         test_time: datetime,
+        partitioned: bool = False,
+        execution_mode: str = DIRECT_EXECUTION,
+        iterations: int = ITERATIONS,
 ) -> tuple[pd.DataFrame, list]:
     '''Perform the tests and collect results from the first execution'''
-    # Execute each query 5 times and calculate average time of last 4 runs
+    # Execute each query and calculate average time of all runs but the first
     results_df = pd.DataFrame(columns=DF_COL_NAMES)
     query_results = []  # List to store results from the first execution
+    # Index the fields once, for all queries of this test
+    field_spec = FieldSpec(fields)
 
     for query_name, query_obj in queries.items():
 
-        query = query_obj.get_query(fields=fields)
+        query = query_obj.get_query(fields=field_spec, partitioned=partitioned)
 
         df_row = {
             "Query": query_name,
@@ -92,29 +104,18 @@ def _perform_test(
             "Test run no.": run_no,
         }
 
-        execution_times = []
-        first_run_result = None
-
-        iterations = 5
-
-        for j in range(iterations):  # Execute the query 5 times
-            tracemalloc.start()
-            start_time = time.perf_counter()
-            # Execute the query and fetch result
-            result = con.execute(query).fetchdf()
-            end_time = time.perf_counter()
-            execution_time = end_time - start_time
-            execution_times.append(execution_time)
-            df_row[f"Iteration {j}"] = execution_time
-
-            if j == 0:
-                first_run_result = result.copy()
+        # Execute the query and fetch results
+        execution_times, planning_time, first_run_result = time_query(
+            con=con, query=query, iterations=iterations, mode=execution_mode, fetch=True)
+        df_row.update(timing_summary(execution_times=execution_times))
+        df_row["Planning time"] = planning_time
 
         # Collect the result from the first run
         query_results.append(first_run_result)
 
-        # Calculate the average time of the last 4 runs and store it
-        avg_time = sum(execution_times[1:]) / (iterations - 1)
+        # Calculate the average time of the runs after the first and store it, under
+        # the name it had when there were 5 runs
+        avg_time = sum(execution_times[1:]) / (len(execution_times) - 1)
         df_row['Avg (last 4 runs)'] = avg_time
 
         temp_df = pd.DataFrame([df_row])
@@ -124,7 +125,7 @@ def _perform_test(
         else:
             results_df = pd.concat([results_df, temp_df],
                                    ignore_index=True).reset_index(drop=True)
-        print(f"""Query {query_name} Average Execution Time (last 4 runs): {
+        print(f"""Query {query_name} Average Execution Time (last {len(execution_times) - 1} runs): {
               avg_time:.4f} seconds""")
     return results_df, query_results
 
@@ -153,49 +154,27 @@ def compare_query_results(dfs: list[pd.DataFrame]):
     return success
 
 
-def _create_fresh_db(dataset: str):
-    db_path = f"./data/db/{dataset}.duckdb"
-    backup_path = f"./data/backup/{dataset}_tiny"
-
-    if os.path.exists(db_path):
-        os.remove(db_path)
-        print(f"Removed db at path {db_path}")
-
-    with duckdb.connect(db_path) as con:
-        con.execute("SET default_block_size = '16384'")
-        con.execute(f"IMPORT DATABASE '{backup_path}';")
-
-
-def _create_connection(dataset: str) -> tuple[duckdb.DuckDBPyConnection, str]:
-    original_db_path = f"./data/db/{dataset}.duckdb"
-    copy_db_path = f"./data/db/{dataset}_testing.db"
-
-    # Remove any old db
-    if os.path.exists(copy_db_path):
-        os.remove(copy_db_path)
-        print(f"Removed db at path {copy_db_path}")
-
-    # Copy original db
-    shutil.copy(original_db_path, copy_db_path)
-
-    # Reconnect to db
-    con = duckdb.connect(copy_db_path)
-    con.execute("SET default_block_size = '16384'")
-
-    con.execute("CHECKPOINT;")
-    db_size = os.path.getsize(copy_db_path)
-    print(f"Fresh database size: {db_size/1024/1024:.6f} MB")
-
-    return con, copy_db_path
-
-
 def perform_tests():
     # Parse command line arguments
     parser = argparse.ArgumentParser(
         description="Run performance tests on different datasets.")
     parser.add_argument("dataset", nargs="?", default="tpch", choices=["tpch"],
                         help="The dataset to run tests on (tpch, yelp, twitter, or all)")
+    parser.add_argument("--strategy", default=ALTER_UPDATE, choices=STRATEGIES,
+                        help="The strategy used to materialize fields")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="Use the backup partitioned by document type, and filter each table on its type")
+    parser.add_argument("--execution", default=DIRECT_EXECUTION, choices=EXECUTION_MODES,
+                        help="Execute the query text each iteration (direct), or prepare it once and time the prepared statement (prepared)")
+    parser.add_argument("--iterations", type=int, default=ITERATIONS,
+                        help=f"Execute each query ITERATIONS times. {ADAPTIVE_ITERATIONS} repeats each query until the confidence interval of its median is narrow enough")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="Import the backup into an in-memory database, and copy it in memory for the tests, rather than copying database files")
     args = parser.parse_args()
+    try:
+        check_iterations(iterations=args.iterations)
+    except ValueError as e:
+        parser.error(str(e))
 
     # datasets_to_test = DATASETS.keys() if args.dataset == "all" else [
     #     args.dataset]
@@ -204,8 +183,11 @@ def perform_tests():
     for dataset in datasets_to_test:
         if not os.path.exists(f"./results/single-queries/{dataset}"):
             os.mkdir(f"./results/single-queries/{dataset}")
-        if not os.path.exists(f"./results/single-queries/{dataset}/{TEST_TIME_STRING}"):
-            os.mkdir(f"./results/single-queries/{dataset}/{TEST_TIME_STRING}")
+        result_dir = f"./results/single-queries/{dataset}/{TEST_TIME_STRING}"
+        if args.partitioned:
+            result_dir += "-partitioned"
+        if not os.path.exists(result_dir):
+            os.mkdir(result_dir)
 
         config = DATASETS[dataset]
 
@@ -214,7 +196,8 @@ def perform_tests():
         column_map: dict = config["column_map"]
 
         # Create fresh db
-        _create_fresh_db(dataset=dataset)
+        create_dataset_db(dataset=dataset, partitioned=args.partitioned,
+                         in_memory=args.in_memory)
 
         # db_connection.execute(
         #     f"ATTACH './data/db/{dataset}.db' AS original_db;")
@@ -229,7 +212,7 @@ def perform_tests():
         new_results_dfs = dict()  # Test results
         query_results_dfs = dict()  # Query results
 
-        db_connection, db_path = _create_connection(
+        db_connection, db_path = create_dataset_connection(
             dataset=dataset)
 
         # Extract all fields to be used in these tests
@@ -246,9 +229,10 @@ def perform_tests():
                 fields.append(
                     (field, access_query, field in materialize_columns))
 
-            # Prepare database
-            time_taken = prepare_database(
-                con=db_connection, fields=fields)
+            # Prepare database, without background copies competing for I/O
+            with paused():
+                time_taken = prepare_database(
+                    con=db_connection, fields=fields, strategy=args.strategy)
 
             # Run test
             new_results_df, query_result_df = _perform_test(
@@ -256,11 +240,14 @@ def perform_tests():
                 fields=fields,
                 queries=queries,
                 run_no=run_no,
-                test_time=test_time
+                test_time=test_time,
+                partitioned=args.partitioned,
+                execution_mode=args.execution,
+                iterations=args.iterations
             )
 
             new_results_df.to_csv(
-                f"./results/single-queries/{dataset}/{TEST_TIME_STRING}/{test}.csv", index=False)
+                f"{result_dir}/{test}.csv", index=False)
 
             # Update df dicts
             old_result_df: pd.DataFrame = old_result_dfs[test]
@@ -278,9 +265,9 @@ def perform_tests():
                 """
 SELECT 
     'test_table' AS table_name,
-    (SELECT block_size FROM pragma_database_size()) AS block_size,
+    (SELECT block_size FROM pragma_database_size() WHERE database_name = current_database()) AS block_size,
     COUNT(DISTINCT block_id) AS num_blocks,
-    COUNT(DISTINCT block_id) * (SELECT block_size FROM pragma_database_size()) AS num_bytes
+    COUNT(DISTINCT block_id) * (SELECT block_size FROM pragma_database_size() WHERE database_name = current_database()) AS num_bytes
 FROM pragma_storage_info('test_table')
 GROUP BY all
 """).fetchdf()
@@ -288,11 +275,13 @@ GROUP BY all
             # print("DB size after test:",
             #       db_connection.execute(
             #           "CALL pragma_database_size();").fetch_df())
-            db_size = get_db_size(con=duckdb.connect(db_path))
+            db_size = get_db_size(con=db_connection)
             # db_connection.close()
 
             meta_results.append({
                 "Test": test,
+                "Strategy": args.strategy,
+                "Execution": args.execution,
                 "Time taken": time_taken,
                 "Blocks used": db_size[0],
                 "Block size": db_size[1],
@@ -301,15 +290,17 @@ GROUP BY all
 
         meta_results_df = pd.DataFrame(meta_results)
         meta_results_df.to_csv(
-            f"./results/single-queries/{dataset}/{TEST_TIME_STRING}/meta_results.csv", index=False)
+            f"{result_dir}/meta_results.csv", index=False)
 
         # Compare the results of raw and materialized queries
         print(f"\nComparing query results for dataset: {dataset}")
         success = compare_query_results(
             dfs=query_results_dfs.values()
         )
-        os.remove(db_path)
+        remove_database(db_path)
 
 
 if __name__ == "__main__":
     perform_tests()
+    print_setup_report()
+    print_repetition_report()
@@ -1,16 +1,24 @@
 # pylint: disable=E0401
+import argparse
+import ast
+import glob
 import time
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from itertools import combinations
+from multiprocessing import Process
 from typing import Iterator, List
 
 import duckdb  # type: ignore
 import pandas as pd
 
 import testing.tpch.setup as tpch_setup
+from queries.field_spec import FieldSpec
 from queries.query import Query
+from utils.measurement_cache import MeasurementCache, measurement_setup
 from utils.prepare_database import prepare_database
+from utils.query_timing import time_query, timing_summary, print_repetition_report, check_iterations, ADAPTIVE_ITERATIONS, EXECUTION_MODES, DIRECT_EXECUTION
+from utils.snapshot import paused, snapshot
 
 if not os.path.isdir("./results"):
     os.mkdir("./results")
@@ -19,10 +27,19 @@ if not os.path.isdir("./results/phase-2"):
     os.mkdir("./results/phase-2")
 
 TEST_TIME_STRING = f"{datetime.now().date()}-{datetime.now().hour}H"
+# Executions of each query. ADAPTIVE_ITERATIONS instead repeats each query until the
+# confidence interval of its median is narrow enough, see `utils.query_timing.done_iterating`
 ITERATIONS = 5
 PERMUTATION_SIZES = [0, 1, 2, 3]
+# How queries are executed, see `utils.query_timing`
+EXECUTION_MODE = DIRECT_EXECUTION
 
 DATASET = "tpch"
+# Size of the backup the database is imported from
+BACKUP_SIZE = "tiny"
+
+# Index of the combinations that have completed, one canonical key per line
+COMPLETED_INDEX = "completed.txt"
 
 
 # Paths and queries for different datasets
@@ -56,44 +73,50 @@ def _is_relevant_query(query: Query, materialization: list[str]):
     return True
 
 
-def _perform_test(
-        con: duckdb.DuckDBPyConnection,
-        query: Query,
+def _test_result(
         query_name: str,
-        materialization: list[str]
-) -> pd.DataFrame:
-    '''Execute the query 5 times and calculate average time of last 4 runs'''
+        materialization: list[str],
+        execution_times: list[float],
+        planning_time: float | None
+) -> dict:
+    '''Record the execution times and calculate average time of all runs but the first'''
 
     row = {
         "Query": query_name,
         "Materialization": materialization
     }
 
-    execution_times = []
-
-    # Execute the query 5 times
-    for i in range(ITERATIONS):
-        start_time = time.perf_counter()
-        # Execute the query
+    # The same columns for any number of runs, as results are appended to one csv
+    summary = timing_summary(execution_times=execution_times)
+    for column in [column for column in summary if column.startswith("Iteration ")]:
+        row[column] = summary.pop(column)
 
-        con.execute(query)
-
-        end_time = time.perf_counter()
-        execution_time = end_time - start_time
-        execution_times.append(execution_time)
-        row[f"Iteration {i}"] = execution_time
-
-    # Calculate the average time of the last 4 runs and store it
+    # Calculate the average time of the runs after the first and store it, under the
+    # name it had when there were 5 runs
     # avg_time = -1
-    avg_time = sum(execution_times[1:]) / (ITERATIONS - 1)
+    avg_time = sum(execution_times[1:]) / (len(execution_times) - 1)
     row['Average (last 4 runs)'] = avg_time
+    row['Planning time'] = planning_time
+    row.update(summary)
 
     return row
 
 
+def _worker_cpu_sets(workers: int) -> list[set[int]]:
+    """
+    Split the CPUs available to this process into `workers` disjoint sets
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < workers:
+        raise ValueError(
+            f"Cannot pin {workers} workers to {len(cpus)} available CPUs")
+
+    return [set(cpus[i::workers]) for i in range(workers)]
+
+
 def _create_fresh_db():
     db_path = os.curdir + f"/data/db/{DATASET}_single_query_v2.duckdb"
-    test_db_path = os.curdir + f"/data/backup/{DATASET}_tiny"
+    test_db_path = os.curdir + f"/data/backup/{DATASET}_{BACKUP_SIZE}"
 
     if os.path.exists(db_path):
         os.remove(db_path)
@@ -120,14 +143,374 @@ def _gen_combinations(strings: List[str]) -> Iterator[List[str]]:
                 yield list(combo)
 
 
-def perform_test():
+def _test_combination(
+        con: duckdb.DuckDBPyConnection,
+        queries: dict[str, Query],
+        column_map: dict,
+        materialize_columns: list[str],
+        measurement_cache: MeasurementCache | None = None,
+        execution_mode: str = EXECUTION_MODE,
+        iterations: int = ITERATIONS,
+        setup: str | None = None,
+) -> list[dict]:
+    """
+    Materialize the columns, and run the queries that use all of them, each timed
+    `iterations` times in `execution_mode`. Queries measured by an earlier run in the same
+    `setup` (see `utils.measurement_cache.measurement_setup`), according to
+    `measurement_cache`, are not run again
+
+    Returns
+    -------
+    list[dict]
+        One result row per relevant query. Empty if no query uses all the columns
+    """
+    prepared_db = False
+    result_rows = []
+
+    # Create the field-materialization setup for this test
+    fields = []
+    for field, access_query in column_map.items():
+        fields.append(
+            (field, access_query, field in materialize_columns))
+    # Index the fields once, for all queries of this setup
+    field_spec = FieldSpec(fields)
+
+    # Iterate over the queries
+    for query_name, query_obj in queries.items():
+        query = query_obj.get_query(fields=field_spec)
+
+        # Check if the materialization is relevant for the current query
+        if _is_relevant_query(query=query_obj, materialization=materialize_columns):
+            measurement_key = {
+                "dataset": DATASET,
+                "scale_factor": BACKUP_SIZE,
+                "query": query,
+                "materialization": materialize_columns,
+                "mode": execution_mode,
+                "setup": setup,
+            }
+            measurement = None
+            if measurement_cache is not None:
+                measurement = measurement_cache.get(
+                    iterations=iterations, **measurement_key)
+
+            if measurement is None:
+                # Only prepare db if it is not prepared, and there is a query to run
+                if not prepared_db:
+                    # Without background copies competing for I/O
+                    with paused():
+                        prepare_database(con=con, fields=fields)
+                    prepared_db = True
+                # Run test, executing the query `iterations` times
+                execution_times, planning_time, _ = time_query(
+                    con=con, query=query, iterations=iterations, mode=execution_mode)
+                measurement = (execution_times, planning_time)
+                if measurement_cache is not None:
+                    measurement_cache.put(
+                        execution_times=execution_times, planning_time=planning_time, iterations=iterations, **measurement_key)
+
+            result = _test_result(
+                query_name=query_name,
+                materialization=materialize_columns,
+                execution_times=measurement[0],
+                planning_time=measurement[1],
+            )
+            result_rows.append(result)
+
+    return result_rows
+
+
+def _combination_key(materialize_columns: list[str]) -> str:
+    """
+    Canonical key of a combination, independent of the order of its columns
+    """
+    return ",".join(sorted(materialize_columns))
+
+
+def _load_completed(index_path: str) -> set[str]:
+    if not os.path.exists(index_path):
+        return set()
+
+    with open(index_path, "r") as index_file:
+        return {line.rstrip("\n") for line in index_file}
 
-    result_dir_path = os.curdir + \
-        f"/results/phase-2/{DATASET}/{TEST_TIME_STRING}"
+
+def _mark_completed(index_path: str, keys: list[str]):
+    """
+    Append the keys to the index, and flush them to disk before continuing
+    """
+    with open(index_path, "a") as index_file:
+        for key in keys:
+            index_file.write(key + "\n")
+        index_file.flush()
+        os.fsync(index_file.fileno())
+
+
+def _completed_rows(results_df: pd.DataFrame, completed: set[str]) -> pd.Series:
+    """
+    Mask of the result rows of completed combinations. Rows appended right before a crash,
+    whose combination was never marked as completed, are rerun instead
+    """
+    return results_df["Materialization"].map(
+        lambda materialization: _combination_key(ast.literal_eval(materialization)) in completed)
+
+
+def _worker_paths(result_dir_path: str, worker_no: int) -> tuple[str, str]:
+    return (result_dir_path + f'/results_w{worker_no}.csv',
+            result_dir_path + f'/completed_w{worker_no}.txt')
+
+
+def _run_worker(
+        worker_no: int,
+        workers: int,
+        base_db_path: str,
+        result_dir_path: str,
+        completed: set[str],
+        cpus: set[int] | None,
+        threads: int | None,
+        measurement_cache: MeasurementCache | None = None,
+        execution_mode: str = EXECUTION_MODE,
+        iterations: int = ITERATIONS,
+):
+    """
+    Run every `workers`-th combination, starting from `worker_no`, on a private copy of
+    the base database. Results are appended to a private results file, tagged with the
+    number of the combination, so they can be merged in the order of a serial run.
+    Combinations in `completed` are skipped.
+    """
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+
+    config = DATASET_CONFIGS[DATASET]
+    queries: dict[str, Query] = config["queries"]
+    column_map: dict = config["column_map"]
+    column_list = list(column_map.keys())
+
+    result_path, index_path = _worker_paths(
+        result_dir_path=result_dir_path, worker_no=worker_no)
+
+    # Snapshot the base db, so the workers do not share a file. Each worker copies it
+    # once, so no copies are kept warm
+    db_path = base_db_path.replace(".duckdb", f"_w{worker_no}.duckdb")
+    snapshot(source=base_db_path, destination=db_path, pool_size=0)
+    con = duckdb.connect(db_path)
+    if threads is not None:
+        con.execute(f"SET threads = {threads};")
+    setup = measurement_setup(
+        threads=threads, pinned=cpus is not None, workers=workers)
+
+    for combination_no, materialize_columns in enumerate(_gen_combinations(column_list)):
+        # Round-robin, as later combinations materialize more columns
+        if combination_no % workers != worker_no:
+            continue
+
+        key = _combination_key(materialize_columns)
+        if key in completed:
+            continue
+
+        test_time = time.time()
+        result_rows = _test_combination(
+            con=con,
+            queries=queries,
+            column_map=column_map,
+            materialize_columns=materialize_columns,
+            measurement_cache=measurement_cache,
+            execution_mode=execution_mode,
+            iterations=iterations,
+            setup=setup,
+        )
+
+        if len(result_rows) > 0:
+            temp_df = pd.DataFrame(result_rows)
+            temp_df.insert(0, "Combination no.", combination_no)
+            temp_df.to_csv(
+                result_path,
+                mode='a',
+                header=not os.path.exists(result_path),
+                index=False
+            )
+            print(
+                f"[worker {worker_no}] Time taken for combination {combination_no}: {round(time.time()-test_time, 2)}s ({len(result_rows)} queries)")
+
+        _mark_completed(index_path=index_path, keys=[key])
+
+    if measurement_cache is not None:
+        measurement_cache.flush()
+    print_repetition_report()
+
+    con.close()
+    os.remove(db_path)
+
+
+def _merge_worker_results(result_dir_path: str):
+    """
+    Merge the results and completed combinations of all workers, including workers of
+    an interrupted run, into the results file and index of the run. Results are merged
+    in the order of a serial run.
+    """
     result_path = result_dir_path + '/results.csv'
+    worker_nos = sorted(int(path.rsplit("_w", 1)[1].split(".")[0])
+                        for path in glob.glob(result_dir_path + "/completed_w*.txt"))
+
+    completed_keys = []
+    worker_dfs = []
+    for worker_no in worker_nos:
+        worker_result_path, worker_index_path = _worker_paths(
+            result_dir_path=result_dir_path, worker_no=worker_no)
+        worker_completed = _load_completed(index_path=worker_index_path)
+        completed_keys.extend(worker_completed)
+
+        if os.path.exists(worker_result_path):
+            worker_df = pd.read_csv(worker_result_path)
+            worker_dfs.append(
+                worker_df[_completed_rows(results_df=worker_df, completed=worker_completed)])
+
+    if len(worker_dfs) > 0:
+        results_df = pd.concat(worker_dfs, ignore_index=True)
+        results_df = results_df.sort_values(
+            "Combination no.", kind="stable").drop(columns=["Combination no."])
+        results_df.to_csv(
+            result_path,
+            mode='a',
+            header=not os.path.exists(result_path),
+            index=False
+        )
+
+    # Mark as completed only after the results are written
+    _mark_completed(index_path=result_dir_path + '/' + COMPLETED_INDEX,
+                    keys=sorted(completed_keys))
+
+    for worker_no in worker_nos:
+        for path in _worker_paths(result_dir_path=result_dir_path, worker_no=worker_no):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _prepare_run(result_dir_path: str | None) -> tuple[str, set[str]]:
+    """
+    Create the result directory of a new run, or recover the state of the run in
+    `result_dir_path` to resume it
+
+    Returns
+    -------
+    tuple[str, set[str]]
+        The result directory, and the keys of the combinations that have completed
+    """
+    if result_dir_path is None:
+        result_dir_path = os.curdir + \
+            f"/results/phase-2/{DATASET}/{TEST_TIME_STRING}"
     if not os.path.exists(result_dir_path):
         os.mkdir(result_dir_path)
 
+    # Merge what the workers of an interrupted parallel run completed
+    _merge_worker_results(result_dir_path=result_dir_path)
+
+    completed = _load_completed(
+        index_path=result_dir_path + '/' + COMPLETED_INDEX)
+
+    # Drop results of combinations that did not complete
+    result_path = result_dir_path + '/results.csv'
+    if os.path.exists(result_path):
+        results_df = pd.read_csv(result_path)
+        mask = _completed_rows(results_df=results_df, completed=completed)
+        if not mask.all():
+            print(
+                f"Dropping {(~mask).sum()} results of combinations that did not complete")
+            results_df[mask].to_csv(result_path, index=False)
+
+    if len(completed) > 0:
+        print(
+            f"Resuming {result_dir_path}: {len(completed)} combinations completed")
+
+    return result_dir_path, completed
+
+
+def perform_test_parallel(
+        workers: int,
+        pin_cpus: bool = False,
+        threads: int | None = None,
+        result_dir_path: str | None = None,
+        measurement_cache: MeasurementCache | None = None,
+        execution_mode: str = EXECUTION_MODE,
+        iterations: int = ITERATIONS,
+):
+    """
+    Run the combinations in `workers` processes, each with its own copy of the database
+
+    Parameters
+    ----------
+    workers : int
+        The number of worker processes
+    pin_cpus : bool
+        Pin each worker to a disjoint set of CPUs
+    threads : int | None
+        The number of DuckDB threads of each worker. Defaults to the number of CPUs
+        of the worker if pinned, otherwise DuckDB's default
+    result_dir_path : str | None
+        The result directory of an interrupted run to resume. Defaults to a new run
+    measurement_cache : MeasurementCache | None
+        Reuse the measurements of earlier runs, and store the new measurements
+    execution_mode : str
+        How queries are executed, see `utils.query_timing`
+    iterations : int
+        The number of executions of each query, see `utils.query_timing.time_query`
+    """
+    result_dir_path, completed = _prepare_run(result_dir_path=result_dir_path)
+
+    cpu_sets = _worker_cpu_sets(
+        workers=workers) if pin_cpus else [None] * workers
+
+    # Create fresh db, shared as the base of all workers
+    db_connection, db_path = _create_fresh_db()
+    db_connection.close()
+
+    processes = []
+    for worker_no, cpus in enumerate(cpu_sets):
+        worker_threads = threads
+        if worker_threads is None and cpus is not None:
+            worker_threads = len(cpus)
+
+        p = Process(target=_run_worker, kwargs={
+            "worker_no": worker_no,
+            "workers": workers,
+            "base_db_path": db_path,
+            "result_dir_path": result_dir_path,
+            "completed": completed,
+            "cpus": cpus,
+            "threads": worker_threads,
+            "measurement_cache": measurement_cache,
+            # Passed explicitly, as spawned workers do not inherit the parsed arguments
+            "execution_mode": execution_mode,
+            "iterations": iterations,
+        })
+        p.start()
+        processes.append(p)
+
+    # Wait for all workers to finish
+    for p in processes:
+        p.join()
+
+    _merge_worker_results(result_dir_path=result_dir_path)
+
+    os.remove(db_path)
+
+    failed = [i for i, p in enumerate(processes) if p.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"Workers {failed} failed")
+
+
+def perform_test(
+        threads: int | None = None,
+        result_dir_path: str | None = None,
+        measurement_cache: MeasurementCache | None = None,
+        execution_mode: str = EXECUTION_MODE,
+        iterations: int = ITERATIONS,
+):
+
+    result_dir_path, completed = _prepare_run(result_dir_path=result_dir_path)
+    result_path = result_dir_path + '/results.csv'
+    index_path = result_dir_path + '/' + COMPLETED_INDEX
+
     config = DATASET_CONFIGS[DATASET]
 
     queries: dict[str, Query] = config["queries"]
@@ -136,40 +519,28 @@ def perform_test():
 
     # Create fresh db
     db_connection, db_path = _create_fresh_db()
+    if threads is not None:
+        db_connection.execute(f"SET threads = {threads};")
+    setup = measurement_setup(threads=threads)
 
     m_no = -1
     # Loop through all combinations of possible materializations
     for materialize_columns in _gen_combinations(column_list):
-        relevant_queries = 0
+        key = _combination_key(materialize_columns)
+        if key in completed:
+            continue
+
         test_time = time.time()
-        prepared_db = False
-        result_rows = []
-
-        # Create the field-materialization setup for this test
-        fields = []
-        for field, access_query in column_map.items():
-            fields.append(
-                (field, access_query, field in materialize_columns))
-
-        # Iterate over the queries
-        for query_name, query_obj in queries.items():
-            query = query_obj.get_query(fields=fields)
-
-            # Check if the materialization is relevant for the current query
-            if _is_relevant_query(query=query_obj, materialization=materialize_columns):
-                relevant_queries += 1
-                # Only prepare db if it is not prepared, and there is a relevant query
-                if not prepared_db:
-                    prepare_database(con=db_connection, fields=fields)
-                    prepared_db = True
-            # Run test
-                result = _perform_test(
-                    con=db_connection,
-                    query=query,
-                    query_name=query_name,
-                    materialization=materialize_columns,
-                )
-                result_rows.append(result)
+        result_rows = _test_combination(
+            con=db_connection,
+            queries=queries,
+            column_map=column_map,
+            materialize_columns=materialize_columns,
+            measurement_cache=measurement_cache,
+            execution_mode=execution_mode,
+            iterations=iterations,
+            setup=setup,
+        )
 
         # Append results to csv, if any tests ran
         if len(result_rows) > 0:
@@ -184,7 +555,13 @@ def perform_test():
             )
             m_no += 1
             print(
-                f"Time taken for m{m_no}: {round(time.time()-test_time, 2)}s ({relevant_queries} queries)")
+                f"Time taken for m{m_no}: {round(time.time()-test_time, 2)}s ({len(result_rows)} queries)")
+
+        _mark_completed(index_path=index_path, keys=[key])
+
+    if measurement_cache is not None:
+        measurement_cache.flush()
+    print_repetition_report()
 
     # Close db connection and clean up
     db_connection.close()
@@ -192,6 +569,44 @@ def perform_test():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the queries for every combination of materialized columns.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="The number of worker processes, each with its own copy of the database")
+    parser.add_argument("--pin", action="store_true",
+                        help="Pin each worker to a disjoint set of CPUs")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="The number of DuckDB threads of each worker")
+    parser.add_argument("--execution", default=DIRECT_EXECUTION, choices=EXECUTION_MODES,
+                        help="Execute the query text each iteration (direct), or prepare it once and time the prepared statement (prepared)")
+    parser.add_argument("--iterations", type=int, default=ITERATIONS,
+                        help=f"Execute each query ITERATIONS times. {ADAPTIVE_ITERATIONS} repeats each query until the confidence interval of its median is narrow enough")
+    parser.add_argument("--resume", default=None, metavar="RESULT_DIR",
+                        help="Resume the interrupted run in RESULT_DIR, skipping completed combinations")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not reuse or store measurements in the measurement cache")
+    parser.add_argument("--max-age", type=float, default=None, metavar="DAYS",
+                        help="Measure again if the stored measurement is older than DAYS")
+    parser.add_argument("--force", action="store_true",
+                        help="Measure every query again, replacing the stored measurements")
+    args = parser.parse_args()
+    try:
+        check_iterations(iterations=args.iterations)
+    except ValueError as e:
+        parser.error(str(e))
+
+    measurement_cache = None
+    if not args.no_cache:
+        max_age = timedelta(
+            days=args.max_age) if args.max_age is not None else None
+        measurement_cache = MeasurementCache(max_age=max_age, force=args.force)
+
     t = time.time()
-    perform_test()
+    if args.workers > 1 or args.pin:
+        perform_test_parallel(workers=args.workers, pin_cpus=args.pin, threads=args.threads,
+                              result_dir_path=args.resume, measurement_cache=measurement_cache,
+                              execution_mode=args.execution, iterations=args.iterations)
+    else:
+        perform_test(threads=args.threads, result_dir_path=args.resume, measurement_cache=measurement_cache,
+                     execution_mode=args.execution, iterations=args.iterations)
     print(f"Total time taken for test: {round(time.time() - t)} seconds")
@@ -1,5 +1,4 @@
 # pylint: disable=E0401
-import shutil
 import os
 import ast
 import string
@@ -11,6 +10,7 @@ import pandas as pd
 import duckdb  # type: ignore
 
 from utils.prepare_database import prepare_database, get_db_size
+from utils.snapshot import create_connection, paused, print_setup_report
 import testing.tpch.setup as tpch_setup
 
 CHARS = string.ascii_letters + string.digits + " "
@@ -47,21 +47,9 @@ def _create_connection(dataset: str, test: str = "temp") -> tuple[duckdb.DuckDBP
     original_db_path = BASE_PATH + f"/data/db/{dataset}.duckdb"
     copy_db_path = BASE_PATH + f"/data/db/{dataset}_{test}.db"
 
-    # Remove any old db
-    if os.path.exists(copy_db_path):
-        os.remove(copy_db_path)
-
-    # Copy original db
-    shutil.copy(original_db_path, copy_db_path)
-
     PATHS_TO_REMOVE.add(copy_db_path)
 
-    # Reconnect to db
-    con = duckdb.connect(copy_db_path)
-
-    con.execute("CHECKPOINT;")
-
-    return con, copy_db_path
+    return create_connection(original_db_path=original_db_path, copy_db_path=copy_db_path)
 
 
 def _generate_json(seed: int, dataset: str, orig_table: str = None):
@@ -305,15 +293,17 @@ def main():
 
             # Get db size before materialization
             db_size_before = get_db_size(db_connection)
-            # Prepare database
-            prepare_time = prepare_database(con=db_connection, fields=fields)
+            # Prepare database, without background copies competing for I/O
+            with paused():
+                prepare_time = prepare_database(con=db_connection, fields=fields)
 
             # Get db size before materialization
             db_size_after = get_db_size(db_connection)
 
-            # Run test
-            write_time = _perform_test(
-                con=db_connection, fields=fields, dataset=dataset)
+            # Run test, without background copies of the database competing for I/O
+            with paused():
+                write_time = _perform_test(
+                    con=db_connection, fields=fields, dataset=dataset)
             print(
                 f"Time taken to write {materialized_fields_list}: {write_time}")
 
@@ -353,6 +343,7 @@ def main():
 if __name__ == "__main__":
     t = time.time()
     main()
+    print_setup_report()
 
     _clean_up()
 
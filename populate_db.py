@@ -1,22 +1,47 @@
 # pylint: disable=E0401
+import argparse
 import json
+from json.encoder import encode_basestring_ascii
 import os
 import shutil
+import resource
+import time
 import duckdb  # type: ignore
-import pandas as pd
+from duckdb.typing import VARCHAR  # type: ignore
 import pyarrow as pa
-import pyarrow.parquet as pq
+
+import testing.tpch.setup as tpch_setup
+from tpch.convert_tpch_into_json import table_definitions
 
 CONFIG = {
     "tpch": {
         "json_path": './data/tpch/tpch.json',
+        "tbl_path": './tpch/data',
+        "doc_types": tpch_setup.DOC_TYPES,
+        # The lines of tpch.json are written by `json.dump`, so the native ingest stores
+        # the same documents as the Python ingest
+        "default_ingest": 'native',
     },
     "twitter": {
         "json_path": './data/twitter/twitter.json',
+        "tbl_path": None,
+        "doc_types": None,
+        # The lines of twitter.json are not serialized as by `json.dumps`, so only the
+        # Python ingest stores the same documents as the existing backups
+        "default_ingest": 'python',
     }
 }
 
 
+# Ingest modes
+# Let DuckDB read and parse the JSONL file in parallel
+NATIVE_INGEST = 'native'
+# Parse the JSONL file line by line in Python, and insert in batches
+PYTHON_INGEST = 'python'
+# Build the JSON documents from the TPC-H .tbl files inside DuckDB, skipping the JSONL file
+TBL_INGEST = 'tbl'
+INGEST_MODES = [NATIVE_INGEST, PYTHON_INGEST, TBL_INGEST]
+
 DATA_PATH = './data'
 DB_PATH = './data/db'
 BACKUP_PATH = './data/backup'
@@ -24,74 +49,228 @@ BACKUP_PATH = './data/backup'
 CLEAN_UP_FILES = set()
 
 
-def _create_db(con: duckdb.DuckDBPyConnection):
+def _create_db(con: duckdb.DuckDBPyConnection, partitioned: bool = False):
     # Drop the test table if it exists, to ensure a fresh start
     con.execute("DROP TABLE IF EXISTS test_table")
 
-    # Create the testtable table with one data colum
-    con.execute("CREATE TABLE test_table (raw_json JSON)")
+    if partitioned:
+        # Create the testtable table with one data column, and the document type
+        con.execute("CREATE TABLE test_table (raw_json JSON, doc_type VARCHAR)")
+    else:
+        # Create the testtable table with one data colum
+        con.execute("CREATE TABLE test_table (raw_json JSON)")
     print("Created fresh test_table table for raw JSON data.")
 
 
-def _parse_and_insert(dataset: str, data_path: str, con: duckdb.DuckDBPyConnection, batch_size=50000) -> int:
-    parquet_file_path = f"{DATA_PATH}/{dataset}.parquet"
-    CLEAN_UP_FILES.add(parquet_file_path)
+def _doc_type_sql(dataset: str) -> str:
+    """
+    Build the expression deriving the document type from the prefix of the first key
+    of `raw_json`, e.g. 'l' for {"l_orderkey": ...}
+    """
+    doc_types = CONFIG[dataset]["doc_types"]
+    if doc_types is None:
+        raise ValueError(f"No document types for dataset {dataset}")
+
+    cases = " ".join(
+        f"WHEN '{prefix}' THEN '{doc_type}'" for prefix, doc_type in doc_types.items())
+    return f"CASE split_part(json_keys(raw_json)[1], '_', 1) {cases} END"
+
+
+def _cluster_by_doc_type(con: duckdb.DuckDBPyConnection):
+    """
+    Rewrite test_table sorted by document type, so each row group holds a single type
+    and DuckDB's zone maps can skip the row groups of other types
+    """
+    con.execute("""
+    BEGIN TRANSACTION;
+    CREATE TABLE test_table_sorted AS SELECT * FROM test_table ORDER BY doc_type;
+    DROP TABLE test_table;
+    ALTER TABLE test_table_sorted RENAME TO test_table;
+    COMMIT;
+    """)
+    print("Clustered test_table by document type.")
+
+
+def _read_and_insert(dataset: str, data_path: str, con: duckdb.DuckDBPyConnection, partitioned: bool = False) -> int:
+    """
+    Insert the JSONL file with DuckDB's newline-delimited JSON reader, which scans the
+    file in parallel. Each line is stored as-is, without being re-serialized.
+    """
+    print("Starting to read raw JSON file with DuckDB...")
+
+    select_sql = "raw_json"
+    if partitioned:
+        select_sql += f", {_doc_type_sql(dataset=dataset)}"
+
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        total_rows = con.execute(f"""
+            INSERT INTO test_table
+            SELECT {select_sql}
+            FROM (
+                SELECT json AS raw_json
+                FROM read_ndjson_objects('{data_path}')
+            );
+        """).fetchone()[0]
+        con.execute("COMMIT;")
+    except duckdb.Error:
+        con.execute("ROLLBACK;")
+        raise
+
+    print(f"Total rows inserted: {total_rows}")
+    return total_rows
+
+
+def _parse_and_insert(dataset: str, data_path: str, con: duckdb.DuckDBPyConnection, batch_size=50000, partitioned: bool = False) -> int:
+    doc_type_sql = _doc_type_sql(dataset=dataset) if partitioned else None
 
     def _insert_batch(data_batch: list[str]) -> int:
-        df_batch = pd.DataFrame(data_batch)
-        table_batch = pa.Table.from_pandas(df_batch)
-        with pq.ParquetWriter(parquet_file_path, table_batch.schema) as writer:
-            writer.write_table(table_batch)
-        _insert_parquet_into_db(con=con, file_path=parquet_file_path)
+        table_batch = pa.table(
+            {'raw_json': pa.array(data_batch, type=pa.string())})
+        _insert_arrow_into_db(
+            con=con, table=table_batch, doc_type_sql=doc_type_sql)
         return len(data_batch)
 
-    print("Starting to parse raw JSON file and prepare for Parquet conversion...")
+    print("Starting to parse raw JSON file and insert Arrow batches...")
 
-    writer = None
     data_batch = []
     total_rows = 0
 
-    try:
-        # for file_path in JSON_FILE_PATHS:
-        with open(data_path, 'r') as file:
-            for line_number, line in enumerate(file, start=1):
-                try:
-                    # Parse the JSON document and store as a single string
-                    json_obj = json.loads(line)
-                    data_batch.append({'raw_json': json.dumps(json_obj)})
-
-                    # Once the batch reaches batch_size, write to Parquet
-                    if len(data_batch) >= batch_size:
-                        total_rows += _insert_batch(data_batch=data_batch)
-                        data_batch = []  # Clear batch memory
-
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON on line {line_number}: {e}")
-
-            # Write any remaining rows in the last batch
-            if data_batch:
-                total_rows += _insert_batch(data_batch=data_batch)
-
-    finally:
-        # Close the writer if it was initialized
-        if writer:
-            writer.close()
-
-    print(f"""Final batch written. Total rows written to raw Parquet: {
-        total_rows}""")
+    # for file_path in JSON_FILE_PATHS:
+    with open(data_path, 'r') as file:
+        for line_number, line in enumerate(file, start=1):
+            try:
+                # Parse the JSON document and store as a single string
+                json_obj = json.loads(line)
+                data_batch.append(json.dumps(json_obj))
+
+                # Once the batch reaches batch_size, insert it
+                if len(data_batch) >= batch_size:
+                    total_rows += _insert_batch(data_batch=data_batch)
+                    data_batch = []  # Clear batch memory
+
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON on line {line_number}: {e}")
+
+        # Write any remaining rows in the last batch
+        if data_batch:
+            total_rows += _insert_batch(data_batch=data_batch)
+
+    print(f"Final batch written. Total rows inserted: {total_rows}")
+    # ru_maxrss is the peak resident memory of the process (KB on Linux)
+    print(
+        f"Peak memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024:.1f} MB (process), {pa.default_memory_pool().max_memory()/1024/1024:.1f} MB (Arrow)")
     return total_rows
 
 
-def _insert_parquet_into_db(con: duckdb.DuckDBPyConnection, file_path: str) -> float:
+def _insert_arrow_into_db(con: duckdb.DuckDBPyConnection, table: pa.Table, doc_type_sql: str = None):
+    """
+    Insert an Arrow table with a `raw_json` column, scanned by DuckDB without copying
+    """
+    con.register("arrow_batch", table)
 
-    # Insert Parquet data into DuckDB
+    # Insert Arrow data into DuckDB
     con.execute("BEGIN TRANSACTION;")
 
-    # Insert data into db
-    con.execute(
-        f"INSERT INTO test_table SELECT raw_json FROM read_parquet('{file_path}');")
+    # Insert data into db, tagged with the document type if partitioned
+    if doc_type_sql is None:
+        con.execute(
+            "INSERT INTO test_table SELECT raw_json FROM arrow_batch;")
+    else:
+        con.execute(
+            f"INSERT INTO test_table SELECT raw_json, {doc_type_sql} FROM arrow_batch;")
     con.execute("COMMIT;")
 
+    con.unregister("arrow_batch")
+
+
+def _json_string_ascii(value: str) -> str:
+    return encode_basestring_ascii(value)
+
+
+def _json_value_sql(value_sql: str, data_type) -> str:
+    """
+    Build the expression rendering a .tbl value as JSON text, equal to the output of
+    `json.dump` in the TPC-H converter. Values that fail to convert are rendered as `null`.
+    """
+    if data_type == int:
+        converted_sql = f"CAST(TRY_CAST({value_sql} AS BIGINT) AS VARCHAR)"
+    elif data_type == float:
+        converted_sql = f"CAST(TRY_CAST({value_sql} AS DOUBLE) AS VARCHAR)"
+    elif data_type == 'date':
+        converted_sql = f"'\"' || CAST(TRY_CAST({value_sql} AS DATE) AS VARCHAR) || '\"'"
+    else:
+        # Printable ASCII only needs quotes and backslashes escaped, anything else is
+        # escaped by the same encoder as `json.dump`
+        converted_sql = f"""CASE WHEN regexp_full_match({value_sql}, '[ -~]*')
+            THEN '"' || replace(replace({value_sql}, '\\', '\\\\'), '"', '\\"') || '"'
+            ELSE json_string_ascii({value_sql}) END"""
+
+    return f"coalesce({converted_sql}, 'null')"
+
+
+def _load_tbl(dataset: str, tbl_path: str, con: duckdb.DuckDBPyConnection, partitioned: bool = False) -> int:
+    """
+    Insert the TPC-H .tbl files directly, with one statement per table. Each line is
+    read by DuckDB's CSV reader, and its JSON document is built as text, byte-equivalent
+    to the lines of `tpch.json` written by `tpch/convert_tpch_into_json.py`.
+    """
+    if tbl_path is None:
+        raise ValueError(f"No .tbl files for dataset {dataset}")
+
+    print("Starting to load .tbl files with DuckDB...")
+
+    con.create_function("json_string_ascii", _json_string_ascii,
+                        [VARCHAR], VARCHAR, side_effects=False)
+
+    total_rows = 0
+    for table, definition in table_definitions.items():
+        file_path = os.path.join(tbl_path, f"{table}.tbl")
+        if not os.path.exists(file_path):
+            print(f"File {file_path} does not exist. Skipping table {table}.")
+            continue
+
+        columns = definition["columns"]
+        # Build the document with a single concat, e.g. concat('{"c_custkey": ', ..., '}')
+        parts_sql = []
+        for i, (column, data_type) in enumerate(zip(columns, definition["types"]), start=1):
+            parts_sql.append(
+                f"'{'{' if i == 1 else ', '}{json.dumps(column)}: '")
+            parts_sql.append(_json_value_sql(
+                value_sql=f"v[{i}]", data_type=data_type))
+        parts_sql.append("'}'")
+        select_sql = f"concat({', '.join(parts_sql)})"
+        if partitioned:
+            select_sql += f", '{table}'"
+
+        # Read each line as a single value, using a delimiter not present in the data.
+        # Each line ends with a delimiter, so a valid line splits into one extra value.
+        # Lines with another number of values are skipped, like in the converter
+        con.execute("BEGIN TRANSACTION;")
+        try:
+            table_rows = con.execute(f"""
+                INSERT INTO test_table
+                SELECT {select_sql}
+                FROM (
+                    SELECT string_split(trim(line), '|') AS v
+                    FROM read_csv('{file_path}', columns={{'line': 'VARCHAR'}}, delim='{chr(1)}',
+                                  quote='', escape='', header=false, auto_detect=false)
+                )
+                WHERE len(v) = {len(columns) + 1};
+            """).fetchone()[0]
+            con.execute("COMMIT;")
+        except duckdb.Error:
+            con.execute("ROLLBACK;")
+            raise
+
+        print(f"Loaded {table_rows} rows from table {table}.")
+        total_rows += table_rows
+
+    con.remove_function("json_string_ascii")
+
+    print(f"Total rows inserted: {total_rows}")
+    return total_rows
+
 
 def _clean_up():
     print(CLEAN_UP_FILES)
@@ -103,14 +282,21 @@ def _clean_up():
             print(f"No file at path {file}")
 
 
-def _prepare_dirs(dataset: str):
+def _backup_path(dataset: str, partitioned: bool) -> str:
+    backup_path = f"{BACKUP_PATH}/{dataset}_medium"
+    if partitioned:
+        backup_path += "_partitioned"
+    return backup_path
+
+
+def _prepare_dirs(dataset: str, partitioned: bool = False):
     if not os.path.isdir(DATA_PATH):
         os.mkdir(DATA_PATH)
 
     if not os.path.isdir(DB_PATH):
         os.mkdir(DB_PATH)
 
-    backup_path = f"{BACKUP_PATH}/{dataset}_medium"
+    backup_path = _backup_path(dataset=dataset, partitioned=partitioned)
     try:
         os.mkdir(backup_path)
     except FileExistsError:
@@ -120,25 +306,77 @@ def _prepare_dirs(dataset: str):
         os.mkdir(backup_path)
 
 
-def populate_db():
+def _insert(dataset: str, con: duckdb.DuckDBPyConnection, ingest: str, partitioned: bool = False) -> int:
     """
-    Populate database
+    Insert the dataset with the given ingest mode, and report the throughput.
+    The native ingest falls back to the Python ingest if DuckDB fails to read the file.
     """
-    dataset = 'tpch'  # TODO dynamic/take from args
     config = CONFIG[dataset]
-    backup_path = f"{BACKUP_PATH}/{dataset}_medium"
+    data_path = config["json_path"]
+    start_time = time.perf_counter()
+
+    total_rows = None
+    if ingest == TBL_INGEST:
+        total_rows = _load_tbl(con=con, dataset=dataset,
+                               tbl_path=config["tbl_path"], partitioned=partitioned)
+    elif ingest == NATIVE_INGEST:
+        try:
+            total_rows = _read_and_insert(
+                con=con, dataset=dataset, data_path=data_path, partitioned=partitioned)
+        except duckdb.Error as e:
+            print(
+                f"Native ingest failed, falling back to Python ingest: {e}")
+
+    if total_rows is None:
+        total_rows = _parse_and_insert(con=con, dataset=dataset,
+                                       data_path=data_path, partitioned=partitioned)
+
+    time_taken = time.perf_counter() - start_time
+    print(
+        f"Ingested {total_rows} rows in {time_taken:.2f} seconds ({total_rows / time_taken:.0f} rows/s)")
+
+    return total_rows
+
+
+def populate_db(dataset: str = 'tpch', partitioned: bool = False, ingest: str | None = None):
+    """
+    Populate database
+
+    Parameters
+    ----------
+    dataset : str
+        The dataset to populate the database with
+    partitioned : bool
+        Tag each document with its source type in a `doc_type` column, and cluster
+        the table by it. The backup is suffixed with `_partitioned`.
+    ingest : str
+        `NATIVE_INGEST` stores each line of the JSONL file as-is, read by DuckDB.
+        `PYTHON_INGEST` stores each line re-serialized by `json.dumps`.
+        The two are byte-identical for files written by `json.dump`, like `tpch.json`.
+        `TBL_INGEST` builds the same documents as `tpch.json` from the TPC-H .tbl files.
+        If None, the default ingest of the dataset, native for TPC-H and Python for Twitter.
+    """
+    if ingest is None:
+        ingest = CONFIG[dataset]["default_ingest"]
+    if ingest not in INGEST_MODES:
+        raise ValueError(f"No such ingest mode {ingest}")
+
+    backup_path = _backup_path(dataset=dataset, partitioned=partitioned)
     db_path = f"{DB_PATH}/{dataset}.db"
 
     # Prepare db and backup directories
-    _prepare_dirs(dataset=dataset)
+    _prepare_dirs(dataset=dataset, partitioned=partitioned)
 
     db_connection = duckdb.connect(db_path)
     CLEAN_UP_FILES.add(db_path)
 
-    _create_db(con=db_connection)
+    _create_db(con=db_connection, partitioned=partitioned)
+
+    _insert(con=db_connection, dataset=dataset,
+            ingest=ingest, partitioned=partitioned)
 
-    _parse_and_insert(con=db_connection, dataset=dataset,
-                      data_path=config["json_path"])
+    if partitioned:
+        _cluster_by_doc_type(con=db_connection)
 
     # Export database as backup
     db_connection.execute(f"EXPORT DATABASE '{backup_path}' (FORMAT PARQUET);")
@@ -149,4 +387,15 @@ def populate_db():
 
 
 if __name__ == "__main__":
-    populate_db()
+    parser = argparse.ArgumentParser(
+        description="Populate the database, and export it as a backup.")
+    parser.add_argument("dataset", nargs="?", default="tpch", choices=list(CONFIG.keys()),
+                        help="The dataset to populate the database with")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="Tag and cluster the documents by their source type")
+    parser.add_argument("--ingest", default=None, choices=INGEST_MODES,
+                        help="Read the JSON file with DuckDB (native), parse it in Python (python), or load the TPC-H .tbl files directly (tbl). Defaults to native for tpch and python for twitter")
+    args = parser.parse_args()
+
+    populate_db(dataset=args.dataset,
+                partitioned=args.partitioned, ingest=args.ingest)
@@ -0,0 +1,75 @@
+from collections.abc import Mapping
+from types import MappingProxyType
+from typing import Iterator, NamedTuple
+
+
+class Field(NamedTuple):
+    """
+    How a field is accessed in the current db materialization
+    """
+    access: str
+    type: str
+    materialized: bool
+    doc_type: str | None = None
+
+
+class FieldSpec(Mapping):
+    """
+    Immutable, hashable index of fields by name, built once from the list of field
+    tuples used throughout the project, for constant-time lookup while formatting queries
+    """
+
+    __slots__ = ("_fields", "_hash")
+
+    def __init__(self, fields: list[tuple[str, dict, bool]]):
+        """
+        Parameters
+        ----------
+        fields : list[tuple[str, dict, bool]]
+            List of tuples of field name, json extraction query, and materialized status
+        """
+        self._fields = MappingProxyType({
+            field: Field(
+                access=access_query["access"],
+                type=access_query["type"],
+                materialized=materialized,
+                doc_type=access_query.get("doc_type"),
+            )
+            for field, access_query, materialized in fields
+        })
+        self._hash = hash(tuple(self._fields.items()))
+
+    @classmethod
+    def from_fields(cls, fields: "list[tuple[str, dict, bool]] | FieldSpec") -> "FieldSpec":
+        """
+        Get the field spec of the fields, without rebuilding it if it is one already
+        """
+        if isinstance(fields, FieldSpec):
+            return fields
+        return cls(fields)
+
+    def __getitem__(self, field: str) -> Field:
+        return self._fields[field]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._fields)
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, FieldSpec):
+            return self._hash == other._hash and self._fields == other._fields
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"FieldSpec(materialized={sorted(self.materialized())})"
+
+    def materialized(self) -> frozenset[str]:
+        """
+        Get the names of the materialized fields
+        """
+        return frozenset(field for field, spec in self._fields.items() if spec.materialized)
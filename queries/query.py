@@ -1,10 +1,39 @@
+import re
+from collections import OrderedDict
 from enum import Enum
 
+from queries.field_spec import Field, FieldSpec
+
 
 class MaterializationStrategy(Enum):
     FIRST_ITERATION = 1
 
 
+# Number of query texts cached per query
+QUERY_CACHE_SIZE = 1024
+
+# Query generation modes
+# Extract each unmaterialized field where it is referenced
+DIRECT_GENERATION = "direct"
+# Extract each unmaterialized field once per table alias, in a projection of the table
+CSE_GENERATION = "cse"
+# Extract all unmaterialized fields of a table alias with a single list extraction, parsing
+# each document once, and index into the extracted list
+LIST_EXTRACT_GENERATION = "list_extract"
+GENERATION_MODES = [DIRECT_GENERATION, CSE_GENERATION, LIST_EXTRACT_GENERATION]
+# Modes projecting the extractions of each table alias
+PROJECTED_GENERATION_MODES = [CSE_GENERATION, LIST_EXTRACT_GENERATION]
+
+TABLE_REFERENCE_PATTERN = r"\btest_table(\s+AS)?\s+(\w+)"
+# Placeholder of an extraction, resolved once the table references have been rewritten
+EXTRACTION_PLACEHOLDER_PATTERN = r"\x00(\d+)\x00"
+# A single key of an access query, e.g. ->'user' or ->>'id_str'
+ACCESS_KEY_PATTERN = r"->>?'([^']*)'"
+
+# Column of the list of extracted values, in `LIST_EXTRACT_GENERATION`
+EXTRACTED_LIST_COLUMN = "extracted_list"
+
+
 class Query:
     """
     Base class for queries used in this project
@@ -13,6 +42,16 @@ class Query:
     def __init__(self, dataset: str):
         self.poor_field_weight = 1
         self.dataset = dataset
+        # Document types accessed through each table alias, collected by `_json`
+        self._alias_doc_types: dict[str, set[str]] = {}
+        # Unmaterialized fields of each table alias by column, and the placeholders of
+        # their extractions, collected by `_json` in `PROJECTED_GENERATION_MODES`
+        self._generation_mode = DIRECT_GENERATION
+        self._alias_extractions: dict[str, dict[str, Field]] = {}
+        self._extraction_placeholders: list[tuple[str, str, str]] = []
+        # Query texts by the specs of the fields used in the query, least recently used first
+        self._query_cache: OrderedDict[tuple, str] = OrderedDict()
+        self._used_fields: tuple[str, ...] | None = None
         if dataset == 'tpch':
 
             self.good_field_weight = 36
@@ -21,22 +60,156 @@ class Query:
         else:
             raise ValueError("No such dataset")
 
-    def get_query(self, fields: list[tuple[str, dict, bool]]) -> str:
-        # TODO dosctr
+    def get_query(self, fields: list[tuple[str, dict, bool]] | FieldSpec, partitioned: bool = False, mode: str = DIRECT_GENERATION) -> str:
         """
         Get the formatted query, adjusted to current db materializaiton
 
         Parameters
         ----------
-        dts : dict[str, dict[str, str]]
-            Dictionary with data types for give columns of CTEs.
-            E.g. {"o": {"o_orderkey": "extracted_list[1]::INT"}}
+        fields : list[tuple[str, dict, bool]] | FieldSpec
+            List of tuples of field name, json extraction query, and materialized status.
+            Pass a `FieldSpec` to avoid converting the list for every query of a setup.
+        partitioned : bool
+            If True, the db has a `doc_type` column tagging the source type of each document.
+            Each table alias is then restricted to the document type of the fields it accesses,
+            allowing DuckDB to skip row groups of other document types.
+        mode : str
+            `DIRECT_GENERATION` extracts each unmaterialized field where it is referenced.
+            `CSE_GENERATION` extracts each unmaterialized field once per table alias, in a
+            projection of `test_table`, and references the projected column elsewhere.
+            `LIST_EXTRACT_GENERATION` projects the fields in the same way, but extracts all
+            fields of a table alias with a single `json_extract_string` of a list of paths.
 
         Returns
         -------
         str
         """
-        raise NotImplementedError()
+        if mode not in GENERATION_MODES:
+            raise ValueError(f"No such generation mode {mode}")
+
+        fields = FieldSpec.from_fields(fields)
+
+        # The text only depends on the fields used in the query
+        key = (partitioned, mode, tuple(fields.get(field)
+               for field in self._get_used_fields()))
+        query = self._query_cache.get(key)
+        if query is not None:
+            self._query_cache.move_to_end(key)
+            return query
+
+        self._alias_doc_types = {}
+        self._generation_mode = mode
+        self._alias_extractions = {}
+        self._extraction_placeholders = []
+        query = self._get_query(fields=fields)
+
+        query = self._rewrite_table_references(
+            query=query, partitioned=partitioned)
+
+        self._query_cache[key] = query
+        if len(self._query_cache) > QUERY_CACHE_SIZE:
+            self._query_cache.popitem(last=False)
+
+        return query
+
+    def relevant_materialization(self, fields: list[tuple[str, dict, bool]] | FieldSpec) -> frozenset[str]:
+        """
+        Get the materialized fields used in the query. Setups with the same relevant
+        materialization produce the same query text.
+
+        Parameters
+        ----------
+        fields : list[tuple[str, dict, bool]] | FieldSpec
+            List of tuples of field name, json extraction query, and materialized status
+
+        Returns
+        -------
+        frozenset[str]
+        """
+        fields = FieldSpec.from_fields(fields)
+        return frozenset(field for field in self._get_used_fields()
+                         if field in fields and fields[field].materialized)
+
+    def _get_used_fields(self) -> tuple[str, ...]:
+        """
+        The distinct columns used in the query, in a fixed order
+        """
+        if self._used_fields is None:
+            self._used_fields = tuple(sorted(set(self.columns_used())))
+        return self._used_fields
+
+    def _get_query(self, fields: FieldSpec) -> str:
+        """
+        Query specific implementation of the formatted query
+
+        Parameters
+        ----------
+        fields : FieldSpec
+            The fields by name, with json extraction query, and materialized status
+
+        Returns
+        -------
+        str
+        """
+        raise NotImplementedError("Subclass must implement this method")
+
+    def _rewrite_table_references(self, query: str, partitioned: bool) -> str:
+        """
+        Replace each `test_table <alias>` with a subquery of `test_table`, which
+        - if `partitioned`, is filtered on the document type of the alias. Aliases without
+          a single known document type are not filtered.
+        - projects the extractions of the alias collected in `PROJECTED_GENERATION_MODES`.
+        Aliases with neither are kept. Extractions of aliases that were not rewritten,
+        e.g. aliases of other subqueries, are extracted directly instead.
+        """
+        rewritten_aliases = set()
+
+        def _replace(match: re.Match) -> str:
+            alias = match.group(2)
+
+            where = ""
+            doc_types = self._alias_doc_types.get(alias, set())
+            if partitioned and len(doc_types) == 1:
+                where = f" WHERE doc_type = '{next(iter(doc_types))}'"
+
+            extractions = self._alias_extractions.get(alias, {})
+            if where == "" and len(extractions) == 0:
+                return match.group(0)
+
+            rewritten_aliases.add(alias)
+            if self._generation_mode == LIST_EXTRACT_GENERATION and len(extractions) > 1:
+                return f"({self._list_extract_projection(extractions=extractions, where=where)}) AS {alias}"
+
+            projection = "".join(f", {self._extract(tbl=None, spec=spec)} AS {col}"
+                                 for col, spec in extractions.items())
+            return f"(SELECT *{projection} FROM test_table{where}) AS {alias}"
+
+        query = re.sub(TABLE_REFERENCE_PATTERN, _replace, query)
+
+        if len(self._extraction_placeholders) == 0:
+            return query
+
+        def _resolve(match: re.Match) -> str:
+            tbl, col, direct_extraction = self._extraction_placeholders[int(
+                match.group(1))]
+            if tbl in rewritten_aliases:
+                return f"{tbl}.{col}"
+            return direct_extraction
+
+        return re.sub(EXTRACTION_PLACEHOLDER_PATTERN, _resolve, query)
+
+    def _list_extract_projection(self, extractions: dict[str, Field], where: str) -> str:
+        """
+        Project the fields of a table alias from a single extraction of all their paths
+        """
+        paths = ", ".join(f"'{_json_path(spec.access)}'"
+                          for spec in extractions.values())
+        projection = "".join(
+            f", {self._cast(value=f'{EXTRACTED_LIST_COLUMN}[{i}]', data_type=spec.type)} AS {col}"
+            for i, (col, spec) in enumerate(extractions.items(), start=1))
+
+        return f"SELECT * EXCLUDE ({EXTRACTED_LIST_COLUMN}){projection} FROM " \
+            f"(SELECT *, json_extract_string(raw_json, [{paths}]) AS {EXTRACTED_LIST_COLUMN} FROM test_table{where})"
 
     def columns_used(self) -> list[str]:
         """
@@ -143,33 +316,14 @@ class Query:
         """
         raise NotImplementedError("Subclass must implement this method")
 
-    def _get_field_type(self, field: str, fields: list[tuple[str, dict, bool]]) -> dict:
-        if fields is None:
-            return None
-
-        for col, access_query, materialized in fields:
-            if col == field:
-                if materialized:
-                    return None
-                else:
-                    return access_query["type"]
-
-        raise ValueError(f"No data type for field with name {field}")
-
-    def _get_field_access(self, field: str, fields: list[tuple[str, dict, bool]]) -> dict:
-        if fields is None:
-            return None
-
-        for col, access_query, materialized in fields:
-            if col == field:
-                if materialized:
-                    return None
-                else:
-                    return access_query["access"]
+    def _get_field(self, field: str, fields: FieldSpec):
+        try:
+            return fields[field]
+        except KeyError:
+            raise ValueError(
+                f"No data type for field with name {field}") from None
 
-        raise ValueError(f"No data type for field with name {field}")
-
-    def _json(self, tbl: str, col: str, fields: list[tuple[str, dict, bool]]):
+    def _json(self, tbl: str, col: str, fields: FieldSpec):
         """
         Extract the column
 
@@ -188,15 +342,47 @@ class Query:
         str
             The column extracted from json. If `dt` is None, there is no json extraction
         """
-        data_type = self._get_field_type(field=col, fields=fields)
-        access = self._get_field_access(field=col, fields=fields)
+        if fields is None:
+            return f"{tbl}.{col}"
 
-        if data_type is None:
+        spec = self._get_field(field=col, fields=FieldSpec.from_fields(fields))
+        if spec.doc_type is not None:
+            self._alias_doc_types.setdefault(tbl, set()).add(spec.doc_type)
+
+        if spec.materialized:
             return f"{tbl}.{col}"
-        elif data_type == 'VARCHAR':
-            return f"({tbl}.{access})"
 
-        return f"TRY_CAST({tbl}.{access} AS {data_type})"
+        if self._generation_mode in PROJECTED_GENERATION_MODES:
+            return self._cse_json(tbl=tbl, col=col, spec=spec)
+
+        return self._extract(tbl=tbl, spec=spec)
+
+    def _extract(self, tbl: str | None, spec) -> str:
+        """
+        Extract an unmaterialized field, from the table alias `tbl` if given
+        """
+        access = spec.access if tbl is None else f"{tbl}.{spec.access}"
+        return self._cast(value=access, data_type=spec.type)
+
+    def _cast(self, value: str, data_type: str) -> str:
+        """
+        Cast an extracted string to the data type of its field
+        """
+        if data_type == 'VARCHAR':
+            return f"({value})"
+
+        return f"TRY_CAST({value} AS {data_type})"
+
+    def _cse_json(self, tbl: str, col: str, spec) -> str:
+        """
+        Collect the field for the projection of the table alias, and get a placeholder
+        for the projected column
+        """
+        self._alias_extractions.setdefault(tbl, {}).setdefault(col, spec)
+
+        self._extraction_placeholders.append(
+            (tbl, col, self._extract(tbl=tbl, spec=spec)))
+        return f"\x00{len(self._extraction_placeholders) - 1}\x00"
 
     def get_column_weights(self, prev_materialization: list[str], iteration: int, only_freq=False):
 
@@ -242,3 +428,13 @@ class Query:
             weights['s_nationkey'] = 0
 
         return weights
+
+
+def _json_path(access: str) -> str:
+    """
+    Convert an access query, e.g. raw_json->'user'->>'id_str', into its JSON path, e.g. $.user.id_str
+    """
+    keys = re.findall(ACCESS_KEY_PATTERN, access)
+    if len(keys) == 0:
+        raise ValueError(f"No JSON path in access query {access}")
+    return "$." + ".".join(keys)
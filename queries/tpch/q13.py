@@ -9,7 +9,7 @@ class Q13(Query):
     def __init__(self, dataset: str):
         super().__init__(dataset=dataset)
 
-    def get_query(self, fields: list[tuple[str, dict, bool]]) -> str:
+    def _get_query(self, fields: list[tuple[str, dict, bool]]) -> str:
         """
         Get the formatted TPC-H query 13, adjusted to current db materializaiton
 
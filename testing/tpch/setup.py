@@ -80,298 +80,368 @@ STANDARD_SETUPS = {
 }
 
 
+# Source table of each TPC-H document, identified by the prefix of its fields
+DOC_TYPES = {
+    "c": "customer",
+    "l": "lineitem",
+    "n": "nation",
+    "o": "orders",
+    "p": "part",
+    "ps": "partsupp",
+    "r": "region",
+    "s": "supplier",
+}
+
+
 COLUMN_MAP = {
     ########################### C ###########################
     "c_custkey": {
         "access": "raw_json->>'c_custkey'",
         "type": "INT",
-        "frequency": 150000
+        "frequency": 150000,
+        "doc_type": "customer"
     },
     "c_nationkey": {
         "access": "raw_json->>'c_nationkey'",
         "type": "INT",
-        "frequency": 150000
+        "frequency": 150000,
+        "doc_type": "customer"
     },
     "c_mktsegment": {
         "access": "raw_json->>'c_mktsegment'",
         "type": "VARCHAR",
-        "frequency": 150000
+        "frequency": 150000,
+        "doc_type": "customer"
     },
     "c_name": {
         "access": "raw_json->>'c_name'",
         "type": "VARCHAR",
-        "frequency": 150000
+        "frequency": 150000,
+        "doc_type": "customer"
     },
     "c_phone": {
         "access": "raw_json->>'c_phone'",
         "type": "VARCHAR",
-        "frequency": 150000
+        "frequency": 150000,
+        "doc_type": "customer"
     },
     "c_address": {
         "access": "raw_json->>'c_address'",
         "type": "VARCHAR",
-        "frequency": 150000
+        "frequency": 150000,
+        "doc_type": "customer"
     },
     "c_comment": {
         "access": "raw_json->>'c_comment'",
         "type": "VARCHAR",
-        "frequency": 150000
+        "frequency": 150000,
+        "doc_type": "customer"
     },
     "c_acctbal": {
         "access": "raw_json->>'c_acctbal'",
         "type": "DECIMAL(12,2)",
-        "frequency": 150000
+        "frequency": 150000,
+        "doc_type": "customer"
     },
     ########################### L ###########################
     "l_orderkey": {
         "access": "raw_json->>'l_orderkey'",
         "type": "INT",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_partkey": {
         "access": "raw_json->>'l_partkey'",
         "type": "INT",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_suppkey": {
         "access": "raw_json->>'l_suppkey'",
         "type": "INT",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     'l_linenumber': {
         "access": "raw_json->>'l_linenumber'",
         "type": "INT",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_quantity": {
         "access": "raw_json->>'l_quantity'",
         "type": "DECIMAL(12,2)",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_extendedprice": {
         "access": "raw_json->>'l_extendedprice'",
         "type": "DECIMAL(12,2)",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_discount": {
         "access": "raw_json->>'l_discount'",
         "type": "DECIMAL(12,2)",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_tax": {
         "access": "raw_json->>'l_tax'",
         "type": "DECIMAL(12,2)",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_returnflag": {
         "access": "raw_json->>'l_returnflag'",
         "type": "CHAR(1)",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     'l_linestatus': {
         "access": "raw_json->>'l_linestatus'",
         "type": "CHAR(1)",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_shipdate": {
         "access": "raw_json->>'l_shipdate'",
         "type": "DATE",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_commitdate": {
         "access": "raw_json->>'l_commitdate'",
         "type": "DATE",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_receiptdate": {
         "access": "raw_json->>'l_receiptdate'",
         "type": "DATE",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_shipinstruct": {
         "access": "raw_json->>'l_shipinstruct'",
         "type": "VARCHAR",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_shipmode": {
         "access": "raw_json->>'l_shipmode'",
         "type": "VARCHAR",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     "l_comment": {
         "access": "raw_json->>'l_comment'",
         "type": "VARCHAR",
-        "frequency": 6000000
+        "frequency": 6000000,
+        "doc_type": "lineitem"
     },
     ########################### N ###########################
     "n_nationkey": {
         "access": "raw_json->>'n_nationkey'",
         "type": "INT",
-        "frequency": 25
+        "frequency": 25,
+        "doc_type": "nation"
     },
     "n_regionkey": {
         "access": "raw_json->>'n_regionkey'",
         "type": "INT",
-        "frequency": 25
+        "frequency": 25,
+        "doc_type": "nation"
     },
     "n_name": {
         "access": "raw_json->>'n_name'",
         "type": "VARCHAR",
-        "frequency": 25
+        "frequency": 25,
+        "doc_type": "nation"
     },
     ########################### O ###########################
     "o_orderdate": {
         "access": "raw_json->>'o_orderdate'",
         "type": "DATE",
-        "frequency": 1500000
+        "frequency": 1500000,
+        "doc_type": "orders"
     },
     "o_totalprice": {
         "access": "raw_json->>'o_totalprice'",
         "type": "DECIMAL(12,2)",
-        "frequency": 1500000
+        "frequency": 1500000,
+        "doc_type": "orders"
     },
     "o_shippriority": {
         "access": "raw_json->>'o_shippriority'",
         "type": "INT",
-        "frequency": 1500000
+        "frequency": 1500000,
+        "doc_type": "orders"
     },
     "o_custkey": {
         "access": "raw_json->>'o_custkey'",
         "type": "INT",
-        "frequency": 1500000
+        "frequency": 1500000,
+        "doc_type": "orders"
     },
     "o_orderkey": {
         "access": "raw_json->>'o_orderkey'",
         "type": "INT",
-        "frequency": 1500000
+        "frequency": 1500000,
+        "doc_type": "orders"
     },
     "o_orderpriority": {
         "access": "raw_json->>'o_orderpriority'",
         "type": "VARCHAR",
-        "frequency": 1500000
+        "frequency": 1500000,
+        "doc_type": "orders"
     },
     "o_comment": {
         "access": "raw_json->>'o_comment'",
         "type": "VARCHAR",
-        "frequency": 1500000
+        "frequency": 1500000,
+        "doc_type": "orders"
     },
     'o_orderstatus': {
         "access": "raw_json->>'o_orderstatus'",
         "type": "CHAR(1)",
-        "frequency": 1500000
+        "frequency": 1500000,
+        "doc_type": "orders"
     },
     ########################### P ###########################
     "p_type": {
         "access": "raw_json->>'p_type'",
         "type": "VARCHAR",
-        "frequency": 200000
+        "frequency": 200000,
+        "doc_type": "part"
     },
     "p_name": {
         "access": "raw_json->>'p_name'",
         "type": "VARCHAR",
-        "frequency": 200000
+        "frequency": 200000,
+        "doc_type": "part"
     },
     "p_partkey": {
         "access": "raw_json->>'p_partkey'",
         "type": "INT",
-        "frequency": 200000
+        "frequency": 200000,
+        "doc_type": "part"
     },
     "p_size": {
         "access": "raw_json->>'p_size'",
         "type": "INT",
-        "frequency": 200000
+        "frequency": 200000,
+        "doc_type": "part"
     },
     "p_mfgr": {
         "access": "raw_json->>'p_mfgr'",
         "type": "VARCHAR",
-        "frequency": 200000
+        "frequency": 200000,
+        "doc_type": "part"
     },
     "p_brand": {
         "access": "raw_json->>'p_brand'",
         "type": "VARCHAR",
-        "frequency": 200000
+        "frequency": 200000,
+        "doc_type": "part"
     },
     "p_container": {
         "access": "raw_json->>'p_container'",
         "type": "VARCHAR",
-        "frequency": 200000
+        "frequency": 200000,
+        "doc_type": "part"
     },
     ########################## PS ###########################
     "ps_partkey": {
         "access": "raw_json->>'ps_partkey'",
         "type": "INT",
-        "frequency": 800000
+        "frequency": 800000,
+        "doc_type": "partsupp"
     },
     "ps_suppkey": {
         "access": "raw_json->>'ps_suppkey'",
         "type": "INT",
-        "frequency": 800000
+        "frequency": 800000,
+        "doc_type": "partsupp"
     },
     "ps_availqty": {
         "access": "raw_json->>'ps_availqty'",
         "type": "INT",
-        "frequency": 800000
+        "frequency": 800000,
+        "doc_type": "partsupp"
     },
     "ps_supplycost": {
         "access": "raw_json->>'ps_supplycost'",
         "type": "INT",
-        "frequency": 800000
+        "frequency": 800000,
+        "doc_type": "partsupp"
     },
     "ps_comment": {
         "access": "raw_json->>'ps_comment'",
         "type": "VARCHAR",
-        "frequency": 800000
+        "frequency": 800000,
+        "doc_type": "partsupp"
     },
     ########################### R ###########################
     "r_regionkey": {
         "access": "raw_json->>'r_regionkey'",
         "type": "INT",
-        "frequency": 5
+        "frequency": 5,
+        "doc_type": "region"
     },
     "r_comment": {
         "access": "raw_json->>'r_comment'",
         "type": "VARCHAR",
-        "frequency": 5
+        "frequency": 5,
+        "doc_type": "region"
     },
     "r_name": {
         "access": "raw_json->>'r_name'",
         "type": "VARCHAR",
-        "frequency": 5
+        "frequency": 5,
+        "doc_type": "region"
     },
     ########################### S ###########################
     "s_suppkey": {
         "access": "raw_json->>'s_suppkey'",
         "type": "INT",
-        "frequency": 10000
+        "frequency": 10000,
+        "doc_type": "supplier"
     },
     "s_name": {
         "access": "raw_json->>'s_name'",
         "type": "VARCHAR",
-        "frequency": 10000
+        "frequency": 10000,
+        "doc_type": "supplier"
     },
     "s_address": {
         "access": "raw_json->>'s_address'",
         "type": "VARCHAR",
-        "frequency": 10000
+        "frequency": 10000,
+        "doc_type": "supplier"
     },
     "s_nationkey": {
         "access": "raw_json->>'s_nationkey'",
         "type": "INT",
-        "frequency": 10000
+        "frequency": 10000,
+        "doc_type": "supplier"
     },
     "s_phone": {
         "access": "raw_json->>'s_phone'",
         "type": "VARCHAR",
-        "frequency": 10000
+        "frequency": 10000,
+        "doc_type": "supplier"
     },
     "s_acctbal": {
         "access": "raw_json->>'s_acctbal'",
         "type": "DECIMAL(12,2)",
-        "frequency": 10000
+        "frequency": 10000,
+        "doc_type": "supplier"
     },
     "s_comment": {
         "access": "raw_json->>'s_comment'",
         "type": "VARCHAR",
-        "frequency": 10000
+        "frequency": 10000,
+        "doc_type": "supplier"
     }
 }
@@ -1,24 +1,19 @@
 import shutil
 import tempfile
-from multiprocessing import Process
+from multiprocessing import Pool
 import time
-from datetime import datetime
+from datetime import date, datetime
 import argparse
 import os
 import json
+import math
+from json.encoder import encode_basestring_ascii
 
 
 TPCH_ORIGINAL_DATA_PATH = './data'
 OUTPUT_DATA_PATH = '../data'
 TPCH_OUTPUT_DATA_PATH = '../data/tpch'
 
-# Create data directory if not exists
-if not os.path.isdir(OUTPUT_DATA_PATH):
-    os.mkdir(OUTPUT_DATA_PATH)
-
-if not os.path.isdir(TPCH_OUTPUT_DATA_PATH):
-    os.mkdir(TPCH_OUTPUT_DATA_PATH)
-
 
 # Define the mapping of table names to their column names and data types
 table_definitions = {
@@ -156,15 +151,80 @@ tables = list(table_definitions.keys())
 # Define date format used in the data (e.g., 'YYYY-MM-DD')
 DATE_FORMAT = '%Y-%m-%d'
 
+# Number of bytes of a .tbl file processed by each worker
+SHARD_SIZE = 64 * 1024 * 1024
+
+
+def _convert_date(value: str) -> str:
+    # Convert date string to ISO format, using the fast ISO parser for 'YYYY-MM-DD'
+    if len(value) == 10 and value[4] == '-' and value[7] == '-':
+        return date.fromisoformat(value).isoformat()
+    return datetime.strptime(value, DATE_FORMAT).strftime('%Y-%m-%d')
+
+
+def _convert_float(value: str) -> str:
+    number = float(value)
+    if math.isfinite(number):
+        return repr(number)
+    # NaN and infinity are written as by `json.dump`
+    return json.dumps(number)
+
+
+# Converters from .tbl values to their JSON representation, equal to the output of `json.dump`
+CONVERTERS = {
+    int: lambda value: repr(int(value)),
+    float: _convert_float,
+    'date': lambda value: encode_basestring_ascii(_convert_date(value)),
+    str: encode_basestring_ascii,
+}
+
+
+def _shard_table(table: str, limit_rows: bool) -> list[tuple[int, int]]:
+    """
+    Split the .tbl file of a table into byte ranges of roughly `SHARD_SIZE` bytes
+
+    Parameters
+    ----------
+    table : str
+        The name of the table to split
+    limit_rows : bool
+        If True, only the first 10 rows are processed, so the table is not split
+
+    Returns
+    -------
+    list[tuple[int, int]]
+        The (start, end) byte offsets of each shard. Empty if the file does not exist
+    """
+    file_path = os.path.join(TPCH_ORIGINAL_DATA_PATH, f'{table}.tbl')
+
+    # Check if the .tbl file exists
+    if not os.path.exists(file_path):
+        print(f'File {file_path} does not exist. Skipping table {table}.')
+        return []
+
+    file_size = os.path.getsize(file_path)
+    if limit_rows:
+        return [(0, file_size)]
+
+    return [(start, min(start + SHARD_SIZE, file_size)) for start in range(0, max(file_size, 1), SHARD_SIZE)]
+
 
-def process_table(table, limit_rows, temp_dir):
+def process_shard(table: str, shard_no: int, start: int, end: int, limit_rows: bool, temp_dir: str) -> tuple[str, int, int]:
     """
-    Process a TPCH table by reading its .tbl file, converting each row to JSON, and writing the results to a temporary file.
+    Process a byte range of a TPCH table by reading its .tbl file, converting each row to JSON, and writing the results to a temporary file.
+
+    A row belongs to the shard in which it starts.
 
     Parameters
     ----------
     table : str
         The name of the table to process. The function expects a file named `<table>.tbl` in the TPCH original data path.
+    shard_no : int
+        The index of the shard within the table, used to name the temporary file.
+    start : int
+        Byte offset of the start of the shard.
+    end : int
+        Byte offset of the end of the shard (exclusive).
     limit_rows : bool
         If True, limits the processing to the first 10 valid rows of the table.
     temp_dir : str
@@ -172,44 +232,47 @@ def process_table(table, limit_rows, temp_dir):
 
     Returns
     -------
-    None
-        Writes the processed rows as JSON documents to a temporary file and prints progress and warnings. Does not return a value.
+    tuple[str, int, int]
+        The table name, the number of rows written, and the number of warnings.
     """
-
-    print(f'\nStarting processing table: {table}')
-    start_time = time.time()
-
     columns = table_definitions[table]['columns']
     types = table_definitions[table]['types']
     filename = f'{table}.tbl'
 
     file_path = os.path.join(TPCH_ORIGINAL_DATA_PATH, filename)
 
-    # Check if the .tbl file exists
-    if not os.path.exists(file_path):
-        print(f'File {file_path} does not exist. Skipping table {table}.')
-        return
-
-    # Try to get total number of lines in file
-    with open(file_path, 'r') as infile:
-        total_lines = sum(1 for line in infile)
-    print(f'Table {table} has {total_lines} lines.')
+    # Preformat the JSON key of each column, e.g. '"c_custkey": '
+    keys = [encode_basestring_ascii(column) + ': '
+            for column in columns]
+    converters = [CONVERTERS[data_type] for data_type in types]
 
     row_count = 0  # Initialize row counter
     warning_count = 0  # Initialize warning counter
 
-    temp_output_file = os.path.join(temp_dir, f'{table}_temp.json')
+    temp_output_file = os.path.join(
+        temp_dir, f'{table}_{shard_no:05d}_temp.json')
+
+    with open(file_path, 'rb') as infile, open(temp_output_file, 'w') as outfile:
+        # Skip the row started in the previous shard
+        if start > 0:
+            infile.seek(start - 1)
+            if infile.read(1) != b'\n':
+                infile.readline()
+
+        position = infile.tell()
+        while position < end:
+            raw_line = infile.readline()
+            if not raw_line:
+                break
+            position += len(raw_line)
 
-    # Open the .tbl file again to process
-    with open(file_path, 'r') as infile, open(temp_output_file, 'w') as outfile:
-        for line_number, line in enumerate(infile, start=1):
             # Break if limit is reached
             if limit_rows and row_count >= 10:
                 print(f'Limit of 10 rows reached for table {table}.')
                 break
 
             # Strip trailing whitespace and delimiter
-            line = line.strip()
+            line = raw_line.decode().strip()
             if not line:
                 continue  # Skip empty lines
 
@@ -219,74 +282,58 @@ def process_table(table, limit_rows, temp_dir):
             # Check for correct number of columns
             if len(values) != len(columns):
                 print(
-                    f'Warning: Line {line_number} in {filename} has {len(values)} values but expected {len(columns)}. Skipping this line.')
+                    f'Warning: Line at byte {position - len(raw_line)} in {filename} has {len(values)} values but expected {len(columns)}. Skipping this line.')
                 warning_count += 1
                 continue
 
-            # Convert values to appropriate data types
-            converted_values = []
-            for i, (value, data_type) in enumerate(zip(values, types)):
+            # Convert values to their JSON representation
+            parts = []
+            for i, (key, value, converter) in enumerate(zip(keys, values, converters)):
                 try:
-                    if data_type == int:
-                        converted_values.append(int(value))
-                    elif data_type == float:
-                        converted_values.append(float(value))
-                    elif data_type == 'date':
-                        # Convert date string to ISO format
-                        date_obj = datetime.strptime(value, DATE_FORMAT)
-                        converted_values.append(date_obj.strftime('%Y-%m-%d'))
-                    else:  # Assume string
-                        converted_values.append(value)
+                    parts.append(key + converter(value))
                 except ValueError as e:
                     print(
-                        f'Warning: Type conversion error on table {table}, line {line_number}, column {columns[i]}: {e}. Setting value to None.')
+                        f'Warning: Type conversion error on table {table}, line at byte {position - len(raw_line)}, column {columns[i]}: {e}. Setting value to None.')
                     warning_count += 1
-                    converted_values.append(None)  # or handle as appropriate
-
-            # Map column names to their respective converted values
-            row = dict(zip(columns, converted_values))
+                    parts.append(key + 'null')  # or handle as appropriate
 
             # Write the JSON document to the temporary output file
-            json.dump(row, outfile)
-            outfile.write('\n')
+            outfile.write('{' + ', '.join(parts) + '}\n')
 
             row_count += 1  # Increment row counter
 
-            # Provide progress feedback every 1,000 rows
-            if row_count % 10000 == 0:
-                print(f'Processed {row_count} rows from table {table}.')
+    return table, row_count, warning_count
 
-    end_time = time.time()
-    print(
-        f'Finished processing {row_count} rows from table {table} in {end_time - start_time:.2f} seconds.')
-    if warning_count > 0:
-        print(
-            f'Encountered {warning_count} warnings while processing table {table}.')
+
+def _process_shard(args: tuple) -> tuple[str, int, int]:
+    return process_shard(*args)
 
 
-def analyze_fields_frequency():
+def analyze_fields_frequency(table_line_counts: dict[str, int] = None):
     """
-    For each .tbl file available in TPCH_ORIGINAL_DATA_PATH, count the number of lines.
+    For each .tbl file available in TPCH_ORIGINAL_DATA_PATH, count the number of lines,
+    unless the counts are given in `table_line_counts`.
     Then, for each table, compute the fraction of documents that come from that table.
     Each field (column) belonging to the table is assigned that same fraction.
     The results are written as CSV to a file with columns 'column_name,frequency'.
     """
-    table_line_counts = {}
-    total_lines = 0
+    if table_line_counts is None:
+        table_line_counts = {}
 
-    # Iterate over all tables defined in table_definitions
-    for table in tables:
-        file_path = os.path.join(TPCH_ORIGINAL_DATA_PATH, f"{table}.tbl")
-        if not os.path.exists(file_path):
-            print(f"File {file_path} not found. Skipping table '{table}'.")
-            continue
-
-        # Count the number of lines in the table file
-        with open(file_path, "r") as f:
-            count = sum(1 for _ in f)
-        table_line_counts[table] = count
-        total_lines += count
-        print(f"Table '{table}' has {count} lines.")
+        # Iterate over all tables defined in table_definitions
+        for table in tables:
+            file_path = os.path.join(TPCH_ORIGINAL_DATA_PATH, f"{table}.tbl")
+            if not os.path.exists(file_path):
+                print(f"File {file_path} not found. Skipping table '{table}'.")
+                continue
+
+            # Count the number of lines in the table file
+            with open(file_path, "r") as f:
+                count = sum(1 for _ in f)
+            table_line_counts[table] = count
+            print(f"Table '{table}' has {count} lines.")
+
+    total_lines = sum(table_line_counts.values())
 
     if total_lines == 0:
         print("No lines found in any table. Frequency analysis will not be generated.")
@@ -300,7 +347,8 @@ def analyze_fields_frequency():
         columns = table_definitions[table]['columns']
         types = table_definitions[table]['types']
         for i, col in enumerate(columns):
-            frequency_entries.append((col, types[i].__name__, fraction))
+            frequency_entries.append(
+                (col, getattr(types[i], '__name__', types[i]), fraction))
 
     frequency_entries.sort(key=lambda x: x[2], reverse=True)
 
@@ -320,6 +368,14 @@ def analyze_fields_frequency():
 
 def convert(limit_rows, field_frequency):
     total_start_time = time.time()
+
+    # Create data directory if not exists
+    if not os.path.isdir(OUTPUT_DATA_PATH):
+        os.mkdir(OUTPUT_DATA_PATH)
+
+    if not os.path.isdir(TPCH_OUTPUT_DATA_PATH):
+        os.mkdir(TPCH_OUTPUT_DATA_PATH)
+
     output_file = os.path.join(
         TPCH_OUTPUT_DATA_PATH, 'tpch.json')
 
@@ -330,25 +386,35 @@ def convert(limit_rows, field_frequency):
     temp_dir = tempfile.mkdtemp()
     print(f'Temporary files will be stored in {temp_dir}')
 
-    processes = []
-
-    # Start a process for each table
+    # Split each table into shards, processed by a pool of workers
+    tasks = []
     for table in tables:
-        p = Process(target=process_table, args=(table, limit_rows, temp_dir))
-        p.start()
-        processes.append(p)
+        for shard_no, (start, end) in enumerate(_shard_table(table=table, limit_rows=limit_rows)):
+            tasks.append((table, shard_no, start, end, limit_rows, temp_dir))
+    print(f'Processing {len(tasks)} shards with {os.cpu_count()} workers...')
+
+    table_row_counts = {}
+    table_warning_counts = {}
+    with Pool() as pool:
+        for table, row_count, warning_count in pool.imap_unordered(_process_shard, tasks):
+            table_row_counts[table] = table_row_counts.get(
+                table, 0) + row_count
+            table_warning_counts[table] = table_warning_counts.get(
+                table, 0) + warning_count
 
-    # Wait for all processes to finish
-    for p in processes:
-        p.join()
+    for table in tables:
+        if table in table_row_counts:
+            print(
+                f'Finished processing table {table}: {table_row_counts[table]} rows, {table_warning_counts[table]} warnings.')
 
-    # Merge all temporary files into the final output file
+    # Merge all temporary files into the final output file, in table and shard order
     print('\nMerging temporary files into the final output file...')
-    with open(output_file, 'w') as outfile:
-        for table in tables:
-            temp_output_file = os.path.join(temp_dir, f'{table}_temp.json')
+    with open(output_file, 'wb') as outfile:
+        for table, shard_no, *_ in tasks:
+            temp_output_file = os.path.join(
+                temp_dir, f'{table}_{shard_no:05d}_temp.json')
             if os.path.exists(temp_output_file):
-                with open(temp_output_file, 'r') as infile:
+                with open(temp_output_file, 'rb') as infile:
                     shutil.copyfileobj(infile, outfile)
 
     # Clean up temporary directory
@@ -361,7 +427,9 @@ def convert(limit_rows, field_frequency):
     print(f'JSON data is written to {output_file}.')
 
     if field_frequency:
-        analyze_fields_frequency()
+        # The number of documents of each table is known from the conversion, unless limited
+        analyze_fields_frequency(
+            table_line_counts=None if limit_rows else table_row_counts)
 
 
 if __name__ == '__main__':
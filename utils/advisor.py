@@ -0,0 +1,241 @@
+import re
+
+import duckdb  # type: ignore
+import numpy as np
+import pandas as pd
+
+from queries.query import Query
+from utils.query_timing import time_query
+from utils.usage_matrix import get_query_usage_matrix, UsageMatrix, CLAUSES
+
+
+# Number of documents sampled from `test_table` to calibrate the costs on
+SAMPLE_SIZE = 100000
+SAMPLE_TABLE = "advisor_sample"
+MATERIALIZED_SAMPLE_TABLE = "advisor_materialized_sample"
+# Timed executions of each calibration query. The fastest is used
+CALIBRATION_ITERATIONS = 3
+
+# Bytes per value of fixed width types
+TYPE_WIDTHS = {
+    "BOOLEAN": 1,
+    "INT": 4,
+    "INTEGER": 4,
+    "DATE": 4,
+    "FLOAT": 4,
+    "BIGINT": 8,
+    "DOUBLE": 8,
+}
+# Bytes per value of decimals, by their maximum precision
+DECIMAL_WIDTHS = [(4, 2), (9, 4), (18, 8), (38, 16)]
+# Bytes per value of strings not present in the sample
+DEFAULT_VARCHAR_WIDTH = 16
+
+# Clauses whose extractions are evaluated on every row of `test_table`, as they filter
+# the table. Extractions in other clauses are only evaluated on rows of the document
+# type of the field
+FILTER_CLAUSES = ["where", "join", "self_join"]
+
+COST_COLUMNS = ["Field", "Extraction cost", "Scan cost",
+                "Row fraction", "Rows", "Width", "Storage"]
+
+
+def calibrate(con: duckdb.DuckDBPyConnection, column_map: dict, sample_size: int = SAMPLE_SIZE) -> pd.DataFrame:
+    """
+    Measure the cost of extracting each field from json, and of scanning it once
+    materialized, by micro-benchmarking a sample of the unmaterialized `test_table`
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        Connection to the database to calibrate against
+    column_map : dict
+        The column map of the dataset
+    sample_size : int
+        The number of documents to sample
+
+    Returns
+    -------
+    pd.DataFrame
+        Per field, the extraction and scan cost in seconds per row, the fraction of rows
+        containing the field, the estimated number of rows containing it, the bytes per
+        value, and the estimated storage in bytes if materialized
+    """
+    no_rows = con.execute("SELECT COUNT(*) FROM test_table;").fetchone()[0]
+    row_fractions = _row_fractions(column_map=column_map)
+
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE {SAMPLE_TABLE} AS
+        SELECT raw_json FROM test_table USING SAMPLE reservoir({sample_size} ROWS) REPEATABLE (42);""")
+    no_sampled = con.execute(
+        f"SELECT COUNT(*) FROM {SAMPLE_TABLE};").fetchone()[0]
+
+    projection = ", ".join(f"{_extraction_sql(access_query)} AS {field}"
+                           for field, access_query in column_map.items())
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE {MATERIALIZED_SAMPLE_TABLE} AS
+        SELECT {projection} FROM {SAMPLE_TABLE};""")
+
+    try:
+        parse_time = _min_time(
+            con=con, query=f"SELECT COUNT(raw_json) FROM {SAMPLE_TABLE};")
+        base_scan_time = _min_time(
+            con=con, query=f"SELECT COUNT(*) FROM {MATERIALIZED_SAMPLE_TABLE};")
+
+        rows = []
+        for field, access_query in column_map.items():
+            extraction_time = _min_time(
+                con=con, query=f"SELECT COUNT({_extraction_sql(access_query)}) FROM {SAMPLE_TABLE};")
+            scan_time = _min_time(
+                con=con, query=f"SELECT COUNT({field}) FROM {MATERIALIZED_SAMPLE_TABLE};")
+
+            width = _type_width(data_type=access_query["type"])
+            if width is None:
+                width = con.execute(
+                    f"SELECT AVG(strlen({field})) FROM {MATERIALIZED_SAMPLE_TABLE};").fetchone()[0]
+                width = DEFAULT_VARCHAR_WIDTH if width is None else width
+
+            field_rows = row_fractions[field] * no_rows
+            rows.append({
+                "Field": field,
+                "Extraction cost": max(extraction_time - parse_time, 0) / max(no_sampled, 1),
+                "Scan cost": max(scan_time - base_scan_time, 0) / max(no_sampled, 1),
+                "Row fraction": row_fractions[field],
+                "Rows": field_rows,
+                "Width": width,
+                # A materialized column spans every row of `test_table`, with a validity
+                # bit per row, and a value per row containing the field
+                "Storage": field_rows * width + no_rows / 8,
+            })
+    finally:
+        con.execute(f"DROP TABLE IF EXISTS {SAMPLE_TABLE};")
+        con.execute(f"DROP TABLE IF EXISTS {MATERIALIZED_SAMPLE_TABLE};")
+
+    return pd.DataFrame(rows, columns=COST_COLUMNS).set_index("Field")
+
+
+def estimate_time_saved(costs: pd.DataFrame, queries: dict[str, Query], load: list[str]) -> dict[str, float]:
+    """
+    Estimate the time saved on the load by materializing each field, in seconds
+
+    Each use of a field saves the difference between extracting it and scanning it, on
+    every row of `test_table` in filtering clauses, and on the rows containing the field
+    elsewhere
+    """
+    usage = get_query_usage_matrix(queries=queries)
+    time_saved = usage.load_counts(load=load) @ time_saved_matrix(
+        costs=costs, usage=usage)
+    return {field: float(time_saved[usage.field_index[field]]) if field in usage.field_index else 0.0
+            for field in costs.index}
+
+
+def time_saved_matrix(costs: pd.DataFrame, usage: UsageMatrix) -> np.ndarray:
+    """
+    The time saved on a single execution of each query by materializing each field, as a
+    query x field matrix over the fields of `usage`. Fields without costs save nothing.
+    """
+    matrix = np.zeros((len(usage.query_names), len(usage.field_names)))
+    costed = [(f, field) for f, field in enumerate(usage.field_names)
+              if field in costs.index]
+    for c, clause in enumerate(CLAUSES):
+        savings = np.zeros(len(usage.field_names))
+        for f, field in costed:
+            savings[f] = use_time_saved(costs=costs, field=field, clause=clause)
+        # A self join reads the field twice
+        no_reads = 2 if clause == "self_join" else 1
+        matrix += no_reads * usage.counts[:, :, c] * savings
+    return matrix
+
+
+def use_time_saved(costs: pd.DataFrame, field: str, clause: str) -> float:
+    """
+    Estimate the time saved on a single use of the field in a clause by materializing it,
+    in seconds
+    """
+    saving = max(costs.at[field, "Extraction cost"] -
+                 costs.at[field, "Scan cost"], 0)
+    if clause in FILTER_CLAUSES:
+        # The number of rows of `test_table`
+        return costs.at[field, "Rows"] / costs.at[field, "Row fraction"] * saving
+    return costs.at[field, "Rows"] * saving
+
+
+def rank_fields(
+        costs: pd.DataFrame,
+        queries: dict[str, Query],
+        load: list[str],
+        exclude: set[str] | None = None
+) -> list[str]:
+    """
+    Rank the fields used by the load by their estimated time saved per byte of storage
+
+    Parameters
+    ----------
+    costs : pd.DataFrame
+        The calibrated costs, see `calibrate`
+    queries : dict[str, Query]
+        The queries of the dataset
+    load : list[str]
+        The names of the queries in the load
+    exclude : set[str] | None
+        Fields not to rank, e.g. the fields materialized already
+
+    Returns
+    -------
+    list[str]
+        The fields, the most beneficial first
+    """
+    exclude = set() if exclude is None else exclude
+    time_saved = estimate_time_saved(costs=costs, queries=queries, load=load)
+
+    scores = {
+        field: saved / max(costs.at[field, "Storage"], 1)
+        for field, saved in time_saved.items()
+        if field not in exclude and saved > 0
+    }
+    return sorted(scores, key=lambda field: (scores[field], field), reverse=True)
+
+
+def _row_fractions(column_map: dict) -> dict[str, float]:
+    """
+    Get the fraction of documents containing each field, from its `frequency`. The number
+    of documents of a type is the highest frequency of its fields, and fields without a
+    document type are assumed to share one
+    """
+    doc_type_rows: dict[str | None, int] = {}
+    for access_query in column_map.values():
+        doc_type = access_query.get("doc_type")
+        doc_type_rows[doc_type] = max(
+            doc_type_rows.get(doc_type, 0), access_query["frequency"])
+
+    no_documents = sum(doc_type_rows.values())
+    return {field: access_query["frequency"] / no_documents
+            for field, access_query in column_map.items()}
+
+
+def _type_width(data_type: str) -> int | None:
+    """
+    Get the bytes per value of a fixed width type, or None for strings
+    """
+    match = re.fullmatch(r"DECIMAL\((\d+),\s*\d+\)", data_type)
+    if match is not None:
+        # DuckDB stores decimals in the smallest integer type holding the precision
+        precision = int(match.group(1))
+        return next(width for max_precision, width in DECIMAL_WIDTHS if precision <= max_precision)
+
+    return TYPE_WIDTHS.get(data_type)
+
+
+def _extraction_sql(access_query: dict) -> str:
+    """
+    Extract the field from `raw_json` as done by unmaterialized queries
+    """
+    if access_query["type"] == "VARCHAR":
+        return f"({access_query['access']})"
+    return f"TRY_CAST({access_query['access']} AS {access_query['type']})"
+
+
+def _min_time(con: duckdb.DuckDBPyConnection, query: str) -> float:
+    execution_times, _, _ = time_query(
+        con=con, query=query, iterations=CALIBRATION_ITERATIONS)
+    return min(execution_times)
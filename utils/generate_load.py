@@ -97,3 +97,66 @@ def random_distribution(queries: dict[str, Query]):
         })
 
     return load_dicts
+
+
+def shifting_distribution(queries: dict[str, Query]):
+    """
+    Loads like `numerical_distribution`, whose majority queries change halfway through.
+    The majority queries of each load are given as the lists before and after the shift.
+    """
+
+    load_dicts = []
+
+    all_queries = list(queries.keys())
+
+    qm = [(q, int(m*QUERIES_IN_LOAD))
+          for q in QUERY_PROPORTIONS for m in MAJORITY_PROPORTIONS]
+
+    half_load_length = QUERIES_IN_LOAD // 2
+
+    for query_proportion, majority_proportion in qm:
+
+        loads = []
+        majority_queries = []
+
+        for i in range(NO_LOADS):
+            r = random.Random()
+            r.seed(i)
+
+            # Disjoint majority queries before and after the shift
+            shuffled_queries = r.sample(
+                population=all_queries, k=2 * query_proportion)
+            load = []
+            load_majority_queries = []
+            for half, half_length in enumerate([half_load_length, QUERIES_IN_LOAD - half_load_length]):
+                half_majority_queries = shuffled_queries[half *
+                                                         query_proportion:(half + 1) * query_proportion]
+                minority_queries = [
+                    q for q in all_queries if q not in half_majority_queries]
+
+                half_majority_length = int(
+                    majority_proportion * half_length / QUERIES_IN_LOAD)
+                half_load = [r.choice(half_majority_queries)
+                             for _ in range(half_majority_length)]
+                half_load += [r.choice(minority_queries)
+                              for _ in range(half_length - half_majority_length)]
+
+                r.shuffle(half_load)
+
+                load += half_load
+                load_majority_queries.append(
+                    sorted(half_majority_queries, key=lambda x: int(x[1:])))
+
+            loads.append(load)
+            majority_queries.append(load_majority_queries)
+
+            assert len(load) == QUERIES_IN_LOAD
+
+        load_dicts.append({
+            "loads": loads,
+            "query_proportion": query_proportion,
+            "majority_proportion": majority_proportion,
+            "majority_queries": majority_queries
+        })
+
+    return load_dicts
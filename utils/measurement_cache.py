@@ -0,0 +1,291 @@
+import hashlib
+import time
+from datetime import datetime, timedelta
+
+import duckdb  # type: ignore
+
+from utils.prepare_database import ALTER_UPDATE
+from utils.query_timing import stopping_rule, DIRECT_EXECUTION
+
+
+# Measurements shared by every harness and run
+MEASUREMENT_CACHE_PATH = "./results/measurements.duckdb"
+MEASUREMENT_TABLE = "measurements"
+
+# Harnesses running in parallel processes take turns holding the cache file
+LOCK_RETRIES = 100
+LOCK_RETRY_DELAY = 0.05
+# New measurements are written to the cache file in batches of this size
+FLUSH_SIZE = 20
+
+KEY_COLUMNS = ["dataset", "scale_factor", "query_hash", "materialization",
+               "duckdb_version", "setup", "mode", "fetched", "iterations", "stopping_rule"]
+
+
+class MeasurementCache:
+    """
+    Execution times of queries, persisted across runs and harnesses
+
+    A measurement is keyed by the dataset, its scale factor, the hash of the query text,
+    the materialized fields, the DuckDB version, the setup the query ran in (see
+    `measurement_setup`), and how the query was timed. Changing a
+    query, or upgrading DuckDB, therefore invalidates its measurements. Adaptively repeated
+    measurements are also keyed by the parameters of the stopping rule, see
+    `utils.query_timing.stopping_rule`. Measurements older than `max_age` are measured
+    again.
+
+    The measurements of the current DuckDB version are read once, when the cache is
+    created, and new measurements are written in batches of `FLUSH_SIZE`. Call `flush`
+    once done.
+    """
+
+    def __init__(self, path: str = MEASUREMENT_CACHE_PATH, max_age: timedelta | None = None, force: bool = False):
+        """
+        Parameters
+        ----------
+        path : str
+            The DuckDB file of the cache, created if missing
+        max_age : timedelta | None
+            Ignore measurements older than this. If None, measurements never expire
+        force : bool
+            Ignore every stored measurement, so each query is measured again. The new
+            measurements replace the stored ones
+        """
+        self.path = path
+        self.max_age = max_age
+        self.force = force
+        self.duckdb_version = duckdb.__version__
+
+        self.hits = 0
+        self.misses = 0
+
+        with self._connect() as con:
+            # Drop caches written before a column was part of the key
+            columns = [row[0] for row in con.execute(
+                "SELECT column_name FROM duckdb_columns() WHERE table_name = ?", [MEASUREMENT_TABLE]).fetchall()]
+            if len(columns) > 0 and not set(KEY_COLUMNS) <= set(columns):
+                con.execute(f"DROP TABLE {MEASUREMENT_TABLE}")
+            con.execute(f"""
+                CREATE TABLE IF NOT EXISTS {MEASUREMENT_TABLE} (
+                    dataset VARCHAR,
+                    scale_factor VARCHAR,
+                    query_hash VARCHAR,
+                    materialization VARCHAR,
+                    duckdb_version VARCHAR,
+                    setup VARCHAR,
+                    mode VARCHAR,
+                    fetched BOOLEAN,
+                    iterations INTEGER,
+                    stopping_rule VARCHAR,
+                    execution_times DOUBLE[],
+                    planning_time DOUBLE,
+                    measured_at TIMESTAMP,
+                    PRIMARY KEY ({", ".join(KEY_COLUMNS)})
+                )
+            """)
+            rows = con.execute(f"""
+                SELECT {", ".join(KEY_COLUMNS)}, execution_times, planning_time, measured_at
+                FROM {MEASUREMENT_TABLE} WHERE duckdb_version = ?
+            """, [self.duckdb_version]).fetchall()
+
+        # Measurements by key, and the measurements not written to the file yet
+        self._measurements: dict[tuple, tuple[list[float], float | None, datetime]] = {
+            tuple(row[:len(KEY_COLUMNS)]): (list(row[-3]), row[-2], row[-1]) for row in rows}
+        self._pending: list[tuple] = []
+
+    def get(
+            self,
+            dataset: str,
+            scale_factor: str | float,
+            query: str,
+            materialization: list[str] | set[str],
+            iterations: int,
+            mode: str = DIRECT_EXECUTION,
+            fetch: bool = False,
+            setup: str | None = None,
+    ) -> tuple[list[float], float | None] | None:
+        """
+        Get the stored measurement of the query, as timed by `utils.query_timing.time_query`
+
+        Parameters
+        ----------
+        dataset : str
+            The dataset the query ran on
+        scale_factor : str | float
+            The scale factor of the data, or the size of the backup it was imported from
+        query : str
+            The query text
+        materialization : list[str] | set[str]
+            The materialized fields of the database
+        iterations : int
+            The number of timed executions
+        mode : str
+            The execution mode, see `utils.query_timing`
+        fetch : bool
+            Whether the result of each execution was fetched as part of its timing
+        setup : str | None
+            The setup the query ran in, see `measurement_setup`. Defaults to the default
+            setup
+
+        Returns
+        -------
+        tuple[list[float], float | None] | None
+            The execution times and the planning time, or None if there is no fresh
+            measurement
+        """
+        measurement = None
+        if not self.force:
+            measurement = self._measurements.get(self._key(
+                dataset=dataset, scale_factor=scale_factor, query=query, materialization=materialization,
+                iterations=iterations, mode=mode, fetch=fetch, setup=setup))
+
+        if measurement is None or (self.max_age is not None and datetime.now() - measurement[2] > self.max_age):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return list(measurement[0]), measurement[1]
+
+    def put(
+            self,
+            dataset: str,
+            scale_factor: str | float,
+            query: str,
+            materialization: list[str] | set[str],
+            execution_times: list[float],
+            planning_time: float | None,
+            mode: str = DIRECT_EXECUTION,
+            fetch: bool = False,
+            iterations: int | None = None,
+            setup: str | None = None,
+    ):
+        """
+        Store the measurement of the query, replacing any stored measurement of it.
+        `iterations` is the number of executions requested, e.g.
+        `utils.query_timing.ADAPTIVE_ITERATIONS`, if not the number of execution times.
+        `setup` is as in `get`.
+        """
+        if iterations is None:
+            iterations = len(execution_times)
+        key = self._key(dataset=dataset, scale_factor=scale_factor, query=query, materialization=materialization,
+                        iterations=iterations, mode=mode, fetch=fetch, setup=setup)
+        measurement = (list(execution_times), planning_time, datetime.now())
+        self._measurements[key] = measurement
+        self._pending.append(key + measurement)
+
+        if len(self._pending) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the new measurements to the cache file
+        """
+        if len(self._pending) == 0:
+            return
+
+        with self._connect() as con:
+            con.executemany(f"""
+                INSERT OR REPLACE INTO {MEASUREMENT_TABLE}
+                VALUES ({", ".join("?" * (len(KEY_COLUMNS) + 3))})
+            """, self._pending)
+        self._pending = []
+
+    def invalidate(self, dataset: str | None = None, scale_factor: str | float | None = None) -> int:
+        """
+        Delete the stored measurements of the dataset and scale factor, or of every
+        dataset and scale factor if None
+
+        Returns
+        -------
+        int
+            The number of measurements deleted
+        """
+        self.flush()
+
+        conditions, parameters = [], []
+        if dataset is not None:
+            conditions.append("dataset = ?")
+            parameters.append(dataset)
+        if scale_factor is not None:
+            conditions.append("scale_factor = ?")
+            parameters.append(str(scale_factor))
+        where = f" WHERE {' AND '.join(conditions)}" if len(
+            conditions) > 0 else ""
+
+        with self._connect() as con:
+            no_deleted = con.execute(
+                f"SELECT count(*) FROM {MEASUREMENT_TABLE}{where}", parameters).fetchone()[0]
+            con.execute(f"DELETE FROM {MEASUREMENT_TABLE}{where}", parameters)
+
+        self._measurements = {
+            key: measurement for key, measurement in self._measurements.items()
+            if (dataset is not None and key[0] != dataset)
+            or (scale_factor is not None and key[1] != str(scale_factor))
+        }
+        return no_deleted
+
+    def _key(
+            self,
+            dataset: str,
+            scale_factor: str | float,
+            query: str,
+            materialization: list[str] | set[str],
+            iterations: int,
+            mode: str,
+            fetch: bool,
+            setup: str | None,
+    ) -> tuple:
+        """
+        The values of `KEY_COLUMNS` of a measurement
+        """
+        return (
+            dataset,
+            str(scale_factor),
+            hashlib.sha256(query.encode()).hexdigest(),
+            ",".join(sorted(materialization)),
+            self.duckdb_version,
+            measurement_setup() if setup is None else setup,
+            mode,
+            fetch,
+            iterations,
+            stopping_rule(iterations=iterations),
+        )
+
+    def _connect(self) -> duckdb.DuckDBPyConnection:
+        """
+        Connect to the cache file, waiting for other processes holding it
+        """
+        for _ in range(LOCK_RETRIES):
+            try:
+                return duckdb.connect(self.path)
+            except duckdb.IOException:
+                time.sleep(LOCK_RETRY_DELAY)
+        return duckdb.connect(self.path)
+
+
+def measurement_setup(
+        in_memory: bool = False,
+        strategy: str = ALTER_UPDATE,
+        threads: int | None = None,
+        pinned: bool = False,
+        workers: int = 1,
+) -> str:
+    """
+    The setup a query ran in, besides its dataset and materialization, as part of the key
+    of its measurement, so measurements of different setups are not mixed
+
+    Parameters
+    ----------
+    in_memory : bool
+        Whether the database was an in-memory snapshot, see `utils.snapshot.import_in_memory`
+    strategy : str
+        The materialization strategy, see `utils.prepare_database`, as it determines the
+        physical layout of the table
+    threads : int | None
+        The DuckDB threads of the connection, or None for DuckDB's default
+    pinned : bool
+        Whether the process was pinned to a set of CPUs
+    workers : int
+        The number of processes running queries at the same time
+    """
+    return f"in_memory={in_memory},strategy={strategy},threads={threads},pinned={pinned},workers={workers}"
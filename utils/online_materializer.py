@@ -0,0 +1,242 @@
+import threading
+import time
+
+import duckdb  # type: ignore
+import numpy as np
+import pandas as pd
+
+from queries.field_spec import FieldSpec
+from queries.query import Query
+from utils.advisor import time_saved_matrix
+from utils.prepare_database import prepare_database
+from utils.snapshot import paused
+from utils.usage_matrix import get_query_usage_matrix
+from utils.workload_stats import WorkloadStats
+
+
+# Number of observed queries after which a query's contribution to the benefit
+# counters has halved
+HALF_LIFE = 50
+# Number of upcoming queries the current benefit rate is projected over
+HORIZON = 100
+# Observed queries between decisions
+CHECK_INTERVAL = 10
+# Materialized fields are dropped once their projected savings fall below this share
+# of their backfill cost, so fields close to the threshold are not repeatedly rebuilt
+DEMATERIALIZE_RATIO = 0.25
+# Weight of each observed backfill in the correction of the backfill cost estimates
+BACKFILL_CORRECTION_WEIGHT = 0.5
+
+# Actions
+MATERIALIZE = "materialize"
+DEMATERIALIZE = "dematerialize"
+
+ACTION_COLUMNS = ["Query no", "Action", "Fields",
+                  "Projected savings", "Estimated cost", "Time taken"]
+
+
+class OnlineMaterializer:
+    """
+    Adapt the materialization of the database to a live stream of executed queries
+
+    Each observed query adds its estimated time saved to decayed per-field workload
+    statistics. Every `CHECK_INTERVAL` queries, the fields whose savings projected over
+    the next `HORIZON` queries exceed their backfill cost are materialized, and
+    materialized fields whose projected savings fell below `DEMATERIALIZE_RATIO` of it
+    are dropped.
+    """
+
+    def __init__(
+            self,
+            con: duckdb.DuckDBPyConnection,
+            queries: dict[str, Query],
+            column_map: dict,
+            costs: pd.DataFrame,
+            background: bool = False,
+            max_fields: int | None = None,
+    ):
+        """
+        Parameters
+        ----------
+        con : duckdb.DuckDBPyConnection
+            Connection to the database to materialize
+        queries : dict[str, Query]
+            The queries of the dataset, by name
+        column_map : dict
+            The column map of the dataset
+        costs : pd.DataFrame
+            The costs calibrated by `utils.advisor.calibrate`
+        background : bool
+            Materialize in a background thread, so `observe` does not wait for backfills.
+            Hold `lock` while generating and executing queries on `con`, as the
+            materialization is only changed while it is held.
+        max_fields : int | None
+            The maximum number of fields materialized at once
+        """
+        self.con = con
+        self.queries = queries
+        self.column_map = column_map
+        self.costs = costs
+        self.background = background
+        self.max_fields = max_fields
+
+        self.decay = 0.5 ** (1 / HALF_LIFE)
+        # Decayed time saved by each field, from the time saved by each query
+        field_names = list(column_map.keys())
+        usage = get_query_usage_matrix(queries=queries)
+        usage_savings = time_saved_matrix(costs=costs, usage=usage)
+        query_savings = np.zeros((len(usage.query_names), len(field_names)))
+        for i, field in enumerate(field_names):
+            if field in usage.field_index and field in costs.index:
+                query_savings[:, i] = usage_savings[:, usage.field_index[field]]
+        self.stats = WorkloadStats(
+            query_names=usage.query_names,
+            field_names=field_names,
+            matrix=query_savings,
+            decay=self.decay,
+        )
+        self.materialized: frozenset[str] = frozenset()
+        self.field_spec = self._field_spec(materialized=self.materialized)
+
+        # Backfill cost of each field, as its extraction from every row, corrected by
+        # the backfill times observed
+        no_rows = (costs["Rows"] / costs["Row fraction"]).max()
+        self.estimated_backfill_costs = {
+            field: no_rows * costs.at[field, "Extraction cost"] for field in column_map}
+        self.backfill_correction = 1.0
+
+        self.no_observed = 0
+        self.actions: list[dict] = []
+        # Total time spent changing the materialization
+        self.time_taken = 0.0
+        self.lock = threading.Lock()
+        self._worker: threading.Thread | None = None
+
+    def observe(self, query_name: str, runtime: float):
+        """
+        Record an executed query, and adapt the materialization every `CHECK_INTERVAL`
+        queries
+
+        Parameters
+        ----------
+        query_name : str
+            The name of the executed query
+        runtime : float
+            The execution time of the query, in seconds
+        """
+        savings = self.stats.query_field_weights(query_name=query_name)
+
+        # The unmaterialized fields cannot save more than the query took, so scale
+        # down overestimated savings
+        unmaterialized_savings = sum(saving for field, saving in zip(self.stats.field_names, savings)
+                                     if field not in self.materialized)
+        scale = min(1.0, runtime / unmaterialized_savings) \
+            if unmaterialized_savings > 0 else 1.0
+        self.stats.observe(query_name=query_name, weight=scale)
+
+        self.no_observed += 1
+        if self.no_observed % CHECK_INTERVAL == 0:
+            self.adapt()
+
+    def projected_savings(self, field: str) -> float:
+        """
+        The time the field is projected to save over the next `HORIZON` queries
+        """
+        # In a steady workload, the decayed savings are the savings per query / (1 - decay)
+        return self.stats.field_weight(field) * (1 - self.decay) * HORIZON
+
+    def all_projected_savings(self) -> dict[str, float]:
+        """
+        The time each field is projected to save over the next `HORIZON` queries
+        """
+        return dict(zip(self.stats.field_names, self.stats.field_weights() * (1 - self.decay) * HORIZON))
+
+    def backfill_cost(self, field: str) -> float:
+        """
+        The estimated time taken to materialize the field
+        """
+        return self.estimated_backfill_costs[field] * self.backfill_correction
+
+    def adapt(self):
+        """
+        Materialize the fields worth their backfill, and drop the fields no longer worth
+        keeping. Runs in the background if `background`, unless a change is in progress.
+        """
+        if self._worker is not None and self._worker.is_alive():
+            return
+
+        if not self.background:
+            self._adapt()
+            return
+
+        self._worker = threading.Thread(target=self._adapt, daemon=True)
+        self._worker.start()
+
+    def wait(self):
+        """
+        Wait for the materialization in progress, if any
+        """
+        if self._worker is not None:
+            self._worker.join()
+
+    def _adapt(self):
+        query_no = self.no_observed
+        projected_savings = self.all_projected_savings()
+        to_drop = {field for field in self.materialized
+                   if projected_savings[field] < DEMATERIALIZE_RATIO * self.backfill_cost(field)}
+
+        kept = self.materialized - to_drop
+        candidates = sorted(
+            (field for field in self.column_map if field not in kept
+             and projected_savings[field] > self.backfill_cost(field)),
+            key=lambda field: projected_savings[field] -
+            self.backfill_cost(field),
+            reverse=True)
+        if self.max_fields is not None:
+            candidates = candidates[:max(self.max_fields - len(kept), 0)]
+        to_add = set(candidates)
+
+        if len(to_drop) == 0 and len(to_add) == 0:
+            return
+
+        materialized = frozenset(kept | to_add)
+        field_spec = self._field_spec(materialized=materialized)
+        estimated_cost = sum(self.backfill_cost(field) for field in to_add)
+
+        # DuckDB cannot checkpoint the altered table while other connections write, so
+        # the connection is shared, and queries wait for the change to complete
+        # Without background copies of databases competing for I/O
+        with self.lock, paused():
+            start_time = time.perf_counter()
+            prepare_database(con=self.con, fields=self._fields(
+                materialized=materialized), include_print=False)
+            time_taken = time.perf_counter() - start_time
+            self.time_taken += time_taken
+
+            self.materialized = materialized
+            self.field_spec = field_spec
+
+        if len(to_add) > 0 and estimated_cost > 0:
+            observed_correction = time_taken / \
+                (estimated_cost / self.backfill_correction)
+            self.backfill_correction += BACKFILL_CORRECTION_WEIGHT * \
+                (observed_correction - self.backfill_correction)
+
+        for action, action_fields in ((DEMATERIALIZE, to_drop), (MATERIALIZE, to_add)):
+            if len(action_fields) == 0:
+                continue
+            self.actions.append({
+                "Query no": query_no,
+                "Action": action,
+                "Fields": sorted(action_fields),
+                "Projected savings": sum(projected_savings[field] for field in action_fields),
+                "Estimated cost": sum(self.backfill_cost(field) for field in action_fields),
+                "Time taken": time_taken,
+            })
+
+    def _fields(self, materialized: frozenset[str]) -> list[tuple[str, dict, bool]]:
+        return [(field, access_query, field in materialized)
+                for field, access_query in self.column_map.items()]
+
+    def _field_spec(self, materialized: frozenset[str]) -> FieldSpec:
+        return FieldSpec(self._fields(materialized=materialized))
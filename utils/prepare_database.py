@@ -1,36 +1,131 @@
 # pylint: disable=E0401
 import os
 import time
+from collections import defaultdict
 import duckdb  # type: ignore
 
 
-def prepare_database(con: duckdb.DuckDBPyConnection, fields: list[tuple[str, dict, bool]], include_print: bool = True) -> float:
+# Table used to track the progress of chunked backfills, making them resumable
+PROGRESS_TABLE = "materialization_progress"
+# Default number of rows per backfill chunk (one DuckDB row group)
+DEFAULT_CHUNK_SIZE = 122880
+
+# Materialization strategies
+# Add the new columns, and populate them through an UPDATE joined on rowid
+ALTER_UPDATE = "alter_update"
+# Rebuild the table with CREATE TABLE AS SELECT, and swap it with the original
+CTAS_SWAP = "ctas_swap"
+STRATEGIES = [ALTER_UPDATE, CTAS_SWAP]
+
+
+def prepare_database(
+        con: duckdb.DuckDBPyConnection,
+        fields: list[tuple[str, dict, bool]],
+        include_print: bool = True,
+        chunk_size: int | None = None,
+        strategy: str = ALTER_UPDATE
+) -> float:
     # def prepare_database(con: duckdb.DuckDBPyConnection, fields: dict[str, bool]):
     """
     Prepare the database by materializing the correct fields and creating the view
 
+    Only the difference between the current physical schema and the requested
+    materialization is applied: stale columns are dropped, and only newly
+    materialized fields are extracted from `raw_json`.
+
     Parameters
     ----------
     con : duckdb.DuckDBPyConnection
         DuckDB connection
     fields : list[tuple[str, dict, bool]]
         List of tuples of field name, json extraction query, and materialized status
+    include_print : bool
+        Print progress information
+    chunk_size : int | None
+        If set, backfill new columns in rowid ranges of `chunk_size` rows, committing
+        after each chunk. If None, backfill in a single transaction.
+        An interrupted chunked backfill is always resumed, in chunks of `chunk_size`
+        rows, or of the chunk size it was started with if None.
+    strategy : str
+        `ALTER_UPDATE` adds the new columns and populates them with an UPDATE.
+        `CTAS_SWAP` rebuilds the table with the new columns in a single pass, and
+        replaces the original table. Does not support `chunk_size`.
+
+    Returns
+    -------
+    float
+        Time taken to materialize the newly added fields
     """
-    time_taken = _alter_table(con=con, fields=fields,
-                              include_print=include_print)
+    if strategy not in STRATEGIES:
+        raise ValueError(f"No such materialization strategy {strategy}")
+    if strategy == CTAS_SWAP and chunk_size is not None:
+        raise ValueError(f"Strategy {CTAS_SWAP} does not support chunk_size")
+
+    fields_to_drop, fields_to_add = _get_materialization_delta(
+        con=con, fields=fields)
+
+    # Dropped fields no longer need to be backfilled
+    _clear_backfill_progress(con=con, fields=fields_to_drop)
+
+    # Resume any backfill interrupted by a crash
+    resumed = _has_progress_table(con=con)
+    time_taken = _resume_backfill(
+        con=con, fields=fields, chunk_size=chunk_size, include_print=include_print)
+
+    if strategy == CTAS_SWAP:
+        time_taken += _rebuild_table(
+            con=con,
+            fields_to_drop=fields_to_drop,
+            fields_to_add=fields_to_add,
+            include_print=include_print
+        )
+    elif chunk_size is None:
+        _drop_columns(con=con, fields=fields_to_drop)
+        time_taken += _alter_table(con=con, fields=fields_to_add,
+                                   include_print=include_print)
+    else:
+        _drop_columns(con=con, fields=fields_to_drop)
+        time_taken += _alter_table_chunked(
+            con=con,
+            fields=fields_to_add,
+            chunk_size=chunk_size,
+            include_print=include_print
+        )
 
     # _create_view(con=con, fields=fields)
 
-    con.execute("ANALYZE;")
+    # Statistics only change if the schema or the data changed
+    if resumed or len(fields_to_drop) > 0 or len(fields_to_add) > 0:
+        con.execute("ANALYZE;")
     return time_taken
 
 
-def _alter_table(con: duckdb.DuckDBPyConnection, fields: list[tuple[str, dict, bool]], include_print: bool = True) -> float:
+def get_materialized_fields(con: duckdb.DuckDBPyConnection, fields: list[tuple[str, dict, bool]]) -> set[str]:
+    """
+    Get the fields that are currently materialized as physical columns of `test_table`
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        DuckDB connection
+    fields : list[tuple[str, dict, bool]]
+        List of tuples of field name, json extraction query, and materialized status
+
+    Returns
+    -------
+    set[str]
+        Names of the fields that exist as columns in `test_table`
     """
-    Alter the table for the given field
+    field_names = {field for field, _, _ in fields}
+    columns = con.execute("DESCRIBE test_table;").fetchall()
 
-    If the field should be materialized, and does not exist, create it.
-    If the field should not be materialized but is present, drop column
+    # DESCRIBE returns (column_name, column_type, null, key, default, extra)
+    return {column[0] for column in columns if column[0] in field_names}
+
+
+def _get_materialization_delta(con: duckdb.DuckDBPyConnection, fields: list[tuple[str, dict, bool]]) -> tuple[list[str], dict[str, str]]:
+    """
+    Compare the requested materialization with the current physical schema
 
     Parameters
     ----------
@@ -39,6 +134,51 @@ def _alter_table(con: duckdb.DuckDBPyConnection, fields: list[tuple[str, dict, b
     fields : list[tuple[str, dict, bool]]
         List of tuples of field name, json extraction query, and materialized status
 
+    Returns
+    -------
+    tuple[list[str], dict[str, str]]
+        (fields to drop, fields to add mapped to their data type)
+    """
+    materialized_fields = get_materialized_fields(con=con, fields=fields)
+
+    fields_to_drop = []
+    fields_to_add = {}
+
+    for field, query, materialize in fields:
+        if materialize and field not in materialized_fields:
+            fields_to_add[field] = query['type']
+        elif not materialize and field in materialized_fields:
+            fields_to_drop.append(field)
+
+    return fields_to_drop, fields_to_add
+
+
+def _drop_columns(con: duckdb.DuckDBPyConnection, fields: list[str]):
+    """
+    Drop the columns of fields that should no longer be materialized
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        DuckDB connection
+    fields : list[str]
+        Names of the fields to drop
+    """
+    for field in fields:
+        con.execute(f"ALTER TABLE test_table DROP COLUMN IF EXISTS {field};")
+
+
+def _alter_table(con: duckdb.DuckDBPyConnection, fields: dict[str, str], include_print: bool = True) -> float:
+    """
+    Alter the table by adding and populating columns for the given fields
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        DuckDB connection
+    fields : dict[str, str]
+        Fields to materialize, mapped to their data type
+
     Returns
     -------
     time_taken : float
@@ -47,46 +187,367 @@ def _alter_table(con: duckdb.DuckDBPyConnection, fields: list[tuple[str, dict, b
 
     time_taken = 0
 
-    materialized = False
-    all_materialized = True
-    materialize_fields = {}
-    col_types = {}
+    # Do nothing if not fields to materialize
+    if len(fields.keys()) == 0:
+        if include_print:
+            print("No new fields to materialize.")
+        return time_taken
 
-    for field, query, materialize in fields:
-        # Drop column if it exists
-        con.execute(f"ALTER TABLE test_table DROP COLUMN IF EXISTS {field};")
+    full_sql = "BEGIN TRANSACTION; " + _add_columns_sql(fields=fields) + \
+        _update_sql(fields=fields) + "END TRANSACTION;"
 
-        if materialize:
-            materialize_fields[field] = query['type']
-            col_types[field] = query['type']
+    start_time = time.perf_counter()
 
-        materialized |= materialize
-        all_materialized &= materialize
+    con.execute(full_sql)
+    end_time = time.perf_counter()
+    time_taken = end_time - start_time
 
-    # Do nothing if not fields to materialize
-    if len(materialize_fields.keys()) == 0:
+    con.execute("CHECKPOINT;")
+
+    return time_taken
+
+
+def _rebuild_table(
+        con: duckdb.DuckDBPyConnection,
+        fields_to_drop: list[str],
+        fields_to_add: dict[str, str],
+        include_print: bool = True
+) -> float:
+    """
+    Rebuild the table with CREATE TABLE AS SELECT, keeping all current columns except
+    `fields_to_drop` and extracting `fields_to_add` from `raw_json`, then swap it in
+    for the original table
+
+    Rows are written in rowid order, as DuckDB preserves insertion order
+    (`preserve_insertion_order` is enabled by default).
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        DuckDB connection
+    fields_to_drop : list[str]
+        Names of the fields to drop
+    fields_to_add : dict[str, str]
+        Fields to materialize, mapped to their data type
+    include_print : bool
+        Print progress information
+
+    Returns
+    -------
+    time_taken : float
+        Time taken to rebuild the table
+    """
+
+    time_taken = 0
+
+    if len(fields_to_drop) == 0 and len(fields_to_add.keys()) == 0:
         if include_print:
-            print("No fields to materialize.")
+            print("No new fields to materialize.")
         return time_taken
 
-    # Build ALTER statements
+    # DESCRIBE returns (column_name, column_type, null, key, default, extra)
+    columns = [column[0] for column in con.execute(
+        "DESCRIBE test_table;").fetchall() if column[0] not in fields_to_drop]
+
+    select_parts = columns + [
+        f"extracted.json_arr[{idx}]::{data_type} AS {field}"
+        for idx, (field, data_type) in enumerate(fields_to_add.items(), start=1)
+    ]
+
+    extract_sql = ""
+    if len(fields_to_add.keys()) > 0:
+        extract_sql = f", {_extract_sql(fields=fields_to_add)} AS json_arr"
+
+    full_sql = f"""
+    BEGIN TRANSACTION;
+    CREATE TABLE test_table_new AS
+        SELECT {', '.join(select_parts)}
+        FROM (
+            SELECT *{extract_sql}
+            FROM test_table
+        ) AS extracted;
+    DROP TABLE test_table;
+    ALTER TABLE test_table_new RENAME TO test_table;
+    COMMIT;
+    """
+
+    start_time = time.perf_counter()
+
+    con.execute(full_sql)
+    end_time = time.perf_counter()
+    time_taken = end_time - start_time
+
+    # Release the blocks of the original table
+    con.execute("CHECKPOINT;")
+
+    return time_taken
+
+
+def _alter_table_chunked(
+        con: duckdb.DuckDBPyConnection,
+        fields: dict[str, str],
+        chunk_size: int,
+        include_print: bool = True
+) -> float:
+    """
+    Alter the table by adding columns for the given fields, and populate them
+    in rowid ranges of `chunk_size` rows, committing after each chunk
+
+    The progress is stored in `PROGRESS_TABLE`, so an interrupted backfill can be
+    resumed by `_resume_backfill`.
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        DuckDB connection
+    fields : dict[str, str]
+        Fields to materialize, mapped to their data type
+    chunk_size : int
+        Number of rows to backfill per transaction
+    include_print : bool
+        Print progress information
+
+    Returns
+    -------
+    time_taken : float
+        Time taken to alter table (not including dropping columns)
+    """
+    if len(fields.keys()) == 0:
+        if include_print:
+            print("No new fields to materialize.")
+        return 0
+
+    assert chunk_size > 0
+
+    progress_values = ", ".join(
+        f"('{field}', 0, {chunk_size})" for field in fields.keys())
+
+    start_time = time.perf_counter()
+
+    # Register the backfill in the same transaction as the new columns
+    con.execute(
+        "BEGIN TRANSACTION; "
+        + f"CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (field VARCHAR PRIMARY KEY, next_rowid BIGINT, chunk_size BIGINT);"
+        # Progress tables created before the chunk size was stored
+        + f"ALTER TABLE {PROGRESS_TABLE} ADD COLUMN IF NOT EXISTS chunk_size BIGINT;"
+        + _add_columns_sql(fields=fields)
+        + f"INSERT INTO {PROGRESS_TABLE} VALUES {progress_values};"
+        + "COMMIT;"
+    )
+    time_taken = time.perf_counter() - start_time
+
+    time_taken += _backfill(
+        con=con,
+        fields=fields,
+        start_rowid=0,
+        chunk_size=chunk_size,
+        include_print=include_print
+    )
+
+    return time_taken
+
+
+def _resume_backfill(
+        con: duckdb.DuckDBPyConnection,
+        fields: list[tuple[str, dict, bool]],
+        chunk_size: int | None = None,
+        include_print: bool = True
+) -> float:
+    """
+    Resume chunked backfills that were interrupted before completion
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        DuckDB connection
+    fields : list[tuple[str, dict, bool]]
+        List of tuples of field name, json extraction query, and materialized status
+    chunk_size : int | None
+        Number of rows to backfill per transaction. If None, the chunk size each
+        backfill was started with, or `DEFAULT_CHUNK_SIZE` if it was not stored
+    include_print : bool
+        Print progress information
+
+    Returns
+    -------
+    time_taken : float
+        Time taken to complete the backfills
+    """
+    time_taken = 0
+
+    if not _has_progress_table(con=con):
+        return time_taken
+
+    # Progress tables created before the chunk size was stored
+    con.execute(
+        f"ALTER TABLE {PROGRESS_TABLE} ADD COLUMN IF NOT EXISTS chunk_size BIGINT;")
+    pending = con.execute(
+        f"SELECT field, next_rowid, chunk_size FROM {PROGRESS_TABLE};").fetchall()
+    data_types = {field: query['type'] for field, query, _ in fields}
+
+    # Fields added together share their progress, so backfill them together
+    pending_by_progress = defaultdict(dict)
+    for field, next_rowid, stored_chunk_size in pending:
+        if field in data_types:
+            pending_by_progress[(next_rowid, stored_chunk_size)][field] = data_types[field]
+
+    for (next_rowid, stored_chunk_size), pending_fields in pending_by_progress.items():
+        resume_chunk_size = chunk_size
+        if resume_chunk_size is None:
+            resume_chunk_size = stored_chunk_size if stored_chunk_size is not None else DEFAULT_CHUNK_SIZE
+        if include_print:
+            print(
+                f"Resuming backfill of {list(pending_fields.keys())} from rowid {next_rowid}")
+        time_taken += _backfill(
+            con=con,
+            fields=pending_fields,
+            start_rowid=next_rowid,
+            chunk_size=resume_chunk_size,
+            include_print=include_print
+        )
+
+    return time_taken
+
+
+def _backfill(
+        con: duckdb.DuckDBPyConnection,
+        fields: dict[str, str],
+        start_rowid: int,
+        chunk_size: int,
+        include_print: bool = True
+) -> float:
+    """
+    Populate existing columns from `raw_json`, one rowid range per transaction
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        DuckDB connection
+    fields : dict[str, str]
+        Fields to backfill, mapped to their data type
+    start_rowid : int
+        First rowid to backfill
+    chunk_size : int
+        Number of rows to backfill per transaction
+    include_print : bool
+        Print progress information
+
+    Returns
+    -------
+    time_taken : float
+        Time taken to backfill the columns
+    """
+    time_taken = 0
+
+    max_rowid = con.execute("SELECT MAX(rowid) FROM test_table;").fetchone()[0]
+    if max_rowid is None:
+        max_rowid = -1
+
+    stringified_fields = ", ".join(f"'{field}'" for field in fields.keys())
+    last_reported = -1
+
+    for chunk_start in range(start_rowid, max_rowid + 1, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, max_rowid + 1) - 1
+
+        chunk_sql = "BEGIN TRANSACTION; " + \
+            _update_sql(fields=fields, rowid_range=(chunk_start, chunk_end)) + \
+            f"""UPDATE {PROGRESS_TABLE} SET next_rowid = {chunk_end + 1}
+            WHERE field IN ({stringified_fields});""" + \
+            "COMMIT;"
+
+        start_time = time.perf_counter()
+        con.execute(chunk_sql)
+        time_taken += time.perf_counter() - start_time
+
+        # Report progress for every 10% backfilled
+        progress = int(10 * (chunk_end + 1) / (max_rowid + 1))
+        if include_print and progress > last_reported:
+            print(
+                f"Backfilled {chunk_end + 1}/{max_rowid + 1} rows ({time_taken:.2f}s)")
+            last_reported = progress
+
+    _clear_backfill_progress(con=con, fields=list(fields.keys()))
+
+    con.execute("CHECKPOINT;")
+
+    return time_taken
+
+
+def _has_progress_table(con: duckdb.DuckDBPyConnection) -> bool:
+    return con.execute(
+        f"""
+        SELECT COUNT(*) FROM duckdb_tables()
+        WHERE database_name = current_database() AND table_name = '{PROGRESS_TABLE}';
+        """).fetchone()[0] > 0
+
+
+def _clear_backfill_progress(con: duckdb.DuckDBPyConnection, fields: list[str]):
+    """
+    Remove the backfill progress of the fields, and the progress table once empty
+    """
+    if len(fields) == 0 or not _has_progress_table(con=con):
+        return
+
+    stringified_fields = ", ".join(f"'{field}'" for field in fields)
+    con.execute(
+        f"DELETE FROM {PROGRESS_TABLE} WHERE field IN ({stringified_fields});")
+
+    if con.execute(f"SELECT COUNT(*) FROM {PROGRESS_TABLE};").fetchone()[0] == 0:
+        con.execute(f"DROP TABLE {PROGRESS_TABLE};")
+
+
+def _add_columns_sql(fields: dict[str, str]) -> str:
+    """
+    Build the ALTER statements adding a column for each of the fields
+    """
     alter_parts = []
-    for field in materialize_fields.keys():
+    for field, data_type in fields.items():
         alter_parts.append(
-            f"ALTER TABLE test_table ADD COLUMN {field} {col_types[field]};"
+            f"ALTER TABLE test_table ADD COLUMN {field} {data_type};"
         )
-    alter_sql = "\n".join(alter_parts)
+    return "\n".join(alter_parts)
+
+
+def _extract_sql(fields: dict[str, str]) -> str:
+    """
+    Build the expression extracting all of the fields from `raw_json` in a single parse
+    """
+    stringified_fields = [f"'{field}'" for field in fields.keys()]
+    return f"json_extract_string(raw_json, [{', '.join(stringified_fields)}])"
+
+
+def _update_sql(fields: dict[str, str], rowid_range: tuple[int, int] | None = None) -> str:
+    """
+    Build the UPDATE statement populating the fields from `raw_json`
+
+    Parameters
+    ----------
+    fields : dict[str, str]
+        Fields to populate, mapped to their data type
+    rowid_range : tuple[int, int] | None
+        Inclusive range of rowids to populate. If None, populate all rows
+
+    Returns
+    -------
+    str
+    """
+    rowid_filter = ""
+    target_filter = ""
+    if rowid_range is not None:
+        rowid_filter = f"WHERE rowid BETWEEN {rowid_range[0]} AND {rowid_range[1]}"
+        # Bound the rows of the target as well, so each chunk does not scan the table
+        target_filter = f"AND test_table.rowid BETWEEN {rowid_range[0]} AND {rowid_range[1]}"
 
-    stringified_fields = [f"'{field}'" for field in materialize_fields.keys()]
     cte_sql = f"""
     WITH extracted AS (
-        SELECT rowid, json_extract_string(raw_json, [{", ".join(stringified_fields)}]) AS json_arr
+        SELECT rowid, {_extract_sql(fields=fields)} AS json_arr
         FROM test_table
+        {rowid_filter}
     )
     """
 
     update_assigns = []
-    for idx, (field, data_type) in enumerate(materialize_fields.items(), start=1):
+    for idx, (field, data_type) in enumerate(fields.items(), start=1):
         update_assigns.append(
             f"{field} = extracted.json_arr[{idx}]::{data_type}")
 
@@ -94,20 +555,10 @@ def _alter_table(con: duckdb.DuckDBPyConnection, fields: list[tuple[str, dict, b
         UPDATE test_table SET
             {', '.join(update_assigns)}
         FROM extracted
-        WHERE test_table.rowid = extracted.rowid;
+        WHERE test_table.rowid = extracted.rowid
+        {target_filter};
     """
-    full_sql = "BEGIN TRANSACTION; " + alter_sql + \
-        cte_sql + update_sql + "END TRANSACTION;"
-
-    start_time = time.perf_counter()
-
-    con.execute(full_sql)
-    end_time = time.perf_counter()
-    time_taken = end_time - start_time
-
-    con.execute("CHECKPOINT;")
-
-    return time_taken
+    return cte_sql + update_sql
 
 
 def _create_view(con: duckdb.DuckDBPyConnection, fields: list[tuple[str, dict, bool]]):
@@ -184,7 +635,9 @@ def get_db_size(con: duckdb.DuckDBPyConnection) -> tuple[int, int, int]:
     tuple[int, int, int]
         (used_blocks, block_size, total_size_in_bytes)
     """
-    result = con.execute("CALL pragma_database_size();").fetchone()
+    # Only the default database, as snapshots may be attached to the same instance
+    result = con.execute(
+        "SELECT * FROM pragma_database_size() WHERE database_name = current_database();").fetchone()
     # database_name(0) database_size(1) block_size(2) total_blocks(3) used_blocks(4) free_blocks(5)...
     block_size = result[2]
     used_blocks = result[4]
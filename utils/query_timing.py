@@ -0,0 +1,274 @@
+import hashlib
+import statistics
+import time
+from math import ceil, comb, log2
+
+import duckdb  # type: ignore
+import pandas as pd
+
+from utils.snapshot import paused
+
+
+# Execution modes
+# Pass the query text to every execution, so each timing includes parsing, binding and planning
+DIRECT_EXECUTION = 'direct'
+# Prepare the query once, and time the executions of the prepared statement
+PREPARED_EXECUTION = 'prepared'
+EXECUTION_MODES = [DIRECT_EXECUTION, PREPARED_EXECUTION]
+
+ITERATIONS = 5
+# Repeat each query until the confidence interval of its median is narrow enough
+ADAPTIVE_ITERATIONS = 0
+# The first execution warms up the caches, and is left out of the statistics
+WARMUP_ITERATIONS = 1
+
+# Adaptive repetition stops once the confidence interval of the median of the executions
+# after the warm-up is narrower than this share of the median
+TARGET_RELATIVE_WIDTH = 0.1
+CONFIDENCE = 0.95
+# Up to `ITERATIONS` executions, the interval is checked at this lower confidence, so
+# stable queries stop before the samples a CONFIDENCE interval needs (6 for 95%). The
+# range of 3 samples covers the median with 75% confidence
+EARLY_CONFIDENCE = 0.75
+# Bounds on the number of executions, including the warm-up. At least the samples an
+# EARLY_CONFIDENCE interval needs, 1 - 2 / 2^n >= EARLY_CONFIDENCE
+MIN_ITERATIONS = WARMUP_ITERATIONS + ceil(log2(2 / (1 - EARLY_CONFIDENCE)))
+MAX_ITERATIONS = 15
+# Adaptive repetition also stops once the executions after the warm-up took this long,
+# in seconds, from MIN_ITERATIONS executions on. Long queries, whose relative noise is
+# small, then run at most `ITERATIONS` times
+MAX_MEASUREMENT_TIME = 0.3
+
+PREPARED_STATEMENT_NAME = "timed_query"
+
+# One row per adaptively repeated query, see `repetition_report`
+REPETITIONS: list[dict] = []
+
+
+def time_query(
+        con: duckdb.DuckDBPyConnection,
+        query: str,
+        iterations: int = ITERATIONS,
+        mode: str = DIRECT_EXECUTION,
+        fetch: bool = False,
+) -> tuple[list[float], float | None, pd.DataFrame | None]:
+    """
+    Execute the query a number of times, and time each execution
+
+    Parameters
+    ----------
+    con : duckdb.DuckDBPyConnection
+        The connection to execute the query on
+    query : str
+        The query to execute
+    iterations : int
+        The number of timed executions. `ADAPTIVE_ITERATIONS` executes the query until
+        `done_iterating`, and records the repetition in `REPETITIONS`
+    mode : str
+        `DIRECT_EXECUTION` executes the query text each time.
+        `PREPARED_EXECUTION` prepares the query once, in the current materialization
+        state, and reuses the prepared statement for the timed executions.
+    fetch : bool
+        Fetch the result of each execution as a dataframe, as part of its timing
+
+    Returns
+    -------
+    tuple[list[float], float | None, pd.DataFrame | None]
+        The execution times, the planning time (only in `PREPARED_EXECUTION`), and
+        the result of the first execution (only if `fetch`)
+    """
+    if mode not in EXECUTION_MODES:
+        raise ValueError(f"No such execution mode {mode}")
+
+    planning_time = None
+    statement = query
+    if mode == PREPARED_EXECUTION:
+        # Parse, bind and plan the query once
+        start_time = time.perf_counter()
+        con.execute(
+            f"PREPARE {PREPARED_STATEMENT_NAME} AS {query.strip().rstrip(';')}")
+        planning_time = time.perf_counter() - start_time
+        statement = f"EXECUTE {PREPARED_STATEMENT_NAME}"
+
+    execution_times = []
+    first_result = None
+    try:
+        # Background copies of databases would compete for I/O with the query
+        with paused():
+            while not done_iterating(execution_times=execution_times, iterations=iterations):
+                start_time = time.perf_counter()
+                if fetch:
+                    result = con.execute(statement).fetchdf()
+                else:
+                    con.execute(statement)
+                execution_times.append(time.perf_counter() - start_time)
+
+                if fetch and len(execution_times) == 1:
+                    first_result = result.copy()
+    finally:
+        if mode == PREPARED_EXECUTION:
+            con.execute(f"DEALLOCATE {PREPARED_STATEMENT_NAME}")
+
+    if iterations == ADAPTIVE_ITERATIONS:
+        record_repetition(execution_times=execution_times)
+
+    return execution_times, planning_time, first_result
+
+
+def done_iterating(execution_times: list[float], iterations: int = ITERATIONS) -> bool:
+    """
+    Whether a query executed with these times has been executed enough times
+
+    With `ADAPTIVE_ITERATIONS`, the query is executed at least `MIN_ITERATIONS` and at
+    most `MAX_ITERATIONS` times, until the confidence interval of the median is narrower
+    than `TARGET_RELATIVE_WIDTH` of the median, at `EARLY_CONFIDENCE` up to `ITERATIONS`
+    executions and at `CONFIDENCE` after, or the executions after the warm-up took
+    `MAX_MEASUREMENT_TIME`.
+    """
+    check_iterations(iterations=iterations)
+
+    no_executions = len(execution_times)
+    if iterations != ADAPTIVE_ITERATIONS:
+        return no_executions >= iterations
+
+    if no_executions < MIN_ITERATIONS:
+        return False
+    if no_executions >= MAX_ITERATIONS:
+        return True
+
+    samples = execution_times[WARMUP_ITERATIONS:]
+    if sum(samples) >= MAX_MEASUREMENT_TIME:
+        return True
+
+    confidence = EARLY_CONFIDENCE if no_executions <= ITERATIONS else CONFIDENCE
+    interval = median_confidence_interval(samples=samples, confidence=confidence)
+    if interval is None:
+        return False
+    return interval[1] - interval[0] <= TARGET_RELATIVE_WIDTH * statistics.median(samples)
+
+
+def check_iterations(iterations: int):
+    """
+    Raise a ValueError unless the query is executed `ADAPTIVE_ITERATIONS` or at least twice,
+    so there are executions after the warm-up to average
+    """
+    if iterations != ADAPTIVE_ITERATIONS and iterations < 2:
+        raise ValueError(
+            f"No such number of iterations {iterations}, use {ADAPTIVE_ITERATIONS} for adaptive repetition or at least 2")
+
+
+def stopping_rule(iterations: int) -> str:
+    """
+    A hash of the parameters of adaptive repetition if `iterations` is
+    `ADAPTIVE_ITERATIONS`, so measurements taken under another stopping rule can be told
+    apart, otherwise an empty string
+    """
+    if iterations != ADAPTIVE_ITERATIONS:
+        return ""
+    parameters = (WARMUP_ITERATIONS, TARGET_RELATIVE_WIDTH, CONFIDENCE, EARLY_CONFIDENCE,
+                  MIN_ITERATIONS, MAX_ITERATIONS, MAX_MEASUREMENT_TIME)
+    return hashlib.sha256(repr(parameters).encode()).hexdigest()[:16]
+
+
+def median_confidence_interval(samples: list[float], confidence: float = CONFIDENCE) -> tuple[float, float] | None:
+    """
+    The distribution-free confidence interval of the median, between two order
+    statistics of the samples
+
+    The median lies between the j-th smallest and the j-th largest of n samples with
+    probability P(j <= B <= n - j), for B ~ Binomial(n, 1/2). The narrowest such interval
+    with at least the confidence is returned.
+
+    Returns
+    -------
+    tuple[float, float] | None
+        The bounds of the interval, or None if there are too few samples for the
+        confidence, e.g. fewer than 6 for 95%
+    """
+    no_samples = len(samples)
+    ordered = sorted(samples)
+
+    j = None
+    # P(B < i), for the candidate lower order statistic i
+    tail = 0.0
+    for i in range(1, no_samples // 2 + 1):
+        tail += comb(no_samples, i - 1) / 2 ** no_samples
+        if 1 - 2 * tail < confidence:
+            break
+        j = i
+
+    if j is None:
+        return None
+    return ordered[j - 1], ordered[no_samples - j]
+
+
+def timing_summary(execution_times: list[float]) -> dict:
+    """
+    The execution times of a query as result columns: the first `ITERATIONS` as
+    "Iteration i" (empty if not executed), all of them, and the median and its
+    confidence interval over the executions after the warm-up
+    """
+    samples = execution_times[WARMUP_ITERATIONS:] if len(
+        execution_times) > WARMUP_ITERATIONS else execution_times
+    interval = median_confidence_interval(samples=samples)
+    return {
+        **{f"Iteration {i}": execution_times[i] if i < len(execution_times) else None
+           for i in range(ITERATIONS)},
+        "Iterations": len(execution_times),
+        "Execution times": list(execution_times),
+        "Median": statistics.median(samples),
+        "Median CI low": interval[0] if interval is not None else None,
+        "Median CI high": interval[1] if interval is not None else None,
+    }
+
+
+def record_repetition(execution_times: list[float]):
+    """
+    Record the executions of an adaptively repeated query, against the `ITERATIONS`
+    executions of a fixed repetition
+    """
+    samples = execution_times[WARMUP_ITERATIONS:]
+    mean_time = sum(samples) / len(samples)
+    REPETITIONS.append({
+        "Iterations": len(execution_times),
+        "Time taken": sum(execution_times),
+        "Fixed time": sum(execution_times[:WARMUP_ITERATIONS]) + (ITERATIONS - WARMUP_ITERATIONS) * mean_time,
+    })
+
+
+def repetition_report() -> dict:
+    """
+    Summarize the adaptively repeated queries
+
+    Returns
+    -------
+    dict
+        The number of queries, their mean, min and max number of executions, the time
+        taken by their executions, the time `ITERATIONS` executions of each would have
+        taken (estimated from the mean execution time after the warm-up), and the
+        difference
+    """
+    repetitions = pd.DataFrame(
+        REPETITIONS, columns=["Iterations", "Time taken", "Fixed time"])
+    return {
+        "Queries": len(repetitions),
+        "Mean iterations": repetitions["Iterations"].mean(),
+        "Min iterations": repetitions["Iterations"].min(),
+        "Max iterations": repetitions["Iterations"].max(),
+        "Time taken": repetitions["Time taken"].sum(),
+        "Fixed time": repetitions["Fixed time"].sum(),
+        "Time saved": repetitions["Fixed time"].sum() - repetitions["Time taken"].sum(),
+    }
+
+
+def print_repetition_report():
+    """
+    Print the number of executions of the adaptively repeated queries, and the time saved
+    over executing each `ITERATIONS` times
+    """
+    if len(REPETITIONS) == 0:
+        return
+
+    report = repetition_report()
+    print(
+        f"Adaptive repetition: {report['Queries']} queries executed {report['Mean iterations']:.1f} times on average ({report['Min iterations']}-{report['Max iterations']}), taking {report['Time taken']:.2f}s, saving {report['Time saved']:.2f}s over {ITERATIONS} executions each")
@@ -0,0 +1,342 @@
+import ast
+
+import numpy as np
+import pandas as pd
+
+from queries.query import Query
+from utils.advisor import estimate_time_saved, use_time_saved
+from utils.usage_matrix import get_query_usage_matrix
+
+
+# Share of the time saved on a join field only realized once both sides of the join
+# are materialized, as DuckDB can then join on the plain columns
+JOIN_COUPLING = 0.5
+# Solve exactly, with branch and bound, up to this number of candidate fields
+EXACT_MAX_FIELDS = 20
+# Rounds of single-field swaps improving the heuristic selection
+LOCAL_SEARCH_ROUNDS = 10
+
+
+class SelectionProblem:
+    """
+    Choose the fields to materialize, maximizing the estimated time saved on a load
+    minus the cost of the writes, without exceeding a storage budget
+
+    The value of a selection is the sum of the benefit of each selected field, less its
+    write cost, plus the interaction of each pair of selected fields
+    """
+
+    def __init__(
+            self,
+            benefits: dict[str, float],
+            interactions: dict[tuple[str, str], float],
+            storage_costs: dict[str, float],
+            write_costs: dict[str, float] | None = None,
+    ):
+        """
+        Parameters
+        ----------
+        benefits : dict[str, float]
+            The time saved by materializing each field on its own
+        interactions : dict[tuple[str, str], float]
+            The additional time saved by materializing both fields of a pair
+        storage_costs : dict[str, float]
+            The bytes of storage used by materializing each field
+        write_costs : dict[str, float] | None
+            The time added to the writes of the load by materializing each field
+        """
+        write_costs = {} if write_costs is None else write_costs
+        self.storage_costs = storage_costs
+
+        self.values = {field: benefit - write_costs.get(field, 0)
+                       for field, benefit in benefits.items()}
+        self.interactions: dict[str, dict[str, float]] = {}
+        for (field_a, field_b), interaction in interactions.items():
+            if interaction <= 0 or field_a == field_b:
+                continue
+            self.interactions.setdefault(field_a, {})[field_b] = interaction
+            self.interactions.setdefault(field_b, {})[field_a] = interaction
+
+        # Fields that may increase the value of a selection
+        self.candidates = sorted(
+            field for field in set(self.values) | set(self.interactions)
+            if field in storage_costs and self._optimistic_value(field) > 0
+        )
+
+    def value(self, selection: set[str]) -> float:
+        """
+        The estimated value of a selection
+        """
+        value = sum(self.values.get(field, 0) for field in selection)
+        for field in selection:
+            value += sum(interaction for other, interaction in self.interactions.get(field, {}).items()
+                         if other in selection and field < other)
+        return value
+
+    def storage(self, selection: set[str]) -> float:
+        """
+        The storage used by a selection
+        """
+        return sum(self.storage_costs[field] for field in selection)
+
+    def solve(self, budget: float) -> set[str]:
+        """
+        Get the selection of highest value within the storage budget. Exact for up to
+        `EXACT_MAX_FIELDS` candidates, and heuristic otherwise
+        """
+        if len(self.candidates) <= EXACT_MAX_FIELDS:
+            return self._branch_and_bound(budget=budget)
+        return self._local_search(selection=self._greedy(budget=budget), budget=budget)
+
+    def _optimistic_value(self, field: str) -> float:
+        """
+        Upper bound of the value a field adds to any selection
+        """
+        return self.values.get(field, 0) + sum(self.interactions.get(field, {}).values())
+
+    def _marginal_value(self, field: str, selection: set[str]) -> float:
+        """
+        The value added by the field to the selection
+        """
+        return self.values.get(field, 0) + sum(interaction for other, interaction in self.interactions.get(field, {}).items()
+                                               if other in selection)
+
+    def _branch_and_bound(self, budget: float) -> set[str]:
+        # Decide the most valuable fields per byte first, to find good selections early
+        fields = sorted(self.candidates, key=lambda field: self._optimistic_value(
+            field) / max(self.storage_costs[field], 1), reverse=True)
+
+        best_selection: set[str] = set()
+        best_value = 0.0
+
+        def _search(i: int, selection: set[str], value: float, storage: float):
+            nonlocal best_selection, best_value
+            if value > best_value:
+                best_selection, best_value = set(selection), value
+            if i == len(fields):
+                return
+
+            # Bound the value reachable by the undecided fields
+            undecided = set(fields[i:])
+            bound = value + sum(max(self._marginal_value(field, selection) + sum(
+                interaction for other, interaction in self.interactions.get(field, {}).items()
+                if other in undecided), 0) for field in undecided)
+            if bound <= best_value:
+                return
+
+            field = fields[i]
+            if storage + self.storage_costs[field] <= budget:
+                marginal_value = self._marginal_value(field, selection)
+                selection.add(field)
+                _search(i + 1, selection, value + marginal_value,
+                        storage + self.storage_costs[field])
+                selection.remove(field)
+            _search(i + 1, selection, value, storage)
+
+        _search(0, set(), 0.0, 0.0)
+        return best_selection
+
+    def _greedy(self, budget: float) -> set[str]:
+        """
+        Repeatedly add the field, or pair of fields, adding the most value per byte
+        """
+        selection: set[str] = set()
+        storage = 0.0
+        while True:
+            options = [(field,) for field in self.candidates if field not in selection]
+            options += [(field, other) for field in self.candidates if field not in selection
+                        for other in self.interactions.get(field, {})
+                        if other not in selection and field < other and other in self.candidates]
+
+            best_option, best_ratio = None, 0.0
+            for option in options:
+                option_storage = sum(self.storage_costs[field] for field in option)
+                if storage + option_storage > budget:
+                    continue
+                ratio = (self.value(selection | set(option)) -
+                         self.value(selection)) / max(option_storage, 1)
+                if ratio > best_ratio:
+                    best_option, best_ratio = option, ratio
+
+            if best_option is None:
+                return selection
+            selection |= set(best_option)
+            storage += sum(self.storage_costs[field] for field in best_option)
+
+    def _local_search(self, selection: set[str], budget: float) -> set[str]:
+        """
+        Improve the selection by adding, removing or swapping single fields
+        """
+        for _ in range(LOCAL_SEARCH_ROUNDS):
+            best_selection, best_value = selection, self.value(selection)
+
+            neighbours = [selection - {field} for field in selection]
+            neighbours += [selection | {field}
+                           for field in self.candidates if field not in selection]
+            neighbours += [(selection - {removed}) | {added} for removed in selection
+                           for added in self.candidates if added not in selection]
+            for neighbour in neighbours:
+                if self.storage(neighbour) > budget:
+                    continue
+                neighbour_value = self.value(neighbour)
+                if neighbour_value > best_value:
+                    best_selection, best_value = neighbour, neighbour_value
+
+            if best_selection is selection:
+                break
+            selection = best_selection
+
+        return selection
+
+
+def estimate_benefits(
+        costs: pd.DataFrame,
+        queries: dict[str, Query],
+        load: list[str]
+) -> tuple[dict[str, float], dict[tuple[str, str], float]]:
+    """
+    Estimate the time saved on the load by each field, and by each pair of joined fields,
+    from the costs calibrated by `utils.advisor.calibrate`
+
+    A share `JOIN_COUPLING` of the time saved on each join is moved from the fields to
+    the interaction of the pair
+
+    Returns
+    -------
+    tuple[dict[str, float], dict[tuple[str, str], float]]
+        The benefits by field, and the interactions by pair of fields
+    """
+    benefits = estimate_time_saved(costs=costs, queries=queries, load=load)
+    interactions: dict[tuple[str, str], float] = {}
+
+    usage = get_query_usage_matrix(queries=queries)
+    # Joins of each field with each other field over the load
+    joins = np.tensordot(usage.load_counts(load=load),
+                         usage.join_adjacency, axes=1)
+    for f, p in zip(*np.nonzero(joins)):
+        field, join_field = usage.field_names[f], usage.field_names[p]
+        if field not in costs.index or join_field not in costs.index:
+            continue
+        coupled = JOIN_COUPLING * joins[f, p] * \
+            use_time_saved(costs=costs, field=field, clause="join")
+        benefits[field] -= coupled
+        pair = tuple(sorted((field, join_field)))
+        interactions[pair] = interactions.get(pair, 0) + coupled
+
+    return benefits, interactions
+
+
+def fit_write_costs(write_times: pd.DataFrame, fields: list[str]) -> tuple[dict[str, float], dict[str, float]]:
+    """
+    Fit the write time and storage added by each field, from the results of
+    `perform_write_test.py`, as a least-squares fit of the write time and the db size
+    delta of each materialization over its fields
+
+    Parameters
+    ----------
+    write_times : pd.DataFrame
+        The `write_times.csv` written by `perform_write_test.py`
+    fields : list[str]
+        The fields of the dataset
+
+    Returns
+    -------
+    tuple[dict[str, float], dict[str, float]]
+        The write time in seconds, and the storage in bytes, added by each field. Fields
+        never materialized in the write tests are left out
+    """
+    write_times = write_times.drop_duplicates(subset=["Materialization"])
+    materializations = [set(ast.literal_eval(materialization))
+                        for materialization in write_times["Materialization"]]
+    tested_fields = [field for field in fields
+                     if any(field in materialization for materialization in materializations)]
+
+    # One row per materialization, with an intercept for the writes of the raw json
+    design = np.array([[1.0] + [float(field in materialization) for field in tested_fields]
+                       for materialization in materializations])
+    db_size_delta = np.array([
+        ast.literal_eval(after)[2] - ast.literal_eval(before)[2]
+        for before, after in zip(write_times["DB Size Before"], write_times["DB Size After"])
+    ], dtype=float)
+
+    write_coefficients = _non_negative_least_squares(
+        design=design, target=write_times["Write time"].to_numpy(dtype=float))
+    storage_coefficients = _non_negative_least_squares(
+        design=design, target=db_size_delta)
+
+    write_costs = {field: float(coefficient)
+                   for field, coefficient in zip(tested_fields, write_coefficients[1:])}
+    storage_costs = {field: float(coefficient)
+                     for field, coefficient in zip(tested_fields, storage_coefficients[1:])}
+    return write_costs, storage_costs
+
+
+def _non_negative_least_squares(design: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """
+    Least-squares fit, refitting without the coefficients fitted as negative
+    """
+    active = np.ones(design.shape[1], dtype=bool)
+    coefficients = np.zeros(design.shape[1])
+    while active.any():
+        fitted, _, _, _ = np.linalg.lstsq(
+            design[:, active], target, rcond=None)
+        if (fitted >= 0).all():
+            coefficients[active] = fitted
+            break
+        active[np.flatnonzero(active)[fitted < 0]] = False
+    return coefficients
+
+
+def select_fields(
+        costs: pd.DataFrame,
+        queries: dict[str, Query],
+        load: list[str],
+        budget: float,
+        write_times: pd.DataFrame | None = None,
+        write_weight: float = 1,
+) -> set[str]:
+    """
+    Select the fields to materialize for the load within a storage budget
+
+    Parameters
+    ----------
+    costs : pd.DataFrame
+        The costs calibrated by `utils.advisor.calibrate`
+    queries : dict[str, Query]
+        The queries of the dataset
+    load : list[str]
+        The names of the queries in the load
+    budget : float
+        The bytes of storage available to the materialized fields
+    write_times : pd.DataFrame | None
+        The results of `perform_write_test.py`. If given, its fitted storage replaces
+        the estimated storage of the tested fields, and its fitted write times are
+        subtracted from their benefit
+    write_weight : float
+        The number of write tests worth of writes performed alongside the load
+
+    Returns
+    -------
+    set[str]
+    """
+    storage_costs = costs["Storage"].to_dict()
+    write_costs = {}
+    if write_times is not None:
+        write_costs, fitted_storage = fit_write_costs(
+            write_times=write_times, fields=list(costs.index))
+        write_costs = {field: write_weight * write_cost
+                       for field, write_cost in write_costs.items()}
+        # Fields fitted to take no storage keep their estimated storage
+        storage_costs.update({field: storage for field, storage in fitted_storage.items()
+                              if storage > 0})
+
+    benefits, interactions = estimate_benefits(
+        costs=costs, queries=queries, load=load)
+
+    problem = SelectionProblem(
+        benefits=benefits,
+        interactions=interactions,
+        storage_costs=storage_costs,
+        write_costs=write_costs,
+    )
+    return problem.solve(budget=budget)
@@ -0,0 +1,558 @@
+import atexit
+import errno
+import fcntl
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+import duckdb  # type: ignore
+import pandas as pd
+
+
+# Snapshot methods
+# Clone the file with the FICLONE ioctl, sharing its blocks copy-on-write (btrfs, XFS)
+REFLINK = "reflink"
+# Rename a copy made ahead of time by a background thread into place
+WARM_POOL = "warm_pool"
+# Copy the file in the kernel with copy_file_range, falling back to shutil.copyfile
+COPY = "copy"
+# Copy an in-memory database into a new in-memory database, see `import_in_memory`
+IN_MEMORY = "in_memory"
+METHODS = [REFLINK, WARM_POOL, COPY, IN_MEMORY]
+
+# The FICLONE ioctl request, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Number of warm copies kept ready per source, where reflinks are not supported
+WARM_POOL_SIZE = 1
+# Bytes copied between checks for a pause of the background copies
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# Seconds between checks for a pause, while waiting for a copy in progress
+PAUSE_CHECK_INTERVAL = 0.01
+# Errors of copy_file_range meaning it does not support the files, so they are copied
+# with shutil.copyfile instead
+COPY_UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EINVAL,
+                           errno.ENOSYS, errno.EOPNOTSUPP}
+
+# Whether reflinks are supported, by device
+_REFLINK_SUPPORTED: dict[int, bool] = {}
+# Warm pools, by source path
+_POOLS: dict[str, "SnapshotPool"] = {}
+# In-memory databases standing in for database files, by absolute path, and the
+# in-memory snapshots taken of them
+_MEMORY_DATABASES: dict[str, duckdb.DuckDBPyConnection] = {}
+_MEMORY_SNAPSHOTS: dict[str, duckdb.DuckDBPyConnection] = {}
+# Background copies only run while set, see `paused`
+_RESUMED = threading.Event()
+_RESUMED.set()
+_PAUSES = 0
+_PAUSES_LOCK = threading.Lock()
+# One row per snapshot taken by `create_connection`
+SETUP_TIMES: list[dict] = []
+
+# The database of each dataset, imported from its backup by `create_dataset_db`, and
+# snapshotted for each test by `create_dataset_connection`
+DATASET_DB_PATH = "./data/db/{dataset}.duckdb"
+DATASET_BACKUP_PATH = "./data/backup/{dataset}_tiny"
+DATASET_BLOCK_SIZE = 16384
+
+
+@contextmanager
+def paused():
+    """
+    Pause the background copies of the warm pools, e.g. while timing queries
+    """
+    global _PAUSES
+    with _PAUSES_LOCK:
+        _PAUSES += 1
+        _RESUMED.clear()
+    try:
+        yield
+    finally:
+        with _PAUSES_LOCK:
+            _PAUSES -= 1
+            if _PAUSES == 0:
+                _RESUMED.set()
+
+
+class SnapshotPool:
+    """
+    Copies of a source file, made ahead of time by a background thread, so a snapshot is
+    a rename. Copies of an earlier version of the source are discarded.
+    """
+
+    def __init__(self, source: str, size: int = WARM_POOL_SIZE):
+        """
+        Parameters
+        ----------
+        source : str
+            The file to copy
+        size : int
+            The number of copies to keep ready
+        """
+        self.source = source
+        self.size = size
+        directory, name = os.path.split(source)
+        self._warm_paths = [os.path.join(directory, f".{name}.warm{i}")
+                            for i in range(size)]
+
+        # Ready copies, with the version of the source they were copied from
+        self._ready: list[tuple[str, tuple]] = []
+        self._copying: str | None = None
+        self._closed = False
+        self._condition = threading.Condition()
+        # Time taken by each complete copy of the source, in the background or not
+        self.copy_times: list[float] = []
+
+        self._thread = threading.Thread(target=self._refill, daemon=True)
+        self._thread.start()
+
+    def take(self, destination: str) -> str:
+        """
+        Move a warm copy of the source to `destination`, or copy the source if none is
+        ready or being made
+
+        Returns
+        -------
+        str
+            The snapshot method used
+        """
+        version = _file_version(self.source)
+        with self._condition:
+            self._discard_stale(version=version)
+            # A copy in progress is closer to done than a new copy, unless it is paused
+            while len(self._ready) == 0 and self._copying is not None and _RESUMED.is_set():
+                self._condition.wait(timeout=PAUSE_CHECK_INTERVAL)
+                self._discard_stale(version=version)
+
+            if len(self._ready) > 0:
+                warm_path, _ = self._ready.pop(0)
+                os.replace(warm_path, destination)
+                method = WARM_POOL
+            else:
+                method = None
+            self._condition.notify_all()
+
+        if method is None:
+            self.copy_times.append(
+                _copy(source=self.source, destination=destination))
+            method = COPY
+        return method
+
+    def close(self):
+        """
+        Stop the background copies, and remove the warm copies
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        _RESUMED.set()
+        self._thread.join()
+        for warm_path in self._warm_paths:
+            if os.path.exists(warm_path):
+                os.remove(warm_path)
+
+    def _discard_stale(self, version: tuple):
+        for warm_path, warm_version in list(self._ready):
+            if warm_version != version:
+                self._ready.remove((warm_path, warm_version))
+                os.remove(warm_path)
+
+    def _refill(self):
+        while True:
+            with self._condition:
+                ready_paths = {warm_path for warm_path, _ in self._ready}
+                while not self._closed and len(ready_paths) >= self.size:
+                    self._condition.wait()
+                    ready_paths = {warm_path for warm_path, _ in self._ready}
+                if self._closed:
+                    return
+                warm_path = next(path for path in self._warm_paths
+                                 if path not in ready_paths)
+                self._copying = warm_path
+
+            version = _file_version(self.source)
+            try:
+                copy_time = _copy(source=self.source, destination=warm_path,
+                                  pausable=True, closed=lambda: self._closed)
+                copied = not self._closed and _file_version(
+                    self.source) == version
+                if copied:
+                    self.copy_times.append(copy_time)
+            except OSError:
+                # The source is being replaced or cannot be read, try again on the next
+                # snapshot
+                copied = False
+            # Do not leave a partial copy on disk until the pool is closed
+            if not copied and os.path.exists(warm_path):
+                os.remove(warm_path)
+
+            with self._condition:
+                self._copying = None
+                if copied:
+                    self._ready.append((warm_path, version))
+                self._condition.notify_all()
+                if not copied:
+                    if self._closed:
+                        return
+                    # Wait for the next snapshot, rather than retrying right away
+                    self._condition.wait()
+
+
+def snapshot(source: str, destination: str, pool_size: int = WARM_POOL_SIZE) -> str:
+    """
+    Copy `source` to `destination`, by reflink if the file system supports it,
+    otherwise from a warm pool of `pool_size` copies (if positive), otherwise by copying
+
+    Returns
+    -------
+    str
+        The snapshot method used
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+
+    if _reflink(source=source, destination=destination):
+        return REFLINK
+
+    if pool_size > 0:
+        if source not in _POOLS:
+            _POOLS[source] = SnapshotPool(source=source, size=pool_size)
+        return _POOLS[source].take(destination=destination)
+
+    _copy(source=source, destination=destination)
+    return COPY
+
+
+def create_connection(
+        original_db_path: str,
+        copy_db_path: str,
+        block_size: int | None = None,
+        pool_size: int = WARM_POOL_SIZE,
+) -> tuple[duckdb.DuckDBPyConnection, str]:
+    """
+    Connect to a fresh snapshot of the database at `original_db_path`, replacing any
+    old snapshot at `copy_db_path`. The time taken is recorded in `SETUP_TIMES`.
+
+    If the database was imported with `import_in_memory`, the snapshot is an in-memory
+    copy in the same DuckDB instance, made the default database of the connection, and
+    no file is written.
+
+    Parameters
+    ----------
+    original_db_path : str
+        The database to snapshot
+    copy_db_path : str
+        The path of the snapshot
+    block_size : int | None
+        The default block size of the connection, in bytes
+    pool_size : int
+        The number of warm copies kept ready, where reflinks are not supported
+
+    Returns
+    -------
+    tuple[duckdb.DuckDBPyConnection, str]
+        The connection, and the path of the snapshot
+    """
+    start_time = time.perf_counter()
+    if is_in_memory(original_db_path):
+        con = _snapshot_in_memory(
+            original_db_path=original_db_path, copy_db_path=copy_db_path)
+        method = IN_MEMORY
+        snapshot_time = time.perf_counter() - start_time
+    else:
+        method = snapshot(source=original_db_path,
+                          destination=copy_db_path, pool_size=pool_size)
+        snapshot_time = time.perf_counter() - start_time
+
+        # The next warm copy would compete for I/O with opening this one
+        with paused():
+            # Reconnect to db
+            con = duckdb.connect(copy_db_path)
+
+    if block_size is not None:
+        con.execute(f"SET default_block_size = '{block_size}'")
+
+    con.execute("CHECKPOINT;")
+
+    SETUP_TIMES.append({
+        "Database": original_db_path,
+        "Method": method,
+        "Snapshot time": snapshot_time,
+        "Setup time": time.perf_counter() - start_time,
+        "Size": None if method == IN_MEMORY else os.path.getsize(copy_db_path),
+    })
+    return con, copy_db_path
+
+
+def import_in_memory(db_path: str, backup_path: str) -> duckdb.DuckDBPyConnection:
+    """
+    Import a backup into an in-memory database, standing in for the database file at
+    `db_path`. `create_connection` then snapshots the in-memory database, so neither
+    setup nor timed queries touch the file system. Meant for the small backups, which
+    fit in memory, and whose JSON extraction is CPU-bound.
+
+    The size of an in-memory database is not reported by `pragma_database_size`, so
+    `get_db_size` reports no blocks.
+
+    Parameters
+    ----------
+    db_path : str
+        The path of the database file the in-memory database stands in for. No file is
+        written
+    backup_path : str
+        The directory of the backup, as written by `EXPORT DATABASE`
+
+    Returns
+    -------
+    duckdb.DuckDBPyConnection
+        The connection to the in-memory database
+    """
+    if is_in_memory(db_path):
+        remove_database(db_path)
+
+    con = duckdb.connect(":memory:")
+    con.execute(f"IMPORT DATABASE '{backup_path}';")
+    _MEMORY_DATABASES[os.path.abspath(db_path)] = con
+    return con
+
+
+def is_in_memory(db_path: str) -> bool:
+    """
+    Whether the database at `db_path` was imported with `import_in_memory`, or is an
+    in-memory snapshot of such a database
+    """
+    path = os.path.abspath(db_path)
+    return path in _MEMORY_DATABASES or path in _MEMORY_SNAPSHOTS
+
+
+def remove_database(db_path: str):
+    """
+    Remove a database file, or the in-memory database standing in for it. Like
+    `os.remove`, raises FileNotFoundError if there is neither.
+    """
+    path = os.path.abspath(db_path)
+    if path in _MEMORY_SNAPSHOTS:
+        con = _MEMORY_SNAPSHOTS.pop(path)
+        con.execute(f"DETACH DATABASE IF EXISTS {_memory_name(path)};")
+    elif path in _MEMORY_DATABASES:
+        # Closing the instance also drops its snapshots
+        con = _MEMORY_DATABASES.pop(path)
+        for snapshot_path, snapshot_con in list(_MEMORY_SNAPSHOTS.items()):
+            if snapshot_con is con:
+                del _MEMORY_SNAPSHOTS[snapshot_path]
+        con.close()
+    else:
+        os.remove(db_path)
+
+
+def create_dataset_db(dataset: str, partitioned: bool = False, in_memory: bool = False):
+    """
+    Import the backup of the dataset into a fresh database at `DATASET_DB_PATH`
+
+    Parameters
+    ----------
+    dataset : str
+        The dataset
+    partitioned : bool
+        Import the backup partitioned by document type
+    in_memory : bool
+        Import the backup into memory, with `import_in_memory`, rather than into a file
+    """
+    db_path = DATASET_DB_PATH.format(dataset=dataset)
+    backup_path = DATASET_BACKUP_PATH.format(dataset=dataset)
+    if partitioned:
+        backup_path += "_partitioned"
+
+    # Import the backup into memory, and snapshot it in memory for each test
+    if in_memory:
+        import_in_memory(db_path=db_path, backup_path=backup_path)
+        return
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+        print(f"Removed db at path {db_path}")
+
+    with duckdb.connect(db_path) as con:
+        con.execute(f"SET default_block_size = '{DATASET_BLOCK_SIZE}'")
+        con.execute(f"IMPORT DATABASE '{backup_path}';")
+
+
+def create_dataset_connection(dataset: str, test: str = "testing") -> tuple[duckdb.DuckDBPyConnection, str]:
+    """
+    Connect to a fresh snapshot of the database of the dataset, created by
+    `create_dataset_db`, named after the test
+
+    Returns
+    -------
+    tuple[duckdb.DuckDBPyConnection, str]
+        The connection, and the path of the snapshot
+    """
+    original_db_path = DATASET_DB_PATH.format(dataset=dataset)
+    copy_db_path = f"./data/db/{dataset}_{test}.db"
+
+    # Remove any old db
+    if os.path.exists(copy_db_path):
+        os.remove(copy_db_path)
+        print(f"Removed db at path {copy_db_path}")
+
+    con, copy_db_path = create_connection(
+        original_db_path=original_db_path, copy_db_path=copy_db_path, block_size=DATASET_BLOCK_SIZE)
+    if not is_in_memory(copy_db_path):
+        db_size = os.path.getsize(copy_db_path)
+        print(f"Fresh database size: {db_size/1024/1024:.6f} MB")
+
+    return con, copy_db_path
+
+
+def setup_report() -> pd.DataFrame:
+    """
+    Summarize the setup time of the snapshots, by database and method, against the time
+    of copying each database in full, where measured
+
+    Returns
+    -------
+    pd.DataFrame
+        The number of snapshots, their mean snapshot and setup (snapshot, connection and
+        checkpoint) time, the mean time of a full copy, and the snapshot time saved
+    """
+    columns = ["Database", "Method", "Snapshots", "Mean snapshot time",
+               "Mean setup time", "Mean copy time", "Time saved"]
+    if len(SETUP_TIMES) == 0:
+        return pd.DataFrame(columns=columns)
+
+    setup_times = pd.DataFrame(SETUP_TIMES)
+    report = setup_times.groupby(["Database", "Method"], sort=False).agg(
+        **{"Snapshots": ("Snapshot time", "count"),
+           "Mean snapshot time": ("Snapshot time", "mean"),
+           "Mean setup time": ("Setup time", "mean")}).reset_index()
+
+    # Full copies made by the warm pools, or in place of a snapshot
+    copy_times = {source: sum(pool.copy_times) / len(pool.copy_times)
+                  for source, pool in _POOLS.items() if len(pool.copy_times) > 0}
+    copied = setup_times[setup_times["Method"] == COPY].groupby("Database")[
+        "Snapshot time"].mean()
+    for database, copy_time in copied.items():
+        copy_times.setdefault(database, copy_time)
+
+    report["Mean copy time"] = report["Database"].map(copy_times)
+    report["Time saved"] = report["Snapshots"] * \
+        (report["Mean copy time"] - report["Mean snapshot time"])
+    return report[columns]
+
+
+def print_setup_report():
+    """
+    Print the setup time of the snapshots, and the time saved over copying them in full
+    """
+    report = setup_report()
+    for _, row in report.iterrows():
+        saved = "" if pd.isna(row["Time saved"]) else \
+            f", saving {row['Time saved']:.2f}s over full copies of {row['Mean copy time']:.3f}s"
+        print(
+            f"{row['Snapshots']} snapshots of {row['Database']} by {row['Method']}: {row['Mean snapshot time']:.3f}s on average, {row['Mean setup time']:.3f}s with the connection{saved}")
+
+
+def close_pools():
+    """
+    Stop the background copies of every warm pool, and remove the warm copies
+    """
+    for pool in _POOLS.values():
+        pool.close()
+    _POOLS.clear()
+
+
+atexit.register(close_pools)
+
+
+def _reflink(source: str, destination: str) -> bool:
+    """
+    Clone the source by reflink, if the file system supports it
+    """
+    device = os.stat(os.path.dirname(os.path.abspath(destination))).st_dev
+    if _REFLINK_SUPPORTED.get(device) is False:
+        return False
+
+    try:
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            fcntl.ioctl(destination_file.fileno(),
+                        FICLONE, source_file.fileno())
+        _REFLINK_SUPPORTED[device] = True
+        return True
+    except OSError:
+        _REFLINK_SUPPORTED[device] = False
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+
+
+def _copy(source: str, destination: str, pausable: bool = False, closed=None) -> float:
+    """
+    Copy the source in the kernel, in chunks, waiting between chunks while `paused` if
+    `pausable`. Stops early once `closed()` is true.
+
+    Returns
+    -------
+    float
+        The time spent copying, excluding pauses
+    """
+    copy_time = 0.0
+    try:
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            remaining = os.fstat(source_file.fileno()).st_size
+            while remaining > 0:
+                if pausable:
+                    _RESUMED.wait()
+                if closed is not None and closed():
+                    break
+                start_time = time.perf_counter()
+                copied = os.copy_file_range(source_file.fileno(), destination_file.fileno(),
+                                            min(remaining, COPY_CHUNK_SIZE))
+                copy_time += time.perf_counter() - start_time
+                if copied == 0:
+                    break
+                remaining -= copied
+    except OSError as e:
+        if e.errno not in COPY_UNSUPPORTED_ERRORS:
+            raise e
+        # copy_file_range is not supported between these files
+        start_time = time.perf_counter()
+        shutil.copyfile(source, destination)
+        copy_time = time.perf_counter() - start_time
+    return copy_time
+
+
+def _snapshot_in_memory(original_db_path: str, copy_db_path: str) -> duckdb.DuckDBPyConnection:
+    """
+    Copy the in-memory database standing in for `original_db_path` into a new in-memory
+    database, named after `copy_db_path`, replacing any old one. Returns a connection to
+    the instance of the original, with the copy as its default database.
+    """
+    original = _MEMORY_DATABASES[os.path.abspath(original_db_path)]
+    name = _memory_name(copy_db_path)
+
+    con = original.cursor()
+    con.execute(f"DETACH DATABASE IF EXISTS {name};")
+    con.execute(f"ATTACH ':memory:' AS {name};")
+    con.execute(f"COPY FROM DATABASE memory TO {name};")
+    con.execute(f"USE {name};")
+    _MEMORY_SNAPSHOTS[os.path.abspath(copy_db_path)] = original
+    return con
+
+
+def _memory_name(db_path: str) -> str:
+    """
+    The name of the in-memory snapshot of a database file path
+    """
+    name = os.path.splitext(os.path.basename(db_path))[0]
+    return "snapshot_" + re.sub(r"\W", "_", name)
+
+
+def _file_version(path: str) -> tuple:
+    """
+    Identify the version of a file, which changes when it is replaced or modified
+    """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,228 @@
+import numpy as np
+
+import testing.tpch.setup as tpch_setup
+import testing.twitter.setup as twitter_setup
+from queries.query import Query
+
+
+CLAUSES = ["select", "where", "group_by", "order_by", "join", "self_join"]
+
+DATASETS = {
+    "tpch": tpch_setup,
+    "twitter": twitter_setup,
+}
+
+# Usage matrices by dataset, see `get_usage_matrix`
+_USAGE_MATRICES: dict[str, "UsageMatrix"] = {}
+# Usage matrices of other dicts of queries, by id, with the dict they were built from,
+# see `get_query_usage_matrix`
+_QUERY_USAGE_MATRICES: dict[int, tuple[dict[str, Query], "UsageMatrix"]] = {}
+
+
+class UsageMatrix:
+    """
+    How often each query uses each field in each clause, and which fields each join
+    field is joined with, built once from the queries of a dataset
+
+    `counts[q, f, c]` holds the number of uses of field f in clause c of query q, as
+    listed by `columns_used_with_position`: the number of join partners in "join", and
+    the number of self joins in "self_join". `join_adjacency[q, f, p]` holds the number
+    of times field f is joined with field p in query q, and `join_fields` the join
+    partners of each field of each query as listed, including None for joins without a
+    field counterpart.
+    """
+
+    def __init__(self, queries: dict[str, Query], field_names: list[str] | None = None):
+        """
+        Parameters
+        ----------
+        queries : dict[str, Query]
+            The queries, by name
+        field_names : list[str] | None
+            The fields, e.g. the keys of the column map. If None, the fields used by the
+            queries, in order of first use
+        """
+        self.queries = queries
+        self.query_names = list(queries.keys())
+
+        positions = {query_name: query_obj.columns_used_with_position()
+                     for query_name, query_obj in queries.items()}
+        self.join_fields: dict[str, dict[str, list[str | None]]] = {
+            query_name: query_position["join"] for query_name, query_position in positions.items()}
+
+        if field_names is None:
+            field_names = []
+            for query_position in positions.values():
+                for col_list in query_position.values():
+                    for field in col_list:
+                        if field not in field_names:
+                            field_names.append(field)
+        self.field_names = list(field_names)
+
+        self.query_index = {query: i for i, query in enumerate(self.query_names)}
+        self.field_index = {field: i for i, field in enumerate(self.field_names)}
+        self.clause_index = {clause: i for i, clause in enumerate(CLAUSES)}
+
+        self.counts = np.zeros(
+            (len(self.query_names), len(self.field_names), len(CLAUSES)))
+        self.join_adjacency = np.zeros(
+            (len(self.query_names), len(self.field_names), len(self.field_names)))
+
+        for query_name, query_position in positions.items():
+            q = self.query_index[query_name]
+            for clause, col_list in query_position.items():
+                c = self.clause_index[clause]
+                for field in col_list:
+                    if field not in self.field_index:
+                        continue
+                    f = self.field_index[field]
+                    if clause == "join":
+                        self.counts[q, f, c] += len(col_list[field])
+                        for join_field in col_list[field]:
+                            if join_field in self.field_index:
+                                self.join_adjacency[q, f,
+                                                    self.field_index[join_field]] += 1
+                    elif clause == "self_join":
+                        self.counts[q, f, c] += col_list[field]
+                    else:
+                        self.counts[q, f, c] += 1
+
+        # Uses of each field in each query, as counted by `columns_used`, which some
+        # queries list separately
+        self.total_counts = np.zeros((len(self.query_names), len(self.field_names)))
+        for query_name, query_obj in queries.items():
+            q = self.query_index[query_name]
+            for field in query_obj.columns_used():
+                if field in self.field_index:
+                    self.total_counts[q, self.field_index[field]] += 1
+        self.used = self.total_counts > 0
+
+        # Rows of `get_column_weights`, by query, arguments and relevant materialization
+        self._weights_cache: dict[tuple, np.ndarray] = {}
+
+    def load_counts(self, load: list[str]) -> np.ndarray:
+        """
+        The number of executions of each query in the load
+        """
+        return np.bincount([self.query_index[query_name] for query_name in load],
+                           minlength=len(self.query_names)).astype(float)
+
+    def clause_counts(self, query_name: str, clause: str) -> dict[str, int]:
+        """
+        The uses of each field in a clause of the query
+        """
+        row = self.counts[self.query_index[query_name], :,
+                          self.clause_index[clause]]
+        return {self.field_names[f]: int(row[f]) for f in np.flatnonzero(row)}
+
+    def count(self, query_name: str, field: str, clause: str | None = None) -> int:
+        """
+        The uses of the field in the query, in a clause or in total
+        """
+        q, f = self.query_index[query_name], self.field_index.get(field)
+        if f is None:
+            return 0
+        if clause is None:
+            return int(self.total_counts[q, f])
+        return int(self.counts[q, f, self.clause_index[clause]])
+
+    def lookup(self, query_names: list[str], fields: list[str], clause: str | None = None) -> np.ndarray:
+        """
+        The uses of each field in the query of the same position, in a clause or in total
+        """
+        q = np.array([self.query_index[query_name]
+                     for query_name in query_names], dtype=int)
+        f = np.array([self.field_index.get(field, -1)
+                     for field in fields], dtype=int)
+        if clause is None:
+            counts = self.total_counts[q, f]
+        else:
+            counts = self.counts[q, f, self.clause_index[clause]]
+        # Fields not in the matrix are not used
+        return np.where(f >= 0, counts, 0).astype(int)
+
+    def uses(self, query_name: str, field: str) -> bool:
+        """
+        Whether the query uses the field
+        """
+        f = self.field_index.get(field)
+        return f is not None and bool(self.used[self.query_index[query_name], f])
+
+    def join_partners(self, query_name: str, field: str) -> list[str]:
+        """
+        The fields the field is joined with in the query
+        """
+        f = self.field_index.get(field)
+        if f is None:
+            return []
+        row = self.join_adjacency[self.query_index[query_name], f]
+        return [self.field_names[p] for p in np.flatnonzero(row)]
+
+    def field_counts(self, load_counts: np.ndarray, clauses: list[str] | None = None) -> np.ndarray:
+        """
+        The uses of each field over the executions of each query, in the clauses or in total
+        """
+        if clauses is None:
+            return load_counts @ self.total_counts
+        clause_ids = [self.clause_index[clause] for clause in clauses]
+        return load_counts @ self.counts[:, :, clause_ids].sum(axis=2)
+
+    def weight_matrix(self, prev_materialization: set[str], iteration: int, only_freq: bool) -> np.ndarray:
+        """
+        The `get_column_weights` of each query, as a query x field matrix. The rows are
+        cached, as the weights of a query only depend on the materialization of its fields.
+        """
+        matrix = np.zeros((len(self.query_names), len(self.field_names)))
+        for query_name, query_obj in self.queries.items():
+            q = self.query_index[query_name]
+            relevant = frozenset(field for field in prev_materialization
+                                 if self.uses(query_name=query_name, field=field))
+            key = (query_name, relevant, iteration, only_freq)
+            if key not in self._weights_cache:
+                row = np.zeros(len(self.field_names))
+                for field, weight in query_obj.get_column_weights(
+                        prev_materialization=list(relevant), iteration=iteration, only_freq=only_freq).items():
+                    if field in self.field_index:
+                        row[self.field_index[field]] = weight
+                self._weights_cache[key] = row
+            matrix[q] = self._weights_cache[key]
+        return matrix
+
+    def field_weights(self, load_counts: np.ndarray, prev_materialization: set[str], iteration: int, only_freq: bool) -> np.ndarray:
+        """
+        The total `get_column_weights` of each field over the executions of each query
+        """
+        return load_counts @ self.weight_matrix(
+            prev_materialization=prev_materialization, iteration=iteration, only_freq=only_freq)
+
+
+def get_usage_matrix(dataset: str) -> UsageMatrix:
+    """
+    Get the usage matrix of the queries and column map of a dataset, built once
+    """
+    if dataset not in DATASETS:
+        raise ValueError(f"No such dataset {dataset}")
+
+    if dataset not in _USAGE_MATRICES:
+        setup = DATASETS[dataset]
+        _USAGE_MATRICES[dataset] = UsageMatrix(
+            queries=setup.QUERIES, field_names=list(setup.COLUMN_MAP.keys()))
+    return _USAGE_MATRICES[dataset]
+
+
+def get_query_usage_matrix(queries: dict[str, Query]) -> UsageMatrix:
+    """
+    Get the usage matrix of a dict of queries, built once per dict. The matrix of a
+    dataset is reused if these are its queries. Rebuild it, with `UsageMatrix`, after
+    changing the queries of the dict.
+    """
+    for dataset, setup in DATASETS.items():
+        if setup.QUERIES is queries:
+            return get_usage_matrix(dataset=dataset)
+
+    entry = _QUERY_USAGE_MATRICES.get(id(queries))
+    # The dict is kept in the entry, so its id is not reused while cached
+    if entry is None or entry[0] is not queries:
+        entry = (queries, UsageMatrix(queries=queries))
+        _QUERY_USAGE_MATRICES[id(queries)] = entry
+    return entry[1]
@@ -0,0 +1,141 @@
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+# Rescale the decayed counts once the scale of new arrivals exceeds this
+MAX_DECAY_SCALE = 1e100
+
+
+class WorkloadStats:
+    """
+    Streaming query frequencies, and the field weights they imply, over a query x field
+    matrix of the weight of each field in each query
+
+    Arrivals are counted over the whole stream, over the last `window` queries, or with
+    each earlier arrival weighted down by `decay` per later arrival. Each arrival is
+    constant time, and the field weights a single vector-matrix product.
+    """
+
+    def __init__(
+            self,
+            query_names: list[str],
+            field_names: list[str],
+            matrix: np.ndarray,
+            decay: float | None = None,
+            window: int | None = None,
+    ):
+        """
+        Parameters
+        ----------
+        query_names : list[str]
+            The names of the queries, one per row of `matrix`
+        field_names : list[str]
+            The names of the fields, one per column of `matrix`
+        matrix : np.ndarray
+            The weight of each field in a single execution of each query
+        decay : float | None
+            Factor each earlier arrival is weighted by per later arrival, in (0, 1]
+        window : int | None
+            Only count the last `window` arrivals
+        """
+        if decay is not None and window is not None:
+            raise ValueError("Use either a decay or a window")
+        if decay is not None and not 0 < decay <= 1:
+            raise ValueError(f"No such decay {decay}")
+        if window is not None and window < 1:
+            raise ValueError(f"No such window {window}")
+
+        self.query_names = list(query_names)
+        self.field_names = list(field_names)
+        self.matrix = np.asarray(matrix, dtype=float)
+        assert self.matrix.shape == (
+            len(self.query_names), len(self.field_names))
+
+        self.decay = decay
+        self.window = window
+
+        self._query_index = {query: i for i, query in enumerate(self.query_names)}
+        self._field_index = {field: i for i, field in enumerate(self.field_names)}
+        # Counts of each query. With a decay, scaled up by `_scale`
+        self._counts = np.zeros(len(self.query_names))
+        self._scale = 1.0
+        self._arrivals: deque[tuple[int, float]] = deque()
+        self.no_observed = 0
+
+    def observe(self, query_name: str, weight: float = 1.0):
+        """
+        Count the arrival of a query, weighted by `weight`
+        """
+        i = self._query_index[query_name]
+        self.no_observed += 1
+
+        if self.decay is not None:
+            # Scale up new arrivals, rather than decaying every earlier count
+            self._scale /= self.decay
+            if self._scale > MAX_DECAY_SCALE:
+                self._counts /= self._scale
+                self._scale = 1.0
+            self._counts[i] += weight * self._scale
+            return
+
+        self._counts[i] += weight
+        if self.window is not None:
+            self._arrivals.append((i, weight))
+            if len(self._arrivals) > self.window:
+                evicted, evicted_weight = self._arrivals.popleft()
+                self._counts[evicted] -= evicted_weight
+
+    def observe_load(self, load: list[str]):
+        """
+        Count the arrival of each query of a load, in order
+        """
+        for query_name in load:
+            self.observe(query_name=query_name)
+
+    def query_field_weights(self, query_name: str) -> np.ndarray:
+        """
+        The weight of each field in a single execution of the query
+        """
+        return self.matrix[self._query_index[query_name]]
+
+    def query_counts(self) -> np.ndarray:
+        """
+        The (decayed or windowed) count of each query
+        """
+        return self._counts / self._scale
+
+    def field_weights(self) -> np.ndarray:
+        """
+        The total weight of each field over the counted queries
+        """
+        return self.query_counts() @ self.matrix
+
+    def field_weight(self, field: str) -> float:
+        """
+        The total weight of a field over the counted queries
+        """
+        return float(self.query_counts() @ self.matrix[:, self._field_index[field]])
+
+    def field_priority(self) -> pd.Series:
+        """
+        The total weight of each field, highest first
+        """
+        return pd.Series(self.field_weights(), index=self.field_names).sort_values(
+            ascending=False, kind="stable")
+
+    def ranked_fields(self, exclude: set[str] | None = None) -> list[str]:
+        """
+        The fields with a positive total weight, highest first
+
+        Parameters
+        ----------
+        exclude : set[str] | None
+            Fields not to rank, e.g. the fields materialized already
+        """
+        exclude = set() if exclude is None else exclude
+        weights = self.field_weights()
+        order = np.argsort(-weights, kind="stable")
+        return [self.field_names[i] for i in order
+                if weights[i] > 0 and self.field_names[i] not in exclude]
@@ -2,7 +2,6 @@
 import os
 import random
 import time
-import shutil
 from collections import defaultdict
 from datetime import datetime
 import pandas as pd
@@ -10,7 +9,10 @@ import duckdb  # type: ignore
 
 from queries.query import Query
 import testing.tpch.setup as tpch_setup
+from utils.measurement_cache import MeasurementCache, measurement_setup
 from utils.prepare_database import prepare_database
+from utils.query_timing import done_iterating, record_repetition, timing_summary, print_repetition_report, ADAPTIVE_ITERATIONS
+from utils.snapshot import create_connection, import_in_memory, paused, print_setup_report, remove_database
 
 
 TEST_TIME_STRING = f"{datetime.now().date()}-{datetime.now().hour}H"
@@ -52,7 +54,12 @@ DF_COL_NAMES = [
     'Iteration 1',
     'Iteration 2',
     'Iteration 3',
-    'Iteration 4'
+    'Iteration 4',
+    'Iterations',
+    'Execution times',
+    'Median',
+    'Median CI low',
+    'Median CI high',
 ]
 
 
@@ -60,6 +67,19 @@ TESTS_PER_TRESHOLD = 3
 TRESHOLDS_TO_MATERIALIZE = [0.25, 0.50, 0.75]
 
 CLEAN_UP_FILES = set()
+# Import each backup into memory, and snapshot it in memory, rather than copying
+# database files. For backups small enough to fit in memory twice
+IN_MEMORY = False
+
+# Reuse the execution times measured by earlier runs, see `utils.measurement_cache`
+USE_MEASUREMENT_CACHE = True
+# Measure again if the stored measurement is older than this. None never expires
+MEASUREMENT_MAX_AGE = None
+# Measure every query again, replacing the stored measurements
+FORCE_MEASUREMENT = False
+# Executions of each query. ADAPTIVE_ITERATIONS instead repeats each query until the
+# confidence interval of its median is narrow enough, see `utils.query_timing.done_iterating`
+ITERATIONS = 5
 
 
 def _prepare_dirs(dataset: str):
@@ -129,27 +149,15 @@ def _create_connection(db_dir: str) -> tuple[duckdb.DuckDBPyConnection, str]:
 
     CLEAN_UP_FILES.add(copy_db_path)
 
-    # Remove any old db
-    if os.path.exists(copy_db_path):
-        os.remove(copy_db_path)
-
-    # Copy original db
-    shutil.copy(original_db_path, copy_db_path)
-
-    # Reconnect to db
-    con = duckdb.connect(copy_db_path)
-    con.execute("SET default_block_size = '16384'")
-
-    con.execute("CHECKPOINT;")
-
-    return con, copy_db_path
+    return create_connection(
+        original_db_path=original_db_path, copy_db_path=copy_db_path, block_size=16384)
 
 
 def _clean_up():
     print(CLEAN_UP_FILES)
     for file in list(CLEAN_UP_FILES):
         try:
-            os.remove(file)
+            remove_database(file)
             print(f"Deleted file {file}")
         except FileNotFoundError:
             print(f"No file at path {file}")
@@ -160,13 +168,14 @@ def _perform_tests(
         query_object: Query,
         db_dir: str,
         materializations: dict,
-        dataset: str
+        dataset: str,
+        scale_factor: float,
+        measurement_cache: MeasurementCache | None = None
 ) -> pd.DataFrame:
     config = DATASETS[dataset]
     column_map: dict = config["column_map"]
 
     rows = []  # list to collect row dictionaries
-    iterations = 5
 
     # will hold the query result from the first materialization
     global_baseline_result = None
@@ -189,31 +198,59 @@ def _perform_tests(
 
             baseline_result = None  # to store the query result from the first iteration
 
-            con, _ = _create_connection(db_dir=db_dir)
-            prepare_database(con=con, fields=fields, include_print=False)
-
-            execution_times = []
-
-            # Execute the test iterations and record their times
-            for i in range(iterations):
-                start_time = time.perf_counter()
-                result = con.execute(query).fetchdf()
-                end_time = time.perf_counter()
-                execution_time = end_time - start_time
-                execution_times.append(execution_time)
-
-                if i == 0:
-                    # Save the result of the first iteration as the baseline for this test.
-                    baseline_result = result.copy()
-                else:
-                    # Check that subsequent iterations yield the same result.
-                    if not baseline_result.equals(result):
-                        raise ValueError(
-                            f"[{query_name}] Query results differ in iteration {i} for threshold {threshold}, replicate {index}!")
-                row[f"Iteration {i}"] = execution_time
-
-            # Compute average execution time over iterations 1 to 4
-            avg_time = sum(execution_times[1:]) / (iterations - 1)
+            measurement_key = {
+                "dataset": dataset,
+                "scale_factor": scale_factor,
+                "query": query,
+                "materialization": fields_list,
+                "fetch": True,
+                "setup": measurement_setup(in_memory=IN_MEMORY),
+            }
+            measurement = None
+            if measurement_cache is not None:
+                measurement = measurement_cache.get(
+                    iterations=ITERATIONS, **measurement_key)
+
+            # Reuse the times measured by an earlier run, whose results were checked then
+            if measurement is not None:
+                execution_times = measurement[0]
+            else:
+                con, _ = _create_connection(db_dir=db_dir)
+                prepare_database(con=con, fields=fields, include_print=False)
+
+                execution_times = []
+
+                # Execute the test iterations and record their times, without
+                # background copies of the database competing for I/O
+                with paused():
+                    while not done_iterating(execution_times=execution_times, iterations=ITERATIONS):
+                        i = len(execution_times)
+                        start_time = time.perf_counter()
+                        result = con.execute(query).fetchdf()
+                        end_time = time.perf_counter()
+                        execution_time = end_time - start_time
+                        execution_times.append(execution_time)
+
+                        if i == 0:
+                            # Save the result of the first iteration as the baseline for this test.
+                            baseline_result = result.copy()
+                        else:
+                            # Check that subsequent iterations yield the same result.
+                            if not baseline_result.equals(result):
+                                raise ValueError(
+                                    f"[{query_name}] Query results differ in iteration {i} for threshold {threshold}, replicate {index}!")
+
+                if ITERATIONS == ADAPTIVE_ITERATIONS:
+                    record_repetition(execution_times=execution_times)
+                if measurement_cache is not None:
+                    measurement_cache.put(
+                        execution_times=execution_times, planning_time=None, iterations=ITERATIONS, **measurement_key)
+
+            row.update(timing_summary(execution_times=execution_times))
+
+            # Compute average execution time over the iterations after the first, under
+            # the name it had when there were 5 iterations
+            avg_time = sum(execution_times[1:]) / (len(execution_times) - 1)
             row['Avg (last 4 runs)'] = avg_time
 
             row["No. materialized fields"] = len(fields_list)
@@ -221,7 +258,9 @@ def _perform_tests(
 
             rows.append(row)
 
-            # Check consistency across all materializations:
+            # Check consistency across all materializations, if the query ran
+            if baseline_result is None:
+                continue
             if global_baseline_result is None:
                 global_baseline_result = baseline_result.copy()
             else:
@@ -242,13 +281,16 @@ def _create_fresh_db(db_dir: str):
     db_path = f"./data/db/{db_dir}.duckdb"
     backup_path = f"./data/backup/{db_dir}"
 
-    if os.path.exists(db_path):
-        os.remove(db_path)
-        print(f"Removed db at path {db_path}")
+    if IN_MEMORY:
+        import_in_memory(db_path=db_path, backup_path=backup_path)
+    else:
+        if os.path.exists(db_path):
+            os.remove(db_path)
+            print(f"Removed db at path {db_path}")
 
-    with duckdb.connect(db_path) as con:
-        con.execute("SET default_block_size = '16384'")
-        con.execute(f"IMPORT DATABASE '{backup_path}';")
+        with duckdb.connect(db_path) as con:
+            con.execute("SET default_block_size = '16384'")
+            con.execute(f"IMPORT DATABASE '{backup_path}';")
 
     CLEAN_UP_FILES.add(db_path)
 
@@ -268,6 +310,11 @@ def main():
     # Generate random materializations for each query
     materializations = _generate_materializations(queries=queries)
 
+    measurement_cache = None
+    if USE_MEASUREMENT_CACHE:
+        measurement_cache = MeasurementCache(
+            max_age=MEASUREMENT_MAX_AGE, force=FORCE_MEASUREMENT)
+
     meta_results = []
 
     for db in db_backups:
@@ -285,7 +332,9 @@ def main():
                 query_object=queries[query_name],
                 materializations=strategies,
                 db_dir=db_dir,
-                dataset=dataset
+                dataset=dataset,
+                scale_factor=scale_factor,
+                measurement_cache=measurement_cache
             )
             query_results_list.append(query_results)
             print(
@@ -303,10 +352,19 @@ def main():
 
         meta_results.append(merged_query_results)
 
+        # Free the memory of the backup before importing the next
+        if IN_MEMORY:
+            db_path = f"./data/db/{db_dir}.duckdb"
+            remove_database(db_path)
+            CLEAN_UP_FILES.discard(db_path)
+
         print(
             f"!! Finished with scale factor {scale_factor} in {int(time.perf_counter() - scale_factor_time)} seconds")
         print("-------------------------------------------")
 
+    if measurement_cache is not None:
+        measurement_cache.flush()
+
     # Merge all the DataFrames from the db_backups loop into a final shared DataFrame
     final_shared_df = pd.concat(meta_results, ignore_index=True)
     final_shared_df.to_csv(
@@ -316,6 +374,8 @@ def main():
 if __name__ == "__main__":
     t = time.perf_counter()
     main()
+    print_setup_report()
+    print_repetition_report()
     _clean_up()
 
     print(f"Finished test in time ~{int(time.perf_counter() - t)/60} minutes")
@@ -26,6 +26,8 @@ spec = importlib.util.spec_from_file_location("setup", setup_path)
 tpch_setup = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(tpch_setup)
 
+from utils.usage_matrix import UsageMatrix  # noqa: E402
+
 # Third-party imports
 
 # Local imports
@@ -49,6 +51,19 @@ TPCH_TABLE_SIZES = {
 
 # Load query definitions
 QUERIES = tpch_setup.QUERIES
+# Column usage of each query, computed once
+USAGE = UsageMatrix(QUERIES)
+
+# Usage frequency columns, by the clause counted. None counts every use
+FREQUENCY_COLUMNS = {
+    "Total Frequency": None,
+    "Join Frequency": "join",
+    "Where Frequency": "where",
+    "Select Frequency": "select",
+    "Group By Frequency": "group_by",
+    "Order By Frequency": "order_by",
+    "Self Join Frequency": "self_join",
+}
 
 # Define join categories
 
@@ -135,69 +150,15 @@ def load_results_data():
 
 # Functions for analyzing query usage patterns
 
-def get_field_frequency_for_query(query_name, materialized_column):
-    """Count total occurrences of a column in a query"""
-    q = QUERIES[query_name]
-    cols = q.columns_used()
-    return cols.count(materialized_column)
-
-
-def get_field_join_frequency_for_query(query_name, materialized_column):
-    """Count how many times a column is used in joins"""
-    q = QUERIES[query_name]
-    cols = q.columns_used_in_join()
-    if materialized_column in cols:
-        return len(cols[materialized_column])
-    else:
-        return 0
-
-
-def get_field_where_frequency_for_query(query_name, materialized_column):
-    """Count how many times a column is used in WHERE clauses"""
-    q = QUERIES[query_name]
-    cols = q.columns_used_with_position()["where"]
-    return cols.count(materialized_column)
-
-
-def get_field_select_frequency_for_query(query_name, materialized_column):
-    """Count how many times a column is used in SELECT clauses"""
-    q = QUERIES[query_name]
-    cols = q.columns_used_with_position()["select"]
-    return cols.count(materialized_column)
-
-
-def get_field_group_by_frequency_for_query(query_name, materialized_column):
-    """Count how many times a column is used in GROUP BY clauses"""
-    q = QUERIES[query_name]
-    cols = q.columns_used_with_position()["group_by"]
-    return cols.count(materialized_column)
-
-
-def get_field_order_by_frequency_for_query(query_name, materialized_column):
-    """Count how many times a column is used in ORDER BY clauses"""
-    q = QUERIES[query_name]
-    cols = q.columns_used_with_position()["order_by"]
-    return cols.count(materialized_column)
-
-
-def get_self_join_frequency_for_query(query_name, materialized_column):
-    """Count how many times a column is used in self-joins"""
-    q = QUERIES[query_name]
-    cols = q.columns_used_with_position()
-    if "self_join" in cols and materialized_column in cols["self_join"].keys():
-        return cols["self_join"][materialized_column]
-    return 0
-
-
 def get_join_category(query_name, materialized_column, previous_materializations, table_size):
     """Determine the join category for a materialized column"""
-    q = QUERIES[query_name]
+    join_fields = USAGE.join_fields[query_name]
 
     # Check if the column is used in a join
-    if materialized_column not in q.columns_used_in_join():
+    if materialized_column not in join_fields:
         return JoinCategory.NO_COUNTERPART
 
-    counterpart = q.columns_used_in_join()[materialized_column][0]
+    counterpart = join_fields[materialized_column][0]
     if counterpart is None:
         return JoinCategory.NO_COUNTERPART
 
@@ -217,12 +178,12 @@ def get_join_category(query_name, materialized_column, previous_materializations
 
 def get_join_counterpart_info(query_name, materialized_column, previous_materializations):
     """Get information about the join counterpart of a materialized column"""
-    q = QUERIES[query_name]
+    join_fields = USAGE.join_fields[query_name]
 
-    if materialized_column not in q.columns_used_in_join():
+    if materialized_column not in join_fields:
         return None, None, False
 
-    counterpart = q.columns_used_in_join()[materialized_column][0]
+    counterpart = join_fields[materialized_column][0]
     if counterpart is None:
         return None, None, False
 
@@ -237,33 +198,9 @@ def get_join_counterpart_info(query_name, materialized_column, previous_material
 
 def add_usage_frequencies(df):
     """Add column usage frequency information to the dataframe"""
-    df["Total Frequency"] = df.apply(
-        lambda row: get_field_frequency_for_query(row["Query"], row["Materialization"]), axis=1
-    )
-
-    df["Join Frequency"] = df.apply(
-        lambda row: get_field_join_frequency_for_query(row["Query"], row["Materialization"]), axis=1
-    )
-
-    df["Where Frequency"] = df.apply(
-        lambda row: get_field_where_frequency_for_query(row["Query"], row["Materialization"]), axis=1
-    )
-
-    df["Select Frequency"] = df.apply(
-        lambda row: get_field_select_frequency_for_query(row["Query"], row["Materialization"]), axis=1
-    )
-
-    df["Group By Frequency"] = df.apply(
-        lambda row: get_field_group_by_frequency_for_query(row["Query"], row["Materialization"]), axis=1
-    )
-
-    df["Order By Frequency"] = df.apply(
-        lambda row: get_field_order_by_frequency_for_query(row["Query"], row["Materialization"]), axis=1
-    )
-
-    df["Self Join Frequency"] = df.apply(
-        lambda row: get_self_join_frequency_for_query(row["Query"], row["Materialization"]), axis=1
-    )
+    for column, clause in FREQUENCY_COLUMNS.items():
+        df[column] = USAGE.lookup(
+            df["Query"].tolist(), df["Materialization"].tolist(), clause=clause)
 
     return df
 